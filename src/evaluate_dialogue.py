@@ -3,20 +3,33 @@
 
 import os
 import json
+import asyncio
 import logging
-import boto3
-from botocore.exceptions import ClientError
-import diskcache
 from os import path
-from time import sleep
 import argparse
 from util.evaluation_prompts import *
+from util.combined_rubric import COMBINED_DIMENSION, parse_combined_evaluation
+from util.async_llm import get_async_invoker, configure_async_invoker
+from util.llm_cache import (make_cache_key, is_deterministic, get_response_cache, configure_response_cache,
+                             log_cache_stats, EVICTION_POLICIES, DEFAULT_SIZE_LIMIT_GB, DEFAULT_EVICTION_POLICY)
+from util.rate_limiter import configure_rate_limits, estimate_tokens, RATE_LIMITS_PATH
+from util.retry import get_retry_engine, configure_retry, conversation_deadline, DEFAULT_MAX_ATTEMPTS, DEFAULT_CALL_DEADLINE
+from util.cassette import configure_cassette
+from util.telemetry import configure_telemetry, telemetry_tags, task_domain, log_telemetry_summary
+from util.prompt_caching import (PromptParts, supports_prompt_caching, prompt_cache_min_tokens, split_template,
+                                 claude_request)
+from util.user_context import load_user_context, format_situation
+from util.profile_store import get_profile_store
+from util.task_index import select_user_tasks, filter_tasks
+from util.cohort import select_users
+from util.validate_data import validate_users
+from util.eval_manifest import EvaluationManifest
+from util.bedrock_client import (get_bedrock_client, refresh_bedrock_client, configure_bedrock_clients,
+                                 DEFAULT_MAX_POOL_CONNECTIONS, DEFAULT_ENDPOINT_URL)
 
 
 DOMAINS = ['Alarm', 'Books', 'Buses', 'Calendar', 'Events', 'Finance', 'Flights', 'Games', 'Hotels', 'Media', 'Messaging', 'Movies', 'Music', 'Rental Cars', 'Restaurants', 'Services', 'Shopping', 'Sports', 'Train', 'Travel']
 
-BEDROCK_SERVICE = "bedrock-runtime"
-
 
 model_id_dict = {
     "anthropic.claude-3-5-sonnet-20240620-v1:0": "claude-3-5-sonnet-v1",
@@ -58,114 +71,292 @@ CACHES_DIR = path.join(DATA_DIR, 'caches')
 
 class ClaudeLLM:
     def __init__(self, model_id='anthropic.claude-3-sonnet-20240229-v1:0', region="us-east-1", max_tokens=512,
-                 temperature=0.5, system_prompt="") -> None:
+                 temperature=0.5, system_prompt="", profile_name=None, cache_responses=False,
+                 prompt_caching=False) -> None:
         self.model_id = model_id
         self.region = region
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.system_prompt = system_prompt
-        self.cache = diskcache.Cache(path.join(CACHES_DIR, model_id))
+        self.profile_name = profile_name
+        # Only deterministic completions are ever served from the cache
+        self.cache_responses = cache_responses and is_deterministic(temperature)
+        self.cache = get_response_cache(path.join(CACHES_DIR, model_id))
+        # Cache checkpoints are only sent to models supporting Bedrock prompt caching
+        self.prompt_caching = prompt_caching and supports_prompt_caching(model_id)
         self.__init_session()
 
     def __init_session(self):
-        self.session = boto3.Session()
-        self.client = self.session.client(
-            BEDROCK_SERVICE,
-            region_name=self.region
-        )
+        self.client = get_bedrock_client(self.region, self.profile_name)
+
+    def __refresh_session(self):
+        self.client = refresh_bedrock_client(self.region, self.profile_name)
 
     def __invoke(self, prompt):
-        backoff_time = 0.5
-        while True:
-            try:
-                body = {
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": self.max_tokens,
-                        "temperature": self.temperature,
-                        "system": self.system_prompt,
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", 
-                                     "text": prompt
-                                    }
-                                ],
-                            }
-                        ],
-                    }
-
-                return self.client.invoke_model(
-                    body=json.dumps(body),
-                    modelId=self.model_id
-                )
-            except ClientError as e:
-                code = e.response['Error']['Code']
-                # print(e.response)
-                if code == 'ThrottlingException':
-                    logging.warning(f"[ThrottlingException] Waiting for ({backoff_time:.1f})s.")
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                elif code == 'ExpiredTokenException':
-                    logging.warning(f"[ExpiredTokenException] Refreshing session security token.")
-                elif code == 'ModelErrorException':
-                    logging.warning(f'error calling {self.model_id}, trying again')
-                    return self.__invoke(prompt)
-                elif code == 'ServiceUnavailableException':
-                    logging.warning(f'Service Unavailable error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(prompt)
-                elif code == 'ModelTimeoutException':
-                    logging.warning(f'Model timeout error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(prompt)
-                else:
-                    raise Exception(f"Unhandled boto ClientError: {code}")
+        system, messages = claude_request(self.system_prompt, [{"role": "user", "content": prompt}], self.prompt_caching,
+                                          prompt_cache_min_tokens(self.model_id))
+        body = {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": self.max_tokens,
+                "temperature": self.temperature,
+                "system": system,
+                "messages": messages,
+            }
+        body = json.dumps(body)
+        return get_retry_engine().call(
+            lambda: self.client.invoke_model(body=body, modelId=self.model_id),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
+        )
+
+    def request_digest(self, prompt):
+        """Digest of everything the completion of `prompt` depends on: prompt, model and parameters."""
+        return make_cache_key(self.model_id, prompt, self.system_prompt, self.temperature, self.max_tokens)
 
     def invoke(self, prompt, use_caching=True):
-        if prompt in self.cache and use_caching:
-            completion = self.cache[prompt]
-        else:
+        cache_key = self.request_digest(prompt)
+        completion = self.cache.get(cache_key) if use_caching else None
+        if completion is None:
             response = self.__invoke(prompt)
             completion = json.loads(response.get('body').read())["content"][0]["text"]
-            self.cache[prompt] = completion
+            if use_caching:
+                self.cache.set(cache_key, completion)
         return completion
 
     def get_msg_body(self, prompt):
+        system, messages = claude_request(self.system_prompt, [{"role": "user", "content": prompt}], self.prompt_caching,
+                                          prompt_cache_min_tokens(self.model_id))
         body = {
                 "anthropic_version": "bedrock-2023-05-31",
                 "max_tokens": self.max_tokens,
                 "temperature": self.temperature,
-                "system": self.system_prompt,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", 
-                                "text": prompt
-                            }
-                        ],
-                    }
-                ],
+                "system": system,
+                "messages": messages,
             }
         return body
 
     def single_turn_request(self, utterance):
         # return self.invoke(f"\n\nHuman:{utterance}\n\nAssistant:")
-        return self.invoke(f"{utterance}", use_caching=False)
+        if not isinstance(utterance, PromptParts):
+            utterance = f"{utterance}"
+        return self.invoke(utterance, use_caching=self.cache_responses)
+
+    async def ainvoke(self, prompt, use_caching=True):
+        return await get_async_invoker().run(self.invoke, prompt, use_caching=use_caching)
+
+    async def asingle_turn_request(self, utterance):
+        return await get_async_invoker().run(self.single_turn_request, utterance)
+
+def format_eval_prompt(template, prompt_caching=False, **kwargs):
+    """Fill an evaluation template; with prompt caching, split it after the static rubric ahead of its first field."""
+    if not prompt_caching:
+        return template.format(**kwargs)
+    prefix, rest = split_template(template)
+    return PromptParts([prefix, rest.format(**kwargs)])
 
 # Function to save the LLM answer to the specified path
+def answer_path(user_id, task_id, model_id_asst, model_id_eval, eval_dimension, evalname="", path="evaluation"):
+    return os.path.join(f"output/{path}/user{user_id}/{model_id_asst}/{eval_dimension}/{model_id_eval}",
+                        f"{task_id}{evalname}.txt")
+
 def save_user_answer(user_id, task_id, answer, model_id_asst, model_id_eval, eval_dimension, evalname="", path="evaluation"):
+    file_path = answer_path(user_id, task_id, model_id_asst, model_id_eval, eval_dimension, evalname, path)
     # Create the user-specific directory if it doesn't exist
-    save_path = f"output/{path}/user{user_id}/{model_id_asst}/{eval_dimension}/{model_id_eval}"
-    os.makedirs(save_path, exist_ok=True)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
     
     # Save the answer to a file
-    with open(os.path.join(save_path, f"{task_id}{evalname}.txt"), "w") as f:
+    with open(file_path, "w") as f:
         f.write(answer)
+    return file_path
+
+
+def eval_template(eval_dimension, assistant=False):
+    """Return the (file suffix, template) judging `eval_dimension` on assistant or user utterances."""
+    if eval_dimension == "naturalness":
+        if assistant:
+            return "_asst", EVAL_DIALOGUE_NATURALNESS_ASSISTANT
+        return "_user", EVAL_DIALOGUE_NATURALNESS_USER
+    elif eval_dimension == "coherence":
+        if assistant:
+            return "_asst", EVAL_DIALOGUE_COHERENCE_ASSISTANT
+        return "_user", EVAL_DIALOGUE_COHERENCE_USER
+    elif eval_dimension == "task_completion":
+        return "", EVAL_DIALOGUE_TASK_COMPLETION
+    elif eval_dimension == "personalization":
+        return "", EVAL_DIALOGUE_PERSONALIZATION
+    elif eval_dimension == COMBINED_DIMENSION:
+        return "", EVAL_DIALOGUE_COMBINED
+    raise ValueError(f"Your specified eval dimension {eval_dimension} is not matched.")
+
+# Every judge template, named after its dimension and file suffix, as (eval_dimension, assistant)
+EVAL_RUNS = {
+    "naturalness_user": ("naturalness", False),
+    "naturalness_asst": ("naturalness", True),
+    "coherence_user": ("coherence", False),
+    "coherence_asst": ("coherence", True),
+    "task_completion": ("task_completion", False),
+    "personalization": ("personalization", False),
+    # One call rating all of the above, see util.combined_rubric
+    COMBINED_DIMENSION: (COMBINED_DIMENSION, False),
+}
+
+def eval_runs(dimensions=None, eval_dimension="naturalness", assistant=False):
+    """
+    Resolve the `--dimensions` (or `-d`/`-a`) arguments into the templates to run.
+
+    Returns:
+        List of (eval_dimension, evalname, template)
+    """
+    if not dimensions:
+        return [(eval_dimension, *eval_template(eval_dimension, assistant))]
+    # `all` stands for the single-dimension templates; name `combined` as well to judge both ways
+    names = [name for name in EVAL_RUNS if name != COMBINED_DIMENSION] if "all" in dimensions else []
+    names = list(dict.fromkeys(names + [name for name in dimensions if name != "all"]))
+    runs = []
+    for name in names:
+        if name not in EVAL_RUNS:
+            raise ValueError(f"Unknown dimension {name}, choose from: all, {', '.join(EVAL_RUNS)}")
+        runs.append((EVAL_RUNS[name][0], *eval_template(*EVAL_RUNS[name])))
+    return runs
+
+def evaluation_tasks(sample, selection, multi_domain):
+    """Yield the (user_id, user_context, task) of every dialogue to evaluate, loading each user once."""
+    for i in sample:
+        user_context = load_user_context(i)
+        tasks = filter_tasks(get_profile_store().tasks(i, multi_domain=multi_domain), selection and selection[i])
+        for _, task in tasks.items():
+            yield i, user_context, task
+
+def build_judge_jobs(i, user_context, task, args, runs, prompt_caching=False):
+    """
+    Load the dialogue of `task` once and render the judge prompt of every run of `runs` on it.
+
+    Returns:
+        List of (user_id, task_id, (eval_dimension, evalname), prompt, telemetry tags)
+    """
+    file_path = os.path.join(f"output/dialogue/user{i}/{args.model_id_asst}", f"{task['task_id']}_dialogue.json")
+    with open(file_path) as f:
+        data = json.load(f)
 
+    task_id = data['task_id']
+    relevant_domains = task['Relevant Domains']
+
+    # Format conversation
+    dialogue_formatted = "\n".join([f"[{msg['role'].upper()}]: {msg['content']}"
+                                    for msg in data['dialogue']])
+
+    def personalization_context():
+        if args.multi_domain:
+            pref_str = user_context.affinities(relevant_domains)
+            interaction_summary = user_context.interaction_summaries(relevant_domains)
+        else:
+            pref_str = user_context.affinity(relevant_domains[0])
+            interaction_summary = user_context.interaction_summary(relevant_domains[0])
+        return dict(
+            # The judge sees the full demographic profile, user id included
+            demographic_profile=user_context.profile_demographics,
+            user_affinity=pref_str,
+            task_description=task['User Intent'],
+            interaction_summary=interaction_summary,
+            situation_context=format_situation(task['situations']))
+
+    jobs = []
+    for eval_dimension, evalname, template in runs:
+        if eval_dimension in ["naturalness", "coherence"]:
+            prompt = format_eval_prompt(template, prompt_caching, conversation=dialogue_formatted)
+        elif eval_dimension == "task_completion":
+            prompt = format_eval_prompt(template, prompt_caching, conversation=dialogue_formatted, goal=task['Task Goal'])
+        elif eval_dimension == "personalization":
+            prompt = format_eval_prompt(template, prompt_caching, conversation=dialogue_formatted,
+                                        **personalization_context())
+        else:
+            prompt = format_eval_prompt(template, prompt_caching, conversation=dialogue_formatted,
+                                        goal=task['Task Goal'], **personalization_context())
+
+        tags = {"user": i, "task": task_id, "domain": task_domain(relevant_domains), "role": "judge",
+                "dimension": eval_dimension + evalname}
+        jobs.append((i, task_id, (eval_dimension, evalname), prompt, tags))
+    return jobs
+
+def judge(llm, job):
+    *_, prompt, tags = job
+    with telemetry_tags(**tags):
+        return llm.single_turn_request(prompt)
+
+async def ajudge(llm, job):
+    *_, prompt, tags = job
+    with telemetry_tags(**tags):
+        return await llm.asingle_turn_request(prompt)
+
+async def evaluate_concurrently(llm, tasks, build_jobs, on_result, workers):
+    """
+    Judge dialogues with up to `workers` judge calls in flight.
+
+    A producer loads the dialogues of `tasks` and renders their prompts with
+    `build_jobs` off the event loop, at most 2 * workers jobs ahead of the judges;
+    `workers` judges pull jobs and await `llm.asingle_turn_request`, and results
+    are handed to `on_result` as they finish, in completion order.
+
+    Args:
+        llm: Judge model
+        tasks: Iterable of (user_id, user_context, task)
+        build_jobs: Callable turning a (user_id, user_context, task) into a list of `build_judge_jobs`
+            tuples to judge and the number of jobs it skipped
+        on_result: Callable taking (user_id, task_id, run, evaluation, exception), where exactly one of
+            evaluation/exception is set, and run is None if the dialogue itself could not be loaded
+        workers: Maximum number of concurrent judge calls
+
+    Returns:
+        Number of jobs `build_jobs` skipped
+    """
+    loop = asyncio.get_running_loop()
+    jobs = asyncio.Queue(maxsize=2 * workers)
+    results = asyncio.Queue()
+
+    async def produce():
+        skipped = 0
+        tasks_iter = iter(tasks)
+        try:
+            while True:
+                item = await loop.run_in_executor(None, next, tasks_iter, None)
+                if item is None:
+                    break
+                user_id, _, task = item
+                try:
+                    task_jobs, task_skipped = await loop.run_in_executor(None, build_jobs, *item)
+                except Exception as e:
+                    await results.put((user_id, task['task_id'], None, None, e))
+                    continue
+                skipped += task_skipped
+                for job in task_jobs:
+                    await jobs.put(job)
+        finally:
+            for _ in range(workers):
+                await jobs.put(None)
+        return skipped
+
+    async def judge_jobs():
+        while (job := await jobs.get()) is not None:
+            try:
+                await results.put((*job[:3], await ajudge(llm, job), None))
+            except Exception as e:
+                await results.put((*job[:3], None, e))
+        await results.put(None)
+
+    producer = asyncio.create_task(produce())
+    judges = [asyncio.create_task(judge_jobs()) for _ in range(workers)]
+    finished = 0
+    while finished < workers:
+        result = await results.get()
+        if result is None:
+            finished += 1
+        else:
+            on_result(*result)
+    # Surface errors of the producer itself, e.g. a user that cannot be loaded
+    skipped = await producer
+    await asyncio.gather(*judges)
+    return skipped
 
 
 if __name__ == '__main__':
@@ -182,164 +373,128 @@ if __name__ == '__main__':
     parser.add_argument("-s3", "--sample_30", action="store_true", help="Whether to use small sample of 30 users.")
     parser.add_argument("-s5", "--sample_50", action="store_true", help="Whether to use small sample of 50 users.")
     parser.add_argument("-s10", "--sample_100", action="store_true", help="Whether to use small sample of 100 users.")
+    parser.add_argument("--validate", action="store_true", help="Whether to check the profiles and tasks of the selected users against res/schema.json before the run.")
+    parser.add_argument("--cohort", type=str, default=None, help="Cohort file, or name of a file under res/cohorts, listing the users to process.")
+    parser.add_argument("--domains", type=str, nargs='+', help="Only evaluate the tasks involving any of these domains.")
+    parser.add_argument("--task_ids", type=str, nargs='+', help="Only evaluate the tasks with these ids.")
     parser.add_argument("-l", "--icl", action="store_true", help="Whether to use in-context learning.")
     parser.add_argument("-p", "--icl_path", type=str, default="icl", help="Path for in-context learning experiment.")
     parser.add_argument("-a", "--assistant", action="store_true", help="Whether to run eval on assistant.")
     parser.add_argument("-md", "--multi_domain", action="store_true", help="Whether to run eval on multi-domain tasks.")
     parser.add_argument("-d", "--eval_dimension", type=str, default='naturalness', help="The evaluation dimension for the dialogue.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of judge calls to keep in flight concurrently.")
+    parser.add_argument("--dimensions", type=str, nargs='+', default=None, choices=["all", *EVAL_RUNS], help="Evaluate these dimensions, or all of them, in one pass over the dialogues instead of -d/-a; `combined` rates all of them in a single judge call.")
+    parser.add_argument("--force", action="store_true", help="Whether to rejudge dialogues whose saved evaluation is up to date.")
+    parser.add_argument("--cache", action="store_true", help="Whether to serve judge calls from the response cache.")
+    parser.add_argument("--cache_size_limit", type=float, default=DEFAULT_SIZE_LIMIT_GB, help="Size cap in GB of each model's response cache directory.")
+    parser.add_argument("--cache_eviction_policy", type=str, default=DEFAULT_EVICTION_POLICY, choices=EVICTION_POLICIES, help="Eviction policy of the response cache.")
+    parser.add_argument("--max_pool_connections", type=int, default=DEFAULT_MAX_POOL_CONNECTIONS, help="Size of the shared Bedrock connection pool.")
+    parser.add_argument("--endpoint_url", type=str, default=DEFAULT_ENDPOINT_URL, help="Bedrock runtime endpoint override, e.g. a local util.fake_bedrock server.")
+    parser.add_argument("--rate_limits", type=str, default=RATE_LIMITS_PATH, help="JSON file with per-model requests/tokens per minute quotas.")
+    parser.add_argument("--no_rate_limit", action="store_true", help="Whether to disable the shared adaptive rate limiter.")
+    parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Maximum attempts per Bedrock call on transient errors.")
+    parser.add_argument("--call_deadline", type=float, default=DEFAULT_CALL_DEADLINE, help="Maximum seconds per Bedrock call, retries included.")
+    parser.add_argument("--prompt_caching", action="store_true", help="Whether to mark the static rubric of each judge prompt as a Bedrock prompt cache checkpoint.")
+    parser.add_argument("--metrics_file", type=str, default=None, help="Append-only JSONL file receiving one token/latency/cost record per Bedrock call.")
+    parser.add_argument("--record", type=str, default=None, help="Cassette directory to record every Bedrock request/response pair to.")
+    parser.add_argument("--replay", type=str, default=None, help="Cassette directory to serve every Bedrock call from, without network access.")
+    parser.add_argument("--replay_latency", action="store_true", help="Whether replayed calls wait for their recorded latency.")
 
     # Parse arguments
     args = parser.parse_args()
 
+    assert not (args.record and args.replay), "--record and --replay are mutually exclusive"
+    configure_cassette("record" if args.record else "replay" if args.replay else None,
+                       args.record or args.replay, reproduce_latency=args.replay_latency)
+    # Every judge keeps one request in flight, so size the shared connection pool and invoker accordingly
+    configure_bedrock_clients(max_pool_connections=max(args.max_pool_connections, args.workers),
+                              endpoint_url=args.endpoint_url)
+    configure_async_invoker(max_concurrency=args.workers)
+    configure_rate_limits(None if args.no_rate_limit else args.rate_limits)
+    configure_retry(max_attempts=args.max_attempts, call_deadline=args.call_deadline)
+    configure_response_cache(size_limit_gb=args.cache_size_limit, eviction_policy=args.cache_eviction_policy)
+    configure_telemetry(metrics_file=args.metrics_file)
+
     llm = ClaudeLLM(
             model_id=model_id_reverse_dict[args.model_id_eval],
             region=args.bedrock_region,
             temperature=0, 
-            max_tokens=4000)
+            max_tokens=4000,
+            cache_responses=args.cache,
+            prompt_caching=args.prompt_caching)
     
     ratings = {}
 
-    sample_20_idxs = [66, 132, 139, 207, 230, 340, 386, 389, 415, 428, 597, 746, 774, 854, 900, 1111, 1197, 1231, 1322, 1458]
-    sample_30_idxs = [7, 66, 132, 139, 207, 230, 251, 313, 340, 376, 386, 389, 415, 428, 597, 746, 774, 788, 822, 854, 900, 1111, 1142, 1150, 1197, 1231, 1322, 1458, 1492, 1495]
-    sample_50_idxs = [7, 53, 66, 107, 132, 139, 167, 195, 207, 230, 251, 313, 340, 376, 386, 389, 415, 418, 428, 439, 517, 532, 597, 630, 641, 660, 674, 701, 746, 774, 788, 802, 822, 854, 900, 1111, 1142, 1145, 1150, 1197, 1231, 1322, 1335, 1362, 1377, 1439, 1458, 1492, 1493, 1495]
-    sample_100_idxs = [7, 21, 53, 66, 86, 107, 132, 139, 157, 166, 167, 168, 195, 207, 230, 248, 251, 312, 313, 340, 352, 363, 365, 376, 386, 389, 394, 415, 418, 428, 431, 439, 470, 482, 517, 532, 597, 619, 630, 641, 657, 659, 660, 664, 674, 686, 689, 701, 744, 745, 746, 774, 788, 802, 813, 822, 838, 840, 842, 847, 854, 857, 870, 878, 880, 900, 913, 928, 942, 954, 997, 1069, 1111, 1114, 1118, 1120, 1142, 1145, 1150, 1151, 1167, 1184, 1197, 1231, 1246, 1322, 1330, 1335, 1345, 1362, 1377, 1384, 1434, 1439, 1458, 1461, 1492, 1493, 1495, 1496]
-    
-    assert len(sample_30_idxs) == 30
-    assert len(sample_50_idxs) == 50
-    assert len(sample_100_idxs) == 100
-
-    if args.sample_30:
-        sample = sample_30_idxs
-    elif args.sample_50:
-        sample = sample_50_idxs
-    elif args.sample_100:
-        sample = sample_100_idxs
-    elif args.sample_20:
-        sample = sample_20_idxs
-    else:
-        sample = range(args.start_index, args.end_index + 1)
+    sample = select_users(args)
+    sample, selection = select_user_tasks(sample, multi_domain=args.multi_domain, domains=args.domains, task_ids=args.task_ids)
+    if args.validate:
+        validate_users(sample)
 
-    assert args.eval_dimension in ["naturalness", "coherence", "task_completion", "personalization"]
+    assert args.eval_dimension in ["naturalness", "coherence", "task_completion", "personalization", COMBINED_DIMENSION]
+    runs = eval_runs(args.dimensions, args.eval_dimension, args.assistant)
 
-    if args.eval_dimension == "naturalness":
-        if args.assistant:
-            evalname = "_asst"
-            TEMPLATE_EVAL = EVAL_DIALOGUE_NATURALNESS_ASSISTANT
-        else:
-            evalname = "_user"
-            TEMPLATE_EVAL = EVAL_DIALOGUE_NATURALNESS_USER
-    elif args.eval_dimension == "coherence":
-        if args.assistant:
-            evalname = "_asst"
-            TEMPLATE_EVAL = EVAL_DIALOGUE_COHERENCE_ASSISTANT
-        else:
-            evalname = "_user"
-            TEMPLATE_EVAL = EVAL_DIALOGUE_COHERENCE_USER
-    elif args.eval_dimension == "task_completion":
-        evalname = ""
-        TEMPLATE_EVAL = EVAL_DIALOGUE_TASK_COMPLETION
-    elif args.eval_dimension == "personalization":
-        evalname = ""
-        TEMPLATE_EVAL = EVAL_DIALOGUE_PERSONALIZATION
-    else:
-        print(f"Your specified eval dimension {args.eval_dimension} is not matched.")
-        exit()
-    
-    dialogue_path = "dialogue/"
     evaluation_path = "evaluation"
-    
-    count = 0
-    inputs = []
-    for i in sample:
-        directory_path = f"output/{dialogue_path}/user{i}/{args.model_id_asst}"
-        
-        with open(f"data/profile/user{i}/profile.json") as f:
-            user_profile = json.load(f)
-
-        if args.multi_domain:
-            with open(f"data/profile/user{i}/tasks_md.json") as f:
-                tasks = json.load(f)
-        else:
-            with open(f"data/profile/user{i}/tasks.json") as f:
-                tasks = json.load(f)
-        
-        for _, task in tasks.items():
-            file_name = f"{task['task_id']}_dialogue.json"
-            file_path = os.path.join(directory_path, file_name)
-            with open(file_path) as f:
-                data = json.load(f)
-
-            task_id = data['task_id']
-            relevant_domains = task['Relevant Domains']
-            demographic_profile = user_profile['demographics']
-            situation_context = task['situations']
-            task_description = task['User Intent']
-            
-            # Format demographic profile
-            demo_str = "\n".join([f"- {k}: {v}" for k, v in demographic_profile.items()])
-
-            # Format situation context
-            situation_str = "\n".join([f"- {k}: {v}" for k, v in situation_context.items()])
-            
-            # Format conversation
-            dialogue_formatted = "\n".join([f"[{msg['role'].upper()}]: {msg['content']}" 
-                                for msg in data['dialogue']])
-            
-            if args.multi_domain:
-                # Format user preferences
-                pref_str = ""
-                for domain in relevant_domains:
-                    pref_str += "\n"+domain+":\n"
-                    pref_str += "\n".join([f"- {k}: {', '.join(map(str, v))}" if isinstance(v, list) else f"- {k}: {v}" for k, v in user_profile['affinities'][domain].items()])
-                    pref_str += "\n"
-    
-                # Format interaction summary
-                interaction_summary = ""
-                for domain in relevant_domains:
-                    interaction_summary += "\n<"+domain+">\n"
-                    interaction_summary += user_profile['interactions'][domain]
-                    interaction_summary += "\n</"+domain+">\n"
-
+    manifest = EvaluationManifest()
+    # Judge request digest of every job in flight, recorded in the manifest once its evaluation is saved
+    digests = {}
+
+    def build_jobs(i, user_context, task):
+        """The judge jobs of a dialogue whose evaluations are not current, and the number of those skipped."""
+        jobs = []
+        skipped = 0
+        for job in build_judge_jobs(i, user_context, task, args, runs, llm.prompt_caching):
+            _, task_id, run, prompt, _ = job
+            digest = llm.request_digest(prompt)
+            file_path = answer_path(i, task_id, args.model_id_asst, args.model_id_eval, *run, path=evaluation_path)
+            if not args.force and manifest.is_current(file_path, digest):
+                skipped += 1
+                continue
+            digests[(i, task_id, run)] = digest
+            jobs.append(job)
+        return jobs, skipped
+
+    def save(i, task_id, run, evaluation):
+        eval_dimension, evalname = run
+        if eval_dimension == COMBINED_DIMENSION:
+            try:
+                parse_combined_evaluation(evaluation)
+            except ValueError as e:
+                # Saved all the same, so the response can be inspected; util.gather_evaluation skips it
+                logging.warning(f"User{i} {task_id} combined evaluation does not follow the response format: {e}")
+        file_path = save_user_answer(i, task_id, evaluation, model_id_asst=args.model_id_asst, model_id_eval=args.model_id_eval,
+                                     eval_dimension=eval_dimension, evalname=evalname, path=evaluation_path)
+        manifest.record(file_path, digests.pop((i, task_id, run)))
+
+    if args.workers > 1:
+        failed = 0
+
+        def on_result(i, task_id, run, evaluation, exception):
+            global failed
+            if exception is not None:
+                failed += 1 if run else len(runs)
+                dimension = "".join(run) if run else "dialogue"
+                logging.error(f"User{i} {task_id} dialogue {dimension} evaluation failed: {exception!r}")
             else:
-                user_affinity = user_profile['affinities'][relevant_domains[0]]
-                interaction_summary = user_profile['interactions'][relevant_domains[0]]
-                
-                # Format user preferences
-                pref_str = "\n".join([f"- {k}: {', '.join(map(str, v))}" if isinstance(v, list) else f"- {k}: {v}" for k, v in user_affinity.items()])
-          
-
-            if args.eval_dimension in ["naturalness", "coherence"]:
-                evaluation = llm.single_turn_request(
-                    TEMPLATE_EVAL.format(conversation=dialogue_formatted)
-                )
-            elif args.eval_dimension == "task_completion":
-                evaluation = llm.single_turn_request(
-                    TEMPLATE_EVAL.format(conversation=dialogue_formatted, goal=task['Task Goal'])
-                )
-            elif args.eval_dimension == "personalization":
-            
-                evaluation = llm.single_turn_request(
-                    TEMPLATE_EVAL.format(
-                        demographic_profile=demo_str,
-                        user_affinity=pref_str,
-                        task_description=task_description,
-                        interaction_summary=interaction_summary,
-                        situation_context=situation_str,
-                        conversation=dialogue_formatted)
-                )
-           
-
-            logging.info(f"User{i} {task_id} dialogue {args.eval_dimension} evaluation done.")
-            
-            # Save the answer for the current user
-            save_user_answer(i, task_id, evaluation, model_id_asst=args.model_id_asst, model_id_eval=args.model_id_eval,
-                             eval_dimension=args.eval_dimension, evalname=evalname, path=evaluation_path)
-        
-        logging.info(f"User{i} interaction evaluation saved.")
-    
-   
-
-        
-
-    
+                save(i, task_id, run, evaluation)
+                logging.info(f"User{i} {task_id} dialogue {''.join(run)} evaluation saved.")
 
+        skipped = asyncio.run(evaluate_concurrently(llm, evaluation_tasks(sample, selection, args.multi_domain),
+                                                    build_jobs, on_result, args.workers))
+        if failed:
+            logging.warning(f"{failed} evaluations failed, rerun the affected users to evaluate them.")
+    else:
+        skipped = 0
+        for i, user_context, task in evaluation_tasks(sample, selection, args.multi_domain):
+            jobs, task_skipped = build_jobs(i, user_context, task)
+            skipped += task_skipped
+            for job in jobs:
+                evaluation = judge(llm, job)
+                logging.info(f"User{i} {job[1]} dialogue {''.join(job[2])} evaluation done.")
+
+                # Save the answer for the current user
+                save(i, job[1], job[2], evaluation)
+
+    if skipped:
+        logging.info(f"Skipped {skipped} evaluations whose dialogue, prompt and judge are unchanged (--force to rejudge them).")
+    log_cache_stats()
+    log_telemetry_summary()
@@ -4,16 +4,30 @@
 import os
 import json
 import logging
-import boto3
-from botocore.exceptions import ClientError
-import diskcache
 from os import path
-from time import sleep
 from typing import List, Dict
 import argparse
 from util.assistant_prompts import *
-
-BEDROCK_SERVICE = "bedrock-runtime"
+from util.async_llm import get_async_invoker
+from util.streaming import (consume_stream, claude_stream_text, llama_stream_text, mistral_stream_text,
+                            stream_cache_params, cached_stream_stats)
+from util.llm_cache import (make_cache_key, is_deterministic, get_response_cache, configure_response_cache,
+                             log_cache_stats, EVICTION_POLICIES, DEFAULT_SIZE_LIMIT_GB, DEFAULT_EVICTION_POLICY)
+from util.rate_limiter import configure_rate_limits, estimate_tokens, RATE_LIMITS_PATH
+from util.retry import get_retry_engine, configure_retry, conversation_deadline, DEFAULT_MAX_ATTEMPTS, DEFAULT_CALL_DEADLINE
+from util.cassette import configure_cassette
+from util.bedrock_client import (get_bedrock_client, refresh_bedrock_client, configure_bedrock_clients,
+                                 DEFAULT_MAX_POOL_CONNECTIONS, DEFAULT_ENDPOINT_URL)
+from util.parallel import imap_unordered
+from util.telemetry import configure_telemetry, telemetry_tags, task_domain, log_telemetry_summary
+from util.prompt_caching import PromptParts, supports_prompt_caching, prompt_cache_min_tokens, claude_request
+from util.prompt_template import BoundPrompt
+from util.profile_store import get_profile_store
+from util.task_index import select_user_tasks, filter_tasks
+from util.cohort import select_users
+from util.validate_data import validate_users
+from util.user_context import (load_user_context, as_rendered, format_demographics, format_affinities,
+                               format_interaction_summaries, format_situation)
 
 model_id_dict = {
     "anthropic.claude-3-5-sonnet-20240620-v1:0": "claude-3-5-sonnet-v1",
@@ -55,311 +69,412 @@ else:
 
 CACHES_DIR = path.join(DATA_DIR, 'caches')
 
+# Stands in for the rendered dialogue in the prompt context when it is sent as separate messages
+MULTI_TURN_HISTORY = "The conversation so far follows as separate messages."
+# Stands in for a turn left empty, e.g. a bare TERMINATE, as Bedrock rejects messages without content
+EMPTY_TURN = "(no reply)"
+
 
 class ClaudeLLM:
     def __init__(self, model_id='anthropic.claude-3-sonnet-20240229-v1:0', region='us-east-1', max_tokens=512,
-                 temperature=0.5, system_prompt="") -> None:
+                 temperature=0.5, system_prompt="", profile_name=None, cache_responses=False,
+                 prompt_caching=False) -> None:
         self.model_id = model_id
         self.region = region
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.system_prompt = system_prompt
-        self.cache = diskcache.Cache(path.join(CACHES_DIR, model_id))
+        self.profile_name = profile_name
+        # Only deterministic completions are ever served from the cache
+        self.cache_responses = cache_responses and is_deterministic(temperature)
+        self.cache = get_response_cache(path.join(CACHES_DIR, model_id))
+        # Cache checkpoints are only sent to models supporting Bedrock prompt caching
+        self.prompt_caching = prompt_caching and supports_prompt_caching(model_id)
         self.__init_session()
 
     def __init_session(self):
-        self.session = boto3.Session()
-        self.client = self.session.client(
-            BEDROCK_SERVICE,
-            region_name=self.region
+        self.client = get_bedrock_client(self.region, self.profile_name)
+
+    def __refresh_session(self):
+        self.client = refresh_bedrock_client(self.region, self.profile_name)
+
+    def __request_body(self, messages, system_prompt=None):
+        # Convert messages to the format expected by Claude, with cache checkpoints if enabled
+        system, formatted_messages = claude_request(
+            self.system_prompt if system_prompt is None else system_prompt, messages, self.prompt_caching,
+            prompt_cache_min_tokens(self.model_id))
+
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "system": system,
+            "messages": formatted_messages
+        }
+        return json.dumps(body)
+
+    def __invoke(self, messages, system_prompt=None):
+        body = self.__request_body(messages, system_prompt)
+        return get_retry_engine().call(
+            lambda: self.client.invoke_model(body=body, modelId=self.model_id),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
         )
 
-    def __invoke(self, messages):
-        backoff_time = 0.5
-        while True:
-            try:
-                # Convert messages to the format expected by Claude
-                formatted_messages = [
-                    {
-                        "role": msg["role"],
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": msg["content"]
-                            }
-                        ]
-                    }
-                    for msg in messages
-                ]
-
-                body = {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": self.max_tokens,
-                    "temperature": self.temperature,
-                    "system": self.system_prompt,
-                    "messages": formatted_messages
-                }
-
-                return self.client.invoke_model(
-                    body=json.dumps(body),
-                    modelId=self.model_id
-                )
-            except ClientError as e:
-                code = e.response['Error']['Code']
-                if code == 'ThrottlingException':
-                    logging.warning(f"[ThrottlingException] Waiting for ({backoff_time:.1f})s.")
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                elif code == 'ExpiredTokenException':
-                    logging.warning(f"[ExpiredTokenException] Refreshing session security token.")
-                elif code == 'ModelErrorException':
-                    logging.warning(f'error calling {self.model_id}, trying again')
-                    return self.__invoke(messages)
-                elif code == 'ServiceUnavailableException':
-                    logging.warning(f'Service Unavailable error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(messages)
-                elif code == 'ModelTimeoutException':
-                    logging.warning(f'Model timeout error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(messages)
-                else:
-                    raise Exception(f"Unhandled boto ClientError: {code}")
-
-    def invoke(self, messages, use_caching=True):
-        # Create a cache key from the messages
-        cache_key = json.dumps(messages, sort_keys=True)
+    def __invoke_stream(self, messages, stop_on=None, system_prompt=None):
+        body = self.__request_body(messages, system_prompt)
+        # The whole stream is read inside the retry so errors raised mid-stream are retried as well
+        return get_retry_engine().call(
+            lambda: consume_stream(
+                lambda: self.client.invoke_model_with_response_stream(body=body, modelId=self.model_id),
+                claude_stream_text,
+                stop_on=stop_on
+            ),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
+        )
+
+    def invoke(self, messages, use_caching=True, system_prompt=None):
+        # Create a cache key from the request
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        cache_key = make_cache_key(self.model_id, messages, system_prompt, self.temperature, self.max_tokens)
         
-        if cache_key in self.cache and use_caching:
-            completion = self.cache[cache_key]
-        else:
-            response = self.__invoke(messages)
+        completion = self.cache.get(cache_key) if use_caching else None
+        if completion is None:
+            response = self.__invoke(messages, system_prompt)
             completion = json.loads(response.get('body').read())["content"][0]["text"]
-            self.cache[cache_key] = completion
+            if use_caching:
+                self.cache.set(cache_key, completion)
         return completion
 
-    def single_turn_request(self, messages):
-        if isinstance(messages, str):
+    def single_turn_request(self, messages, system_prompt=None):
+        if isinstance(messages, (str, PromptParts)):
             # Convert single string to proper message format
             messages = [{"role": "user", "content": messages}]
-        return self.invoke(messages, use_caching=False)
+        return self.invoke(messages, use_caching=self.cache_responses, system_prompt=system_prompt)
+
+    def stream_request(self, messages, stop_on=None, system_prompt=None):
+        """
+        Stream a completion, returning (completion, stats); reading stops early once `stop_on` is emitted.
+
+        Deterministic completions are served from, and saved to, the response cache like `invoke`.
+        """
+        if isinstance(messages, (str, PromptParts)):
+            messages = [{"role": "user", "content": messages}]
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        cache_key = make_cache_key(self.model_id, messages, system_prompt, self.temperature, self.max_tokens,
+                                   **stream_cache_params(stop_on))
+        completion = self.cache.get(cache_key) if self.cache_responses else None
+        if completion is None:
+            completion, stats = self.__invoke_stream(messages, stop_on=stop_on, system_prompt=system_prompt)
+            if self.cache_responses:
+                self.cache.set(cache_key, completion)
+        else:
+            stats = cached_stream_stats()
+        return completion, stats
+
+    async def ainvoke(self, messages, use_caching=True, system_prompt=None):
+        return await get_async_invoker().run(self.invoke, messages, use_caching=use_caching, system_prompt=system_prompt)
+
+    async def asingle_turn_request(self, messages, system_prompt=None):
+        return await get_async_invoker().run(self.single_turn_request, messages, system_prompt=system_prompt)
 
 class LlamaLLM:
     def __init__(self, model_id='meta.llama2-13b-chat-v1', region='us-east-1', max_tokens=512,
-                 temperature=0.5, top_p=0.9, system_prompt="") -> None:
+                 temperature=0.5, top_p=0.9, system_prompt="", profile_name=None, cache_responses=False) -> None:
         self.model_id = model_id
         self.region = region
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.top_p = top_p
         self.system_prompt = system_prompt
-        self.cache = diskcache.Cache(path.join(CACHES_DIR, model_id))
+        self.profile_name = profile_name
+        # Only deterministic completions are ever served from the cache
+        self.cache_responses = cache_responses and is_deterministic(temperature)
+        self.cache = get_response_cache(path.join(CACHES_DIR, model_id))
+        self.prompt_caching = False
         self.__init_session()
 
     def __init_session(self):
-        self.session = boto3.Session()
-        self.client = self.session.client(
-            BEDROCK_SERVICE,
-            region_name=self.region
-        )
+        self.client = get_bedrock_client(self.region, self.profile_name)
+
+    def __refresh_session(self):
+        self.client = refresh_bedrock_client(self.region, self.profile_name)
 
-    def __format_messages(self, messages):
-        """Format messages into Llama's expected prompt format"""
+    def __format_messages(self, messages, system_prompt=None):
+        """Format a single user turn, or a list of alternating turns, into Llama's expected prompt format"""
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
         formatted_prompt = "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
-        formatted_prompt += self.system_prompt if self.system_prompt else """
+        formatted_prompt += system_prompt if system_prompt else """
 You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe.  
 Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content.
 Please ensure that your responses are socially unbiased and positive in nature."""
         formatted_prompt += "<|eot_id|>\n"
-        formatted_prompt += "<|start_header_id|>user<|end_header_id|>\n\n"
-        formatted_prompt += messages
-        formatted_prompt += "<|eot_id|>\n<|start_header_id|>assistant<|end_header_id|>"
+        for msg in messages:
+            formatted_prompt += f"<|start_header_id|>{msg['role']}<|end_header_id|>\n\n"
+            formatted_prompt += msg["content"]
+            formatted_prompt += "<|eot_id|>\n"
+        formatted_prompt += "<|start_header_id|>assistant<|end_header_id|>"
         return formatted_prompt
 
-    def __invoke(self, messages):
-        backoff_time = 0.5
-        while True:
-            try:
-                formatted_prompt = self.__format_messages(messages)
-                body = {
-                    "prompt": formatted_prompt,
-                    "max_gen_len": self.max_tokens,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p
-                }
-
-                return self.client.invoke_model(
-                    body=json.dumps(body),
-                    modelId=self.model_id
-                )
-            except ClientError as e:
-                code = e.response['Error']['Code']
-                if code == 'ThrottlingException':
-                    logging.warning(f"[ThrottlingException] Waiting for ({backoff_time:.1f})s.")
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                elif code == 'ExpiredTokenException':
-                    logging.warning(f"[ExpiredTokenException] Refreshing session security token.")
-                elif code == 'ModelErrorException':
-                    logging.warning(f'error calling {self.model_id}, trying again')
-                    return self.__invoke(messages)
-                elif code == 'ServiceUnavailableException':
-                    logging.warning(f'Service Unavailable error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(messages)
-                elif code == 'ModelTimeoutException':
-                    logging.warning(f'Model timeout error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(messages)
-                else:
-                    raise Exception(f"Unhandled boto ClientError: {code}")
-
-    def invoke(self, messages, use_caching=True):
-        # Create a cache key from the messages
-        cache_key = json.dumps([{"role": "user", "content": messages}], sort_keys=True)
+    def __request_body(self, messages, system_prompt=None):
+        formatted_prompt = self.__format_messages(messages, system_prompt)
+        body = {
+            "prompt": formatted_prompt,
+            "max_gen_len": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p
+        }
+        return json.dumps(body)
+
+    def __invoke(self, messages, system_prompt=None):
+        body = self.__request_body(messages, system_prompt)
+        return get_retry_engine().call(
+            lambda: self.client.invoke_model(body=body, modelId=self.model_id),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
+        )
+
+    def __invoke_stream(self, messages, stop_on=None, system_prompt=None):
+        body = self.__request_body(messages, system_prompt)
+        # The whole stream is read inside the retry so errors raised mid-stream are retried as well
+        return get_retry_engine().call(
+            lambda: consume_stream(
+                lambda: self.client.invoke_model_with_response_stream(body=body, modelId=self.model_id),
+                llama_stream_text,
+                stop_on=stop_on
+            ),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
+        )
+
+    def invoke(self, messages, use_caching=True, system_prompt=None):
+        # Create a cache key from the request
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        history = messages if isinstance(messages, list) else [{"role": "user", "content": messages}]
+        cache_key = make_cache_key(self.model_id, history, system_prompt,
+                                   self.temperature, self.max_tokens, top_p=self.top_p)
         
-        if cache_key in self.cache and use_caching:
-            completion = self.cache[cache_key]
-        else:
-            response = self.__invoke(messages)
+        completion = self.cache.get(cache_key) if use_caching else None
+        if completion is None:
+            response = self.__invoke(messages, system_prompt)
             response_body = json.loads(response.get('body').read())
             completion = response_body['generation']
-            self.cache[cache_key] = completion
+            if use_caching:
+                self.cache.set(cache_key, completion)
 
         return completion
 
-    def single_turn_request(self, messages):
-        return self.invoke(messages, use_caching=False).lstrip()
+    def single_turn_request(self, messages, system_prompt=None):
+        return self.invoke(messages, use_caching=self.cache_responses, system_prompt=system_prompt).lstrip()
+
+    def stream_request(self, messages, stop_on=None, system_prompt=None):
+        """
+        Stream a completion, returning (completion, stats); reading stops early once `stop_on` is emitted.
+
+        Deterministic completions are served from, and saved to, the response cache like `invoke`.
+        """
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        history = messages if isinstance(messages, list) else [{"role": "user", "content": messages}]
+        cache_key = make_cache_key(self.model_id, history, system_prompt, self.temperature, self.max_tokens,
+                                   top_p=self.top_p, **stream_cache_params(stop_on))
+        completion = self.cache.get(cache_key) if self.cache_responses else None
+        if completion is None:
+            completion, stats = self.__invoke_stream(messages, stop_on=stop_on, system_prompt=system_prompt)
+            if self.cache_responses:
+                self.cache.set(cache_key, completion)
+        else:
+            stats = cached_stream_stats()
+        return completion.lstrip(), stats
+
+    async def ainvoke(self, messages, use_caching=True, system_prompt=None):
+        return await get_async_invoker().run(self.invoke, messages, use_caching=use_caching, system_prompt=system_prompt)
+
+    async def asingle_turn_request(self, messages, system_prompt=None):
+        return await get_async_invoker().run(self.single_turn_request, messages, system_prompt=system_prompt)
 
 class MistralLLM:
     def __init__(self, model_id='mistral.mistral-7b-instruct-v0:2', region='us-east-1', max_tokens=512,
-                 temperature=0.7, top_p=1.0, system_prompt="") -> None:
+                 temperature=0.7, top_p=1.0, system_prompt="", profile_name=None, cache_responses=False) -> None:
         self.model_id = model_id
         self.region = region
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.top_p = top_p
         self.system_prompt = system_prompt
-        self.cache = diskcache.Cache(path.join(CACHES_DIR, model_id))
+        self.profile_name = profile_name
+        # Only deterministic completions are ever served from the cache
+        self.cache_responses = cache_responses and is_deterministic(temperature)
+        self.cache = get_response_cache(path.join(CACHES_DIR, model_id))
+        self.prompt_caching = False
         self.__init_session()
 
     def __init_session(self):
-        self.session = boto3.Session()
-        self.client = self.session.client(
-            BEDROCK_SERVICE,
-            region_name=self.region
-        )
+        self.client = get_bedrock_client(self.region, self.profile_name)
+
+    def __refresh_session(self):
+        self.client = refresh_bedrock_client(self.region, self.profile_name)
 
-    def __format_messages(self, messages):
-        """Format messages into Llama's expected prompt format"""
+    def __format_messages(self, messages, system_prompt=None):
+        """Format a single user turn, or a list of alternating turns starting with the user, into Mistral's [INST] format"""
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
         formatted_prompt = "<s>[INST]"
-        formatted_prompt += self.system_prompt if self.system_prompt else """
+        formatted_prompt += system_prompt if system_prompt else """
 You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe.  
 Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content.
 Please ensure that your responses are socially unbiased and positive in nature.\n\n"""
-        formatted_prompt += messages
-        formatted_prompt += "[/INST]"
+        if isinstance(messages, str):
+            formatted_prompt += messages
+            formatted_prompt += "[/INST]"
+            return formatted_prompt
+        # Mistral has no system role, so the system prompt opens the first user turn
+        formatted_prompt += "\n\n"
+        for i, msg in enumerate(messages):
+            if msg["role"] == "user":
+                formatted_prompt += ("[INST]" if i else "") + msg["content"] + "[/INST]"
+            else:
+                formatted_prompt += msg["content"] + "</s>"
         return formatted_prompt
 
-    def __invoke(self, messages):
-        backoff_time = 0.5
-        while True:
-            try:
-                formatted_prompt = self.__format_messages(messages)
-                body = {
-                    "prompt": formatted_prompt,
-                    "max_tokens": self.max_tokens,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p
-                }
-
-                return self.client.invoke_model(
-                    body=json.dumps(body),
-                    modelId=self.model_id
-                )
-            except ClientError as e:
-                code = e.response['Error']['Code']
-                if code == 'ThrottlingException':
-                    logging.warning(f"[ThrottlingException] Waiting for ({backoff_time:.1f})s.")
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                elif code == 'ExpiredTokenException':
-                    logging.warning(f"[ExpiredTokenException] Refreshing session security token.")
-                elif code == 'ModelErrorException':
-                    logging.warning(f'error calling {self.model_id}, trying again')
-                    return self.__invoke(messages)
-                elif code == 'ServiceUnavailableException':
-                    logging.warning(f'Service Unavailable error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(messages)
-                elif code == 'ModelTimeoutException':
-                    logging.warning(f'Model timeout error calling {self.model_id}, trying again')
-                    sleep(backoff_time)
-                    backoff_time *= 2
-                    return self.__invoke(messages)
-                else:
-                    raise Exception(f"Unhandled boto ClientError: {code}")
-
-    def invoke(self, messages, use_caching=True):
-        # Create a cache key from the messages
-        cache_key = json.dumps([{"role": "user", "content": messages}], sort_keys=True)
+    def __request_body(self, messages, system_prompt=None):
+        formatted_prompt = self.__format_messages(messages, system_prompt)
+        body = {
+            "prompt": formatted_prompt,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p
+        }
+        return json.dumps(body)
+
+    def __invoke(self, messages, system_prompt=None):
+        body = self.__request_body(messages, system_prompt)
+        return get_retry_engine().call(
+            lambda: self.client.invoke_model(body=body, modelId=self.model_id),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
+        )
+
+    def __invoke_stream(self, messages, stop_on=None, system_prompt=None):
+        body = self.__request_body(messages, system_prompt)
+        # The whole stream is read inside the retry so errors raised mid-stream are retried as well
+        return get_retry_engine().call(
+            lambda: consume_stream(
+                lambda: self.client.invoke_model_with_response_stream(body=body, modelId=self.model_id),
+                mistral_stream_text,
+                stop_on=stop_on
+            ),
+            model_id=self.model_id,
+            tokens=estimate_tokens(body, self.max_tokens),
+            refresh=self.__refresh_session
+        )
+
+    def invoke(self, messages, use_caching=True, system_prompt=None):
+        # Create a cache key from the request
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        history = messages if isinstance(messages, list) else [{"role": "user", "content": messages}]
+        cache_key = make_cache_key(self.model_id, history, system_prompt,
+                                   self.temperature, self.max_tokens, top_p=self.top_p)
         
-        if cache_key in self.cache and use_caching:
-            completion = self.cache[cache_key]
-        else:
-            response = self.__invoke(messages)
+        completion = self.cache.get(cache_key) if use_caching else None
+        if completion is None:
+            response = self.__invoke(messages, system_prompt)
             response_body = json.loads(response.get('body').read())
             completion = response_body['outputs'][0]['text']
-            self.cache[cache_key] = completion
+            if use_caching:
+                self.cache.set(cache_key, completion)
 
         return completion
 
-    def single_turn_request(self, messages):
-        return self.invoke(messages, use_caching=False).lstrip()
+    def single_turn_request(self, messages, system_prompt=None):
+        return self.invoke(messages, use_caching=self.cache_responses, system_prompt=system_prompt).lstrip()
+
+    def stream_request(self, messages, stop_on=None, system_prompt=None):
+        """
+        Stream a completion, returning (completion, stats); reading stops early once `stop_on` is emitted.
+
+        Deterministic completions are served from, and saved to, the response cache like `invoke`.
+        """
+        system_prompt = self.system_prompt if system_prompt is None else system_prompt
+        history = messages if isinstance(messages, list) else [{"role": "user", "content": messages}]
+        cache_key = make_cache_key(self.model_id, history, system_prompt, self.temperature, self.max_tokens,
+                                   top_p=self.top_p, **stream_cache_params(stop_on))
+        completion = self.cache.get(cache_key) if self.cache_responses else None
+        if completion is None:
+            completion, stats = self.__invoke_stream(messages, stop_on=stop_on, system_prompt=system_prompt)
+            if self.cache_responses:
+                self.cache.set(cache_key, completion)
+        else:
+            stats = cached_stream_stats()
+        return completion.lstrip(), stats
+
+    async def ainvoke(self, messages, use_caching=True, system_prompt=None):
+        return await get_async_invoker().run(self.invoke, messages, use_caching=use_caching, system_prompt=system_prompt)
+
+    async def asingle_turn_request(self, messages, system_prompt=None):
+        return await get_async_invoker().run(self.single_turn_request, messages, system_prompt=system_prompt)
 
 
 class ConversationSimulator:
-    def __init__(self, user_llm, assistant_llm, user_prompt, assistant_prompt):
+    def __init__(self, user_llm, assistant_llm, user_prompt, assistant_prompt, verbose=True, streaming=False,
+                 multi_turn=False):
         """
         Initialize with two separate LLM models.
         
         Args:
             user_llm: LLM model instance for simulating user responses
             assistant_llm: LLM model instance for simulating assistant responses
+            verbose: Whether to print every turn as it is generated
+            streaming: Whether to stream responses and record per-call latency metrics in `turn_metrics`
+            multi_turn: Whether to send the static context as system prompt and the dialogue as
+                alternating messages, instead of rendering everything into one prompt per turn
         """
         self.user_llm = user_llm
         self.assistant_llm = assistant_llm
         # Initialize prompt templates
         self.user_prompt = user_prompt
         self.assistant_prompt = assistant_prompt
+        self.verbose = verbose
+        self.streaming = streaming
+        self.multi_turn = multi_turn
+        self.turn_metrics = []
+        self.turn = 0
+
+    def _request(self, llm, prompt, role, stop_on=None, system_prompt=None):
+        """Send one request, streaming it and recording its latency metrics when streaming is on."""
+        with telemetry_tags(turn=self.turn, role=role):
+            if not self.streaming:
+                return llm.single_turn_request(prompt, system_prompt=system_prompt)
+            completion, stats = llm.stream_request(prompt, stop_on=stop_on, system_prompt=system_prompt)
+        self.turn_metrics.append({"call": len(self.turn_metrics), "role": role, **stats})
+        return completion
     
     def generate_initial_query(self, 
                              task_description: str,
                              demographic_profile: dict,
                              user_affinities: dict,
                              interaction_summaries: dict,
-                             situation_context: dict) -> str:
+                             situation_context: dict,
+                             user_prompt=None) -> str:
         """Generate the initial user query based on the task description and user context."""
-        # Create initial empty message history
-        initial_messages = []
-        
+        if user_prompt is None:
+            user_prompt = self.user_prompt.bind(
+                task_description, demographic_profile, user_affinities, interaction_summaries, situation_context)
+
+        if self.multi_turn:
+            system_prompt, messages = user_prompt.format_messages(message_history=[])
+            return self._request(self.user_llm, messages, "user", system_prompt=system_prompt)
+
         # Format the initial prompt using the user template
-        initial_prompt = self.user_prompt.format_prompt(
-            task_description=task_description,
-            demographic_profile=demographic_profile,
-            user_affinities=user_affinities,
-            interaction_summaries=interaction_summaries,
-            situation_context=situation_context,
-            message_history=initial_messages,
-            initial_query=True
-        )
+        initial_prompt = user_prompt.format_prompt(message_history=[], initial_query=True)
         
-        return self.user_llm.single_turn_request(initial_prompt)
+        return self._request(self.user_llm, initial_prompt, "user")
 
     def run_user_simulation(self,
                           message_history: List[Dict[str, str]],
@@ -367,37 +482,42 @@ class ConversationSimulator:
                           demographic_profile: dict,
                           user_affinities: dict,
                           interaction_summaries: dict,
-                          situation_context: dict) -> str:
+                          situation_context: dict,
+                          user_prompt=None) -> str:
         """Simulate the user's response using the user LLM."""
+        if user_prompt is None:
+            user_prompt = self.user_prompt.bind(
+                task_description, demographic_profile, user_affinities, interaction_summaries, situation_context)
+
+        if self.multi_turn:
+            system_prompt, messages = user_prompt.format_messages(message_history)
+            return self._request(self.user_llm, messages, "user", stop_on="TERMINATE", system_prompt=system_prompt)
+
         # Format prompt using the user template
-        prompt = self.user_prompt.format_prompt(
-            task_description=task_description,
-            demographic_profile=demographic_profile,
-            user_affinities=user_affinities,
-            interaction_summaries=interaction_summaries,
-            situation_context=situation_context,
-            message_history=message_history
-        )
+        prompt = user_prompt.format_prompt(message_history, split_prefix=self.user_llm.prompt_caching)
         
-        return self.user_llm.single_turn_request(prompt)
+        # Nothing after TERMINATE is used, so stop reading the stream once it is emitted
+        return self._request(self.user_llm, prompt, "user", stop_on="TERMINATE")
     
     def run_assistant_simulation(self,
                                 demographic_profile: dict,
                                 interaction_summaries: dict,
                                 situation_context: dict,
                                 flags: list,
-                                message_history: List[Dict[str, str]]) -> str:
+                                message_history: List[Dict[str, str]],
+                                assistant_prompt=None) -> str:
         """Simulate the assistant's response using the assistant LLM."""
+        if assistant_prompt is None:
+            assistant_prompt = self.assistant_prompt.bind(demographic_profile, interaction_summaries, situation_context, flags)
+
+        if self.multi_turn:
+            system_prompt, messages = assistant_prompt.format_messages(message_history)
+            return self._request(self.assistant_llm, messages, "assistant", system_prompt=system_prompt)
+
         # Format prompt using the assistant template
-        prompt = self.assistant_prompt.format_prompt(
-            demographic_profile,
-            interaction_summaries,
-            situation_context,
-            flags,
-            message_history=message_history
-        )
+        prompt = assistant_prompt.format_prompt(message_history, split_prefix=self.assistant_llm.prompt_caching)
         
-        return self.assistant_llm.single_turn_request(prompt)
+        return self._request(self.assistant_llm, prompt, "assistant")
 
     def simulate_conversation(self,
                             task_description: str,
@@ -408,29 +528,40 @@ class ConversationSimulator:
                             flags: list,
                             max_turns: int = 30) -> List[Dict[str, str]]:
         """Run the full conversation simulation."""
+        self.turn_metrics = []
+        self.turn = 0
+        # The context is fixed for the whole dialogue, so it is rendered once and only the history grows
+        user_prompt = self.user_prompt.bind(
+            task_description, demographic_profile, user_affinities, interaction_summaries, situation_context)
+        assistant_prompt = self.assistant_prompt.bind(demographic_profile, interaction_summaries, situation_context, flags)
         # Generate initial query from the user LLM
         initial_query = self.generate_initial_query(
             task_description,
             demographic_profile,
             user_affinities,
             interaction_summaries,
-            situation_context
+            situation_context,
+            user_prompt=user_prompt
         )
         
         message_history = [{"role": "user", "content": initial_query}]
-        print(f"User (Initial Query): {initial_query}\n")
+        if self.verbose:
+            print(f"User (Initial Query): {initial_query}\n")
         
-        for _ in range(max_turns):
+        for turn in range(max_turns):
+            self.turn = turn + 1
             # Get assistant's response
             assistant_response = self.run_assistant_simulation(
                 demographic_profile,
                 interaction_summaries,
                 situation_context,
                 flags,
-                message_history
+                message_history,
+                assistant_prompt=assistant_prompt
             )
             message_history.append({"role": "assistant", "content": assistant_response})
-            print(f"Assistant: {assistant_response}\n")
+            if self.verbose:
+                print(f"Assistant: {assistant_response}\n")
             
             # Get user's response
             user_response = self.run_user_simulation(
@@ -439,9 +570,11 @@ class ConversationSimulator:
                 demographic_profile,
                 user_affinities,
                 interaction_summaries,
-                situation_context
+                situation_context,
+                user_prompt=user_prompt
             )
-            print(f"User: {user_response}\n")
+            if self.verbose:
+                print(f"User: {user_response}\n")
             
            # Add user response to history, with or without TERMINATE
             message_history.append({"role": "user", "content": user_response})
@@ -458,10 +591,12 @@ class ConversationSimulator:
                     interaction_summaries,
                     situation_context,
                     flags,
-                    message_history
+                    message_history,
+                    assistant_prompt=assistant_prompt
                 )
                 message_history.append({"role": "assistant", "content": final_assistant_response})
-                print(f"Assistant (Final): {final_assistant_response}\n")
+                if self.verbose:
+                    print(f"Assistant (Final): {final_assistant_response}\n")
                 break
     
         return message_history
@@ -485,6 +620,25 @@ You are tasked with generating realistic user responses in a conversation with a
 Remember: You are not an assistant - you are the user seeking help. Maintain this perspective throughout the conversation.
 </instruction>"""
         
+        self.initial_query_instructions = """<initial_query_instructions>
+Based on the above information, provide your initial query as the user. Your query should:
+1. Account for your current situation
+2. Be natural and conversational
+3. Short and concise (1-2 sentences maximum)
+4. Avoid stating specific preferences or providing excessive background information.
+IMPORTANT - Do not output TERMINATE for this initial query. Output your query in English language.
+</initial_query_instructions>
+
+<examples>
+"What events are happening in Basel this weekend?"
+"Are there any lectures I could attend nearby?"
+"Can you suggest some activities happening in the city this week?"
+</examples>
+
+<initial_query>
+Your initial query:
+</initial_query>"""
+
         self.task_prompt_initial_query = """<user_profile>
 Demographic Information:
 {demographic_profile}
@@ -505,24 +659,8 @@ User Preferences and Affinities:
 {task_description}
 </task_description>
 
-<initial_query_instructions>
-Based on the above information, provide your initial query as the user. Your query should:
-1. Account for your current situation
-2. Be natural and conversational
-3. Short and concise (1-2 sentences maximum)
-4. Avoid stating specific preferences or providing excessive background information.
-IMPORTANT - Do not output TERMINATE for this initial query. Output your query in English language.
-</initial_query_instructions>
-
-<examples>
-"What events are happening in Basel this weekend?"
-"Are there any lectures I could attend nearby?"
-"Can you suggest some activities happening in the city this week?"
-</examples>
+""" + self.initial_query_instructions
 
-<initial_query>
-Your initial query:
-</initial_query>"""
         
 
         self.task_prompt = """<user_profile>
@@ -576,6 +714,37 @@ Your response:
 </query>
 """
 
+    def bind(self,
+             task_description: str,
+             demographic_profile: dict,
+             user_affinities: dict,
+             interaction_summaries: dict,
+             situation_context: dict):
+        """
+        Pre-render the static sections of the user prompts once for a (user, task) dialogue.
+
+        Parameters:
+        - task_description: Detailed description of what the user wants to accomplish
+        - demographic_profile: Dict containing user demographic information
+        - user_affinities: Dict containing user preferences in the relevant domains
+        - interaction_summaries: Dict with string summarizing previous relevant interactions
+        - situation_context: Dict containing current situational information
+
+        Each section may also be passed pre-rendered, e.g. from a `UserContext`.
+        """
+
+        demo_str = as_rendered(demographic_profile, format_demographics)
+        pref_str = as_rendered(user_affinities, format_affinities)
+        situation_str = as_rendered(situation_context, format_situation)
+        interaction_summary = as_rendered(interaction_summaries, format_interaction_summaries)
+
+        return BoundUserPrompt(self,
+                               task_description=task_description,
+                               demographic_profile=demo_str,
+                               user_affinity=pref_str,
+                               interaction_summary=interaction_summary,
+                               situation_context=situation_str)
+
     def format_prompt(self, 
                      task_description: str,
                      demographic_profile: dict,
@@ -583,132 +752,154 @@ Your response:
                      interaction_summaries: dict,
                      situation_context: dict,
                      message_history: list,
-                     initial_query: bool = False) -> str:
+                     initial_query: bool = False,
+                     split_prefix: bool = False):
+        """
+        Format the prompt with specific information; see `bind` and `BoundUserPrompt.format_prompt`.
+        """
+        return self.bind(task_description, demographic_profile, user_affinities, interaction_summaries,
+                         situation_context).format_prompt(message_history, initial_query, split_prefix)
+
+    def format_messages(self,
+                        task_description: str,
+                        demographic_profile: dict,
+                        user_affinities: dict,
+                        interaction_summaries: dict,
+                        situation_context: dict,
+                        message_history: list):
+        """Format the static user context as a system prompt and the dialogue as alternating messages; see `BoundUserPrompt`."""
+        return self.bind(task_description, demographic_profile, user_affinities, interaction_summaries,
+                         situation_context).format_messages(message_history)
+
+class BoundUserPrompt:
+    def __init__(self, template, **fields):
+        """User prompts of one (user, task) dialogue, with the static sections rendered once."""
+        self.system_prompt = template.system_prompt
+        self.initial_query_instructions = template.initial_query_instructions
+        self.initial_query_prompt = BoundPrompt(template.task_prompt_initial_query, self.format_message, **fields)
+        self.task_prompt = BoundPrompt(template.task_prompt, self.format_message, MULTI_TURN_HISTORY, **fields)
+
+    @staticmethod
+    def format_message(msg):
+        return f"[{msg['role'].upper()}]: {msg['content']}"
+
+    def format_prompt(self, message_history: list, initial_query: bool = False, split_prefix: bool = False):
         """
-        Format the prompt with specific information.
+        Format the prompt for the dialogue so far.
         
         Parameters:
-        - task_description: Detailed description of what the user wants to accomplish
-        - demographic_profile: Dict containing user demographic information
-        - user_affinities: Dict containing user preferences in the relevant domains
-        - interaction_summaries: Dict with string summarizing previous relevant interactions
-        - situation_context: Dict containing current situational information
-        - message_history: List of previous conversation messages
+        - message_history: List of previous conversation messages, or None to leave
+          them out for `format_messages`
+        - split_prefix: Whether to return PromptParts split before the dialogue history,
+          so the static context ahead of it can be read from the prompt cache
         """
-        
-        # Format demographic profile
-        demo_str = "\n".join([f"- {k}: {v}" for k, v in demographic_profile.items()])
-        
-        # Format user preferences
-        pref_str = ""
-        for domain, user_affinity in user_affinities.items():
-            pref_str += "\n"+domain+":\n"
-            pref_str += "\n".join([f"- {k}: {', '.join(map(str, v))}" if isinstance(v, list) else f"- {k}: {v}" for k, v in user_affinity.items()])
-            pref_str += "\n"
-
-        # Format situation context
-        situation_str = "\n".join([f"- {k}: {v}" for k, v in situation_context.items()])
-        
-        # Format message history
-        history_str = "\n".join([f"[{msg['role'].upper()}]: {msg['content']}" 
-                               for msg in message_history])
-        
-        # Format interaction summary
-        interaction_summary = ""
-        for domain, summary in interaction_summaries.items():
-            interaction_summary += "\n<"+domain+">\n"
-            interaction_summary += summary
-            interaction_summary += "\n</"+domain+">\n"
-
         if initial_query:
-            # Format the complete prompt
-            formatted_prompt = self.task_prompt_initial_query.format(
-                task_description=task_description,
-                demographic_profile=demo_str,
-                user_affinity=pref_str,
-                interaction_summary=interaction_summary,
-                situation_context=situation_str
-            )
-        else:
-            # Format the complete prompt
-            formatted_prompt = self.task_prompt.format(
-                task_description=task_description,
-                demographic_profile=demo_str,
-                user_affinity=pref_str,
-                interaction_summary=interaction_summary,
-                situation_context=situation_str,
-                message_history=history_str
-            )
-        
-        return formatted_prompt
+            return self.initial_query_prompt.format()
+        return self.task_prompt.format(message_history, split_prefix)
+
+    def format_messages(self, message_history: list):
+        """
+        Format the static user context as a system prompt and the dialogue as alternating messages.
+
+        The user agent is the one answering here, so the roles of `message_history`
+        are swapped; the initial query instructions open the exchange.
+
+        Returns:
+            Tuple of (system_prompt, messages)
+        """
+        context = self.format_prompt(message_history=None)
+        messages = [{"role": "user", "content": self.initial_query_instructions}]
+        messages += [{"role": "assistant" if msg["role"] == "user" else "user", "content": msg["content"] or EMPTY_TURN}
+                     for msg in message_history]
+        return self.system_prompt + "\n\n" + context, messages
 
 class AssistantPromptTemplate:
     def __init__(self, system_prompt, task_prompt):
         self.system_prompt = system_prompt
         self.task_prompt = task_prompt
-        
+
+    def bind(self,
+             demographic_profile: dict,
+             interaction_summaries: dict,
+             situation_context: dict,
+             flags: list):
+        """
+        Pre-render the user context enabled by `flags` once for a (user, task) dialogue.
+
+        Parameters:
+        - flags: (demographic, past interaction summary, situation) switches of the context
+          sections, matching the sections of `task_prompt`
+
+        Each section may also be passed pre-rendered, e.g. from a `UserContext`.
+        """
+        assert len(flags) == 3
+        demographic_flag, interaction_flag, situation_flag = flags
+
+        fields = {}
+        if demographic_flag:
+            fields["demographic_profile"] = as_rendered(demographic_profile, format_demographics)
+        if interaction_flag:
+            fields["interaction_summary"] = as_rendered(interaction_summaries, format_interaction_summaries)
+        if situation_flag:
+            fields["situation_context"] = as_rendered(situation_context, format_situation)
+
+        return BoundAssistantPrompt(self, **fields)
+
     def format_prompt(self,
                      demographic_profile: str,
                      interaction_summaries: dict,
                      situation_context: str,
                      flags: list,
-                     message_history: list) -> str:
+                     message_history: list,
+                     split_prefix: bool = False):
+        """
+        Format the prompt with specific information; see `bind` and `BoundAssistantPrompt.format_prompt`.
         """
-        Format the prompt with specific information.
+        return self.bind(demographic_profile, interaction_summaries, situation_context,
+                         flags).format_prompt(message_history, split_prefix)
+
+    def format_messages(self,
+                        demographic_profile: dict,
+                        interaction_summaries: dict,
+                        situation_context: dict,
+                        flags: list,
+                        message_history: list):
+        """Format the enabled user context as a system prompt and the dialogue as alternating messages; see `BoundAssistantPrompt`."""
+        return self.bind(demographic_profile, interaction_summaries, situation_context,
+                         flags).format_messages(message_history)
+
+class BoundAssistantPrompt:
+    def __init__(self, template, **fields):
+        """Assistant prompt of one (user, task) dialogue, with the enabled context sections rendered once."""
+        self.system_prompt = template.system_prompt
+        self.task_prompt = BoundPrompt(template.task_prompt, self.format_message, MULTI_TURN_HISTORY, **fields)
+
+    @staticmethod
+    def format_message(msg):
+        return f"{msg['role'].capitalize()}: {msg['content']}"
+
+    def format_prompt(self, message_history: list, split_prefix: bool = False):
+        """
+        Format the prompt for the dialogue so far.
         
         Parameters:
-        - message_history: List of previous conversation messages
+        - message_history: List of previous conversation messages, or None to leave
+          them out for `format_messages`
+        - split_prefix: Whether to return PromptParts split before the dialogue history,
+          so the static context ahead of it can be read from the prompt cache
         """
-        
-        # Format demographic profile
-        demo_str = "\n".join([f"- {k}: {v}" for k, v in demographic_profile.items()])
-        
-        # Format situation context
-        situation_str = "\n".join([f"- {k}: {v}" for k, v in situation_context.items()])
-
-        # Format interaction summary
-        interaction_summary = ""
-        for domain, summary in interaction_summaries.items():
-            interaction_summary += "\n<"+domain+">\n"
-            interaction_summary += summary
-            interaction_summary += "\n</"+domain+">\n"
-
-        # Format message history
-        history_str = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" 
-                               for msg in message_history])
-        
-        assert len(flags) == 3
-        
-        demographic_flag, interaction_flag, situation_flag = flags
-        # Format the complete prompt
-        if demographic_flag and interaction_flag and situation_flag:
-            formatted_prompt = self.task_prompt.format(
-                demographic_profile=demo_str,
-                interaction_summary=interaction_summary,
-                situation_context=situation_str,
-                message_history=history_str
-            )
-        elif demographic_flag and not interaction_flag and not situation_flag:
-            formatted_prompt = self.task_prompt.format(
-                demographic_profile=demo_str,
-                message_history=history_str
-            )
-        elif not demographic_flag and interaction_flag and not situation_flag:
-            formatted_prompt = self.task_prompt.format(
-                interaction_summary=interaction_summary,
-                message_history=history_str
-            )
-        elif not demographic_flag and not interaction_flag and situation_flag:
-            formatted_prompt = self.task_prompt.format(
-                situation_context=situation_str,
-                message_history=history_str
-            )
-        elif not demographic_flag and not interaction_flag and not situation_flag:
-            formatted_prompt = self.task_prompt.format(
-                message_history=history_str
-            )
-        
-        return formatted_prompt
+        return self.task_prompt.format(message_history, split_prefix)
+
+    def format_messages(self, message_history: list):
+        """
+        Format the enabled user context as a system prompt and the dialogue as alternating messages.
+
+        Returns:
+            Tuple of (system_prompt, messages)
+        """
+        context = self.format_prompt(message_history=None)
+        return self.system_prompt + "\n" + context, [{**msg, "content": msg["content"] or EMPTY_TURN}
+                                                     for msg in message_history]
 
 # Function to save the LLM answer to the specified path
 def save_user_answer(user_id, task_id, answer, model_id, flags):
@@ -729,13 +920,11 @@ def save_user_answer(user_id, task_id, answer, model_id, flags):
     with open(os.path.join(save_path, f"{task_id}_dialogue.json"), "w") as f:
         json.dump(answer, f, indent=4)
 
-def main(user_id, args):
+def build_models(args):
+    """Build the prompt templates and LLM wrappers shared by every conversation of a run."""
     # Initialize prompt templates
     user_prompt = UserPromptTemplate()
 
-    # Obtain ablation flags for using user context in assistant prompt
-    flags = [args.demographic, args.past_interaction_summary, args.situation]
-
 
     if "claude" in args.model_id_asst:
         if args.demographic and args.past_interaction_summary and args.situation:
@@ -777,7 +966,8 @@ def main(user_id, args):
         region=args.bedrock_region,
         temperature=0.5,
         max_tokens=800,
-        system_prompt=user_prompt.system_prompt
+        system_prompt=user_prompt.system_prompt,
+        prompt_caching=args.prompt_caching
     )
     
     if "claude" in args.model_id_asst:
@@ -786,7 +976,9 @@ def main(user_id, args):
         region=args.bedrock_region,
         temperature=0,
         max_tokens=800,
-        system_prompt=assistant_prompt.system_prompt
+        system_prompt=assistant_prompt.system_prompt,
+        cache_responses=args.cache,
+        prompt_caching=args.prompt_caching
     )
     elif "llama" in args.model_id_asst:
         assistant_llm = LlamaLLM(
@@ -794,7 +986,8 @@ def main(user_id, args):
         region=args.bedrock_region,
         temperature=0,
         max_tokens=800,
-        system_prompt=assistant_prompt.system_prompt
+        system_prompt=assistant_prompt.system_prompt,
+        cache_responses=args.cache
     )
     elif "mistral" in args.model_id_asst or "mixtral" in args.model_id_asst:
         assistant_llm = MistralLLM(
@@ -802,32 +995,44 @@ def main(user_id, args):
         region=args.bedrock_region,
         temperature=0,
         max_tokens=800,
-        system_prompt=assistant_prompt.system_prompt
+        system_prompt=assistant_prompt.system_prompt,
+        cache_responses=args.cache
     )
-    
-    with open(f"data/profile/user{user_id}/profile.json") as f:
-        user_profile = json.load(f)
-    with open(f"data/profile/user{user_id}/tasks_md.json") as f:
-        tasks = json.load(f)
-    user_profile['demographics'].pop('user_id')
 
-    for _ , task in tasks.items():
-        task_id = task['task_id']
-        relevant_domains = task['Relevant Domains']
-        
-        demographic_profile = user_profile['demographics']
-        user_affinities = {}
-        interaction_summaries = {}
-        for domain in relevant_domains:
-            user_affinities[domain] = user_profile['affinities'][domain]
-            interaction_summaries[domain] = user_profile['interactions'][domain]
-        situation_context = task['situations']
-        task_description = task['User Intent']
-
-        # Initialize conversation simulator with both models
-        simulator = ConversationSimulator(user_llm, assistant_llm, user_prompt, assistant_prompt)
-        
-        # Run the simulation
+    return user_prompt, assistant_prompt, user_llm, assistant_llm
+
+
+def load_user(user_id, task_ids=None):
+    """Load the pre-rendered context and multi-domain tasks of a user, only those in `task_ids` if given."""
+    user_context = load_user_context(user_id)
+    tasks = filter_tasks(get_profile_store().tasks(user_id, multi_domain=True), task_ids)
+    return user_context, tasks
+
+def run_task(user_id, user_context, task, models, args, verbose=True):
+    """Simulate and save the dialogue of a single (user, task) pair."""
+    user_prompt, assistant_prompt, user_llm, assistant_llm = models
+
+    # Obtain ablation flags for using user context in assistant prompt
+    flags = [args.demographic, args.past_interaction_summary, args.situation]
+
+    task_id = task['task_id']
+    relevant_domains = task['Relevant Domains']
+    
+    demographic_profile = user_context.demographics
+    user_affinities = user_context.affinities(relevant_domains)
+    interaction_summaries = user_context.interaction_summaries(relevant_domains)
+    situation_context = task['situations']
+    task_description = task['User Intent']
+
+    # Initialize conversation simulator with both models
+    simulator = ConversationSimulator(user_llm, assistant_llm, user_prompt, assistant_prompt,
+                                      verbose=verbose, streaming=args.stream, multi_turn=args.multi_turn)
+    
+    # Run the simulation
+    tags = {"user": user_id, "task": task_id, "domain": task_domain(relevant_domains),
+            "flags": [name for name, on in zip(["demographic", "past_interaction_summary", "situation", "multi_turn"],
+                                               flags + [args.multi_turn]) if on]}
+    with conversation_deadline(args.conversation_deadline), telemetry_tags(**tags):
         conversation_history = simulator.simulate_conversation(
             task_description=task_description,
             demographic_profile=demographic_profile,
@@ -837,16 +1042,59 @@ def main(user_id, args):
             flags=flags
         )
 
-        output = {
-            "user_id": user_id,
-            "task_id": task_id,
-            "task_description": task_description,
-            "user_model": args.model_id_asst,
-            "assistant_model": args.model_id_asst,
-            "dialogue": conversation_history}
-        
-        
-        save_user_answer(user_id, task_id, output, model_id=args.model_id_asst, flags=flags)
+    output = {
+        "user_id": user_id,
+        "task_id": task_id,
+        "task_description": task_description,
+        "user_model": args.model_id_asst,
+        "assistant_model": args.model_id_asst,
+        "dialogue": conversation_history}
+    if args.multi_turn:
+        output["multi_turn"] = True
+    if args.stream:
+        output["turn_metrics"] = simulator.turn_metrics
+    
+    
+    save_user_answer(user_id, task_id, output, model_id=args.model_id_asst, flags=flags)
+    return task_id
+
+def main(user_id, args, models=None, task_ids=None):
+    if models is None:
+        models = build_models(args)
+    user_context, tasks = load_user(user_id, task_ids)
+
+    for _ , task in tasks.items():
+        run_task(user_id, user_context, task, models, args)
+
+def main_parallel(user_ids, args, selection=None):
+    """Run independent (user, task) conversations concurrently on `args.workers` threads."""
+    models = build_models(args)
+
+    unloaded = []
+
+    def jobs():
+        for user_id in user_ids:
+            # A user that cannot be loaded only costs their own dialogues, as a failed task does
+            try:
+                user_context, tasks = load_user(user_id, selection and selection[user_id])
+            except Exception as e:
+                unloaded.append(user_id)
+                logging.error(f"User{user_id} could not be loaded, skipping their dialogues: {e!r}")
+                continue
+            for _, task in tasks.items():
+                yield user_id, user_context, task
+
+    failed = 0
+    for (user_id, _, task), _, exception in imap_unordered(
+            lambda job: run_task(*job, models, args, verbose=False), jobs(), args.workers):
+        if exception is not None:
+            failed += 1
+            logging.error(f"User{user_id} {task['task_id']} dialogue generation failed: {exception!r}")
+        else:
+            logging.info(f"User{user_id} {task['task_id']} dialogue saved.")
+    if failed or unloaded:
+        logging.warning(f"{failed} dialogues failed and {len(unloaded)} users could not be loaded, "
+                        f"rerun the affected users to regenerate them.")
 
 
 if __name__ == '__main__':
@@ -859,47 +1107,66 @@ if __name__ == '__main__':
     parser.add_argument("-s3", "--sample_30", action="store_true", help="Whether to use small sample of 30 users.")
     parser.add_argument("-s5", "--sample_50", action="store_true", help="Whether to use small sample of 50 users.")
     parser.add_argument("-s10", "--sample_100", action="store_true", help="Whether to use small sample of 100 users.")
+    parser.add_argument("--validate", action="store_true", help="Whether to check the profiles and tasks of the selected users against res/schema.json before the run.")
+    parser.add_argument("--cohort", type=str, default=None, help="Cohort file, or name of a file under res/cohorts, listing the users to process.")
     parser.add_argument("--sample_idxs", type=int, nargs='+', 
                    help="List of user indices to process.")
+    parser.add_argument("--domains", type=str, nargs='+', help="Only run the tasks involving any of these domains.")
+    parser.add_argument("--task_ids", type=str, nargs='+', help="Only run the tasks with these ids.")
     parser.add_argument("-r", "--bedrock_region", type=str, default='us-east-1', help="The Bedrock region.")
     parser.add_argument("-u", "--model_id_user", type=str, default='claude-3-sonnet-v1', help="The model id of the user used in the dialogue generation.")
     parser.add_argument("-m", "--model_id_asst", type=str, default='claude-3-sonnet-v1', help="The model id of the assistant used in the dialogue generation.")
     parser.add_argument("-d", "--demographic", action="store_true", help="Whether to include demographic profile to assistant.")
     parser.add_argument("-p", "--past_interaction_summary", action="store_true", help="Whether to include past interaction summary to assistant.")
     parser.add_argument("-si", "--situation", action="store_true", help="Whether to include situational context to assistant.")
+    parser.add_argument("--cache", action="store_true", help="Whether to serve deterministic (temperature 0) assistant calls from the response cache.")
+    parser.add_argument("--cache_size_limit", type=float, default=DEFAULT_SIZE_LIMIT_GB, help="Size cap in GB of each model's response cache directory.")
+    parser.add_argument("--cache_eviction_policy", type=str, default=DEFAULT_EVICTION_POLICY, choices=EVICTION_POLICIES, help="Eviction policy of the response cache.")
+    parser.add_argument("--multi_turn", action="store_true", help="Whether to send the dialogue as alternating messages after a static system prompt, instead of one flattened prompt per turn.")
+    parser.add_argument("--stream", action="store_true", help="Whether to stream responses and record time-to-first-token and tokens/sec per call. With --cache, calls served from the response cache are recorded without latency.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of (user, task) conversations to generate concurrently.")
+    parser.add_argument("--max_pool_connections", type=int, default=DEFAULT_MAX_POOL_CONNECTIONS, help="Size of the shared Bedrock connection pool.")
+    parser.add_argument("--endpoint_url", type=str, default=DEFAULT_ENDPOINT_URL, help="Bedrock runtime endpoint override, e.g. a local util.fake_bedrock server.")
+    parser.add_argument("--rate_limits", type=str, default=RATE_LIMITS_PATH, help="JSON file with per-model requests/tokens per minute quotas.")
+    parser.add_argument("--no_rate_limit", action="store_true", help="Whether to disable the shared adaptive rate limiter.")
+    parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Maximum attempts per Bedrock call on transient errors.")
+    parser.add_argument("--call_deadline", type=float, default=DEFAULT_CALL_DEADLINE, help="Maximum seconds per Bedrock call, retries included.")
+    parser.add_argument("--conversation_deadline", type=float, default=None, help="Maximum seconds of Bedrock calls per dialogue, retries included.")
+    parser.add_argument("--prompt_caching", action="store_true", help="Whether to mark the static context of Claude prompts as Bedrock prompt cache checkpoints.")
+    parser.add_argument("--metrics_file", type=str, default=None, help="Append-only JSONL file receiving one token/latency/cost record per Bedrock call.")
+    parser.add_argument("--record", type=str, default=None, help="Cassette directory to record every Bedrock request/response pair to.")
+    parser.add_argument("--replay", type=str, default=None, help="Cassette directory to serve every Bedrock call from, without network access.")
+    parser.add_argument("--replay_latency", action="store_true", help="Whether replayed calls wait for their recorded latency.")
 
     # Parse arguments
     args = parser.parse_args()
 
-    
-    sample_30_idxs = [7, 66, 132, 139, 207, 230, 251, 313, 340, 376, 386, 389, 415, 428, 597, 746, 774, 788, 822, 854, 900, 1111, 1142, 1150, 1197, 1231, 1322, 1458, 1492, 1495]
-    sample_50_idxs = [7, 53, 66, 107, 132, 139, 167, 195, 207, 230, 251, 313, 340, 376, 386, 389, 415, 418, 428, 439, 517, 532, 597, 630, 641, 660, 674, 701, 746, 774, 788, 802, 822, 854, 900, 1111, 1142, 1145, 1150, 1197, 1231, 1322, 1335, 1362, 1377, 1439, 1458, 1492, 1493, 1495]
-    sample_100_idxs = [7, 21, 53, 66, 86, 107, 132, 139, 157, 166, 167, 168, 195, 207, 230, 248, 251, 312, 313, 340, 352, 363, 365, 376, 386, 389, 394, 415, 418, 428, 431, 439, 470, 482, 517, 532, 597, 619, 630, 641, 657, 659, 660, 664, 674, 686, 689, 701, 744, 745, 746, 774, 788, 802, 813, 822, 838, 840, 842, 847, 854, 857, 870, 878, 880, 900, 913, 928, 942, 954, 997, 1069, 1111, 1114, 1118, 1120, 1142, 1145, 1150, 1151, 1167, 1184, 1197, 1231, 1246, 1322, 1330, 1335, 1345, 1362, 1377, 1384, 1434, 1439, 1458, 1461, 1492, 1493, 1495, 1496]
-    
-
-    assert len(sample_30_idxs) == 30
-    assert len(sample_50_idxs) == 50
-    assert len(sample_100_idxs) == 100
     assert args.model_id_asst in model_id_reverse_dict.keys(), f"{args.model_id_asst} is not supported for Assistant model id."
     assert args.model_id_user in model_id_reverse_dict.keys(), f"{args.model_id_user} is not supported for User model id."
 
 
-    if args.sample_30:
-        for idx in sample_30_idxs:
-            main(idx, args)
-    elif args.sample_50:
-        for idx in sample_50_idxs:
-            main(idx, args)
-    elif args.sample_100:
-        for idx in sample_100_idxs:
-            main(idx, args)
-    elif args.sample_idxs:
-        for idx in args.sample_idxs:
-            main(idx, args)
+    user_ids = select_users(args)
+    user_ids, selection = select_user_tasks(user_ids, multi_domain=True, domains=args.domains, task_ids=args.task_ids)
+    if args.validate:
+        validate_users(user_ids)
+
+    assert not (args.record and args.replay), "--record and --replay are mutually exclusive"
+    configure_cassette("record" if args.record else "replay" if args.replay else None,
+                       args.record or args.replay, reproduce_latency=args.replay_latency)
+    # Every worker keeps one request in flight, so size the shared connection pool accordingly
+    configure_bedrock_clients(max_pool_connections=max(args.max_pool_connections, args.workers),
+                              endpoint_url=args.endpoint_url)
+    configure_rate_limits(None if args.no_rate_limit else args.rate_limits)
+    configure_retry(max_attempts=args.max_attempts, call_deadline=args.call_deadline)
+    configure_response_cache(size_limit_gb=args.cache_size_limit, eviction_policy=args.cache_eviction_policy)
+    configure_telemetry(metrics_file=args.metrics_file)
+
+    if args.workers > 1:
+        main_parallel(user_ids, args, selection)
     else:
-        for i in range(args.start_index, args.end_index + 1):
-            main(i, args)
-    
-    
-       
+        models = build_models(args)
+        for idx in user_ids:
+            main(idx, args, models, selection and selection[idx])
 
+    log_cache_stats()
+    log_telemetry_summary()
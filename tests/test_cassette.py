@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import json
+import shutil
+import tempfile
+import unittest
+from botocore.exceptions import EventStreamError
+from util.cassette import Cassette, CassetteClient, request_key
+from util.streaming import consume_stream, claude_stream_text
+
+BODY = json.dumps({"messages": [{"role": "user", "content": "Hi"}]})
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def text_event(text):
+    data = {"type": "content_block_delta", "delta": {"type": "text_delta", "text": text}}
+    return {"chunk": {"bytes": json.dumps(data).encode('utf-8')}}
+
+
+class ScriptedStream:
+    """EventStream stand-in yielding the events of `words`, raising a mid-stream error after `fail_after` of them."""
+
+    def __init__(self, words, fail_after=None):
+        self.words = words
+        self.fail_after = fail_after
+        self.closed = False
+
+    def __iter__(self):
+        for i, word in enumerate(self.words):
+            if i == self.fail_after:
+                raise EventStreamError({"Error": {"Code": "modelStreamErrorException", "Message": "failed"}},
+                                       "InvokeModelWithResponseStream")
+            yield text_event(word)
+
+    def close(self):
+        self.closed = True
+
+
+class ScriptedClient:
+    def __init__(self, streams):
+        self.streams = list(streams)
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        return {"body": self.streams.pop(0)}
+
+
+class RecordingStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cassette = Cassette(self.directory)
+
+    def tearDown(self):
+        self.cassette.connection.close()
+        shutil.rmtree(self.directory)
+
+    def stream(self, client, stop_on=None):
+        return consume_stream(lambda: client.invoke_model_with_response_stream(body=BODY, modelId=MODEL_ID),
+                              claude_stream_text, stop_on=stop_on)[0]
+
+    def recordings(self):
+        return self.cassette.connection.execute(
+            "SELECT COUNT(*) FROM interactions WHERE key = ?", (request_key(MODEL_ID, BODY),)).fetchone()[0]
+
+    def test_failed_attempt_is_not_recorded(self):
+        client = CassetteClient(self.cassette, ScriptedClient([
+            ScriptedStream(["Hello", " there"], fail_after=1), ScriptedStream(["Hello", " world"])]))
+        with self.assertRaises(EventStreamError):
+            self.stream(client)
+        self.assertEqual(self.recordings(), 0)
+        self.assertEqual(self.stream(client), "Hello world")
+        self.assertEqual(self.recordings(), 1)
+
+        replay = CassetteClient(self.cassette)
+        self.assertEqual(self.stream(replay), "Hello world")
+
+    def test_early_stop_is_recorded(self):
+        source = ScriptedStream(["Thanks!", " TERMINATE", " extra"])
+        client = CassetteClient(self.cassette, ScriptedClient([source]))
+        self.assertEqual(self.stream(client, stop_on="TERMINATE"), "Thanks! TERMINATE")
+        self.assertTrue(source.closed)
+        self.assertEqual(self.recordings(), 1)
+        self.assertEqual(self.stream(CassetteClient(self.cassette)), "Thanks! TERMINATE")
+
+
+if __name__ == '__main__':
+    unittest.main()
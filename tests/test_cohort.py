@@ -0,0 +1,64 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import unittest
+from util.cohort import ProfileMatrix, stratified_sample
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STRATA = ("demographic", "interest")
+AGES = ("18-24", "25-34", "35-54", "55+")
+REGIONS = ("Europe", "Asia", "Americas")
+DOMAINS = ("Hotels", "Flights", "Movies", "Music", "Sports")
+
+
+def synthetic_matrix(users=600, seed=7):
+    """Profiles with skewed one-hot demographics and independent interest bits."""
+    rng = np.random.default_rng(seed)
+    columns = ([f"demographic:age={age}" for age in AGES] + [f"demographic:region={region}" for region in REGIONS]
+               + [f"interest:{domain}" for domain in DOMAINS])
+    matrix = np.zeros((users, len(columns)), dtype=np.uint8)
+    matrix[np.arange(users), rng.choice(len(AGES), users, p=[0.4, 0.3, 0.2, 0.1])] = 1
+    matrix[np.arange(users), len(AGES) + rng.choice(len(REGIONS), users, p=[0.6, 0.3, 0.1])] = 1
+    matrix[:, len(AGES) + len(REGIONS):] = rng.random((users, len(DOMAINS))) < [0.7, 0.5, 0.3, 0.2, 0.1]
+    return ProfileMatrix(np.arange(1000, 1000 + users, dtype=np.int64), columns, matrix)
+
+
+@unittest.skipIf(np is None, "The profile matrix needs NumPy")
+class StratifiedSampleTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.matrix = synthetic_matrix()
+
+    def sample(self, size, seed=0, **kwargs):
+        return stratified_sample(size, seed, strata=STRATA, profile_matrix=self.matrix, **kwargs)
+
+    def test_deterministic(self):
+        self.assertEqual(self.sample(50, seed=3), self.sample(50, seed=3))
+        self.assertNotEqual(self.sample(50, seed=3)[0], self.sample(50, seed=4)[0])
+
+    def test_covers_every_stratum(self):
+        user_ids, deviation, random_deviation = self.sample(40)
+        self.assertEqual(len(set(user_ids)), 40)
+        self.assertEqual(set(deviation), set(STRATA))
+        rows = [self.matrix.row_index[user_id] for user_id in user_ids]
+        for column, i in self.matrix.column_index.items():
+            with self.subTest(column=column):
+                self.assertGreater(self.matrix.matrix[rows, i].sum(), 0)
+        for stratum in STRATA:
+            self.assertLessEqual(deviation[stratum], random_deviation[stratum])
+            self.assertLess(deviation[stratum], 0.05)
+
+    def test_restricted_population(self):
+        population = list(range(1000, 1300))
+        user_ids, _, _ = self.sample(30, user_ids=population)
+        self.assertTrue(set(user_ids) <= set(population))
+        with self.assertRaises(ValueError):
+            self.sample(301, user_ids=population)
+
+
+if __name__ == '__main__':
+    unittest.main()
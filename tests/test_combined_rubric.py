@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import json
+import unittest
+from util.combined_rubric import COMBINED_FIELDS, parse_combined_evaluation, split_combined_evaluation
+
+
+def evaluation(**overrides):
+    fields = {name: ({"verdict": True, "explanation": "Done."} if label is None
+                     else {"score": max_score, "justification": "Good."})
+              for name, (_, _, label, max_score) in COMBINED_FIELDS.items()}
+    fields.update(overrides)
+    return fields
+
+
+def response(fields):
+    return f"Here is my evaluation.\n<response>\n{json.dumps(fields)}\n</response>"
+
+
+class ParseCombinedEvaluationTest(unittest.TestCase):
+    def test_valid_response(self):
+        self.assertEqual(parse_combined_evaluation(response(evaluation())), evaluation())
+        # The <response> tags are optional
+        self.assertEqual(parse_combined_evaluation(json.dumps(evaluation())), evaluation())
+
+    def test_malformed_json(self):
+        for content in ("", "no json here", "<response>{\"naturalness_user\": {\"score\": 5,</response>",
+                        response(evaluation())[:-40], "<response>[1, 2, 3]</response>", "<response>null</response>"):
+            with self.subTest(content=content):
+                with self.assertRaises(ValueError):
+                    parse_combined_evaluation(content)
+
+    def test_wrong_keys(self):
+        fields = evaluation()
+        del fields["personalization"]
+        for bad in (fields, evaluation(extra={"score": 1, "justification": ""})):
+            with self.assertRaises(ValueError):
+                parse_combined_evaluation(response(bad))
+
+    def test_wrong_field_values(self):
+        for overrides in ({"coherence_user": {"score": 6, "justification": "Too high."}},
+                          {"coherence_user": {"score": "5", "justification": "A string."}},
+                          {"coherence_user": {"score": True, "justification": "A bool."}},
+                          {"personalization": {"score": 3}},
+                          {"task_completion": {"verdict": "yes", "explanation": "Not a bool."}},
+                          {"task_completion": "VERDICT: True"}):
+            with self.subTest(overrides=overrides):
+                with self.assertRaises(ValueError):
+                    parse_combined_evaluation(response(evaluation(**overrides)))
+
+    def test_split_into_single_dimension_responses(self):
+        responses = split_combined_evaluation(response(evaluation()))
+        self.assertEqual(len(responses), len(COMBINED_FIELDS))
+        self.assertEqual(responses[("naturalness", "_user")], "Naturalness Score: 5\nJustification: Good.")
+        self.assertEqual(responses[("task_completion", "")], "VERDICT: True\nEXPLANATION: Done.")
+
+
+if __name__ == '__main__':
+    unittest.main()
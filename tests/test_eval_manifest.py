@@ -0,0 +1,57 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+from util.eval_manifest import MANIFEST_NAME, EvaluationManifest
+
+
+class EvaluationManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = path.join(self.directory, "SD-Hotels-task-1_naturalness_user.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, manifest, digest):
+        with open(self.file_path, "w") as f:
+            f.write("Naturalness Score: 5")
+        manifest.record(self.file_path, digest)
+
+    def test_unchanged_request_is_skipped(self):
+        manifest = EvaluationManifest()
+        self.assertFalse(manifest.is_current(self.file_path, "a" * 64))
+        self.save(manifest, "a" * 64)
+        self.assertTrue(manifest.is_current(self.file_path, "a" * 64))
+        # As seen by the next run
+        self.assertTrue(EvaluationManifest().is_current(self.file_path, "a" * 64))
+
+    def test_changed_request_is_rejudged(self):
+        self.save(EvaluationManifest(), "a" * 64)
+        manifest = EvaluationManifest()
+        self.assertFalse(manifest.is_current(self.file_path, "b" * 64))
+        self.save(manifest, "b" * 64)
+        self.assertTrue(EvaluationManifest().is_current(self.file_path, "b" * 64))
+        self.assertFalse(EvaluationManifest().is_current(self.file_path, "a" * 64))
+
+    def test_deleted_evaluation_is_rejudged(self):
+        self.save(EvaluationManifest(), "a" * 64)
+        os.remove(self.file_path)
+        self.assertFalse(EvaluationManifest().is_current(self.file_path, "a" * 64))
+
+    def test_corrupt_manifest_rejudges_directory(self):
+        self.save(EvaluationManifest(), "a" * 64)
+        with open(path.join(self.directory, MANIFEST_NAME), "w") as f:
+            f.write('{"SD-Hotels-task-1_natur')
+        manifest = EvaluationManifest()
+        self.assertFalse(manifest.is_current(self.file_path, "a" * 64))
+        self.save(manifest, "a" * 64)
+        self.assertTrue(EvaluationManifest().is_current(self.file_path, "a" * 64))
+
+
+if __name__ == '__main__':
+    unittest.main()
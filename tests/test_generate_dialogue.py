@@ -0,0 +1,117 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from util.llm_cache import ResponseCache
+from util.prompt_caching import claude_request
+from src.generate_dialogue import (main_parallel, ClaudeLLM, ConversationSimulator, UserPromptTemplate, AssistantPromptTemplate,
+                                   CLAUDE_SYSTEM_PROMPT, CLAUDE_TASK_PROMPT_DPS, EMPTY_TURN)
+
+
+class ScriptedLLM:
+    """Stands in for an LLM wrapper: answers from a script and builds the Claude request of every call."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.prompt_caching = True
+        self.requests = []
+
+    def single_turn_request(self, messages, system_prompt=None):
+        self.requests.append(claude_request(system_prompt, messages, self.prompt_caching))
+        return self.responses.pop(0)
+
+
+class BareTerminateTest(unittest.TestCase):
+    def simulate(self, user_responses, assistant_responses):
+        user_llm, assistant_llm = ScriptedLLM(user_responses), ScriptedLLM(assistant_responses)
+        simulator = ConversationSimulator(
+            user_llm, assistant_llm, UserPromptTemplate(),
+            AssistantPromptTemplate(system_prompt=CLAUDE_SYSTEM_PROMPT, task_prompt=CLAUDE_TASK_PROMPT_DPS),
+            verbose=False, multi_turn=True)
+        history = simulator.simulate_conversation(
+            "Find a restaurant for tonight.", "Age: 30", "Cuisine: Thai", "Booked Thai food last week.",
+            "Location: Basel", flags=[True, True, True], max_turns=3)
+        return history, assistant_llm.requests
+
+    def test_bare_terminate_sends_placeholder(self):
+        history, requests = self.simulate(["Any Thai places nearby?", "TERMINATE"],
+                                          ["Try Baan Thai.", "Enjoy your meal!"])
+        self.assertEqual(history[-2], {"role": "user", "content": ""})
+        self.assertEqual(history[-1], {"role": "assistant", "content": "Enjoy your meal!"})
+        _, final_messages = requests[-1]
+        for message in final_messages:
+            self.assertTrue(message["content"], message)
+        self.assertEqual(final_messages[-1]["content"][-1]["text"], EMPTY_TURN)
+        self.assertIn("cache_control", final_messages[-1]["content"][-1])
+
+    def test_empty_last_message_gets_no_checkpoint(self):
+        _, messages = claude_request("", [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"},
+                                          {"role": "user", "content": ""}], True)
+        self.assertEqual(messages[-1]["content"], [])
+
+
+class CachedStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def llm(self, temperature=0):
+        llm = ClaudeLLM(model_id="anthropic.claude-3-haiku-20240307-v1:0", temperature=temperature, cache_responses=True)
+        llm.cache = ResponseCache(self.directory)
+        return llm
+
+    def stream(self, llm, stop_on=None):
+        stats = {"time_to_first_token": 0.1, "stopped_early": bool(stop_on), "response_cache_hit": False}
+        with mock.patch.object(llm, "_ClaudeLLM__invoke_stream", return_value=("Thanks! TERMINATE", stats)) as invoke:
+            completion, stats = llm.stream_request("Any Thai places?", stop_on=stop_on)
+        return completion, stats, invoke.called
+
+    def test_rerun_is_served_from_cache(self):
+        llm = self.llm()
+        self.assertEqual(self.stream(llm)[1:], ({"time_to_first_token": 0.1, "stopped_early": False,
+                                                  "response_cache_hit": False}, True))
+        completion, stats, called = self.stream(llm)
+        self.assertEqual(completion, "Thanks! TERMINATE")
+        self.assertFalse(called)
+        self.assertTrue(stats["response_cache_hit"])
+        self.assertIsNone(stats["latency"])
+        # Served to non-streamed calls as well, as nothing was cut off
+        self.assertEqual(llm.single_turn_request("Any Thai places?"), "Thanks! TERMINATE")
+
+    def test_stopped_stream_is_cached_apart(self):
+        llm = self.llm()
+        self.assertTrue(self.stream(llm, stop_on="TERMINATE")[2])
+        self.assertTrue(self.stream(llm)[2])
+        self.assertFalse(self.stream(llm, stop_on="TERMINATE")[2])
+
+    def test_sampled_stream_is_not_cached(self):
+        llm = self.llm(temperature=0.5)
+        self.assertTrue(self.stream(llm)[2])
+        self.assertTrue(self.stream(llm)[2])
+
+
+class MainParallelTest(unittest.TestCase):
+    def test_unloadable_user_skips_only_their_tasks(self):
+        def load_user(user_id, task_ids=None):
+            if user_id == 1:
+                raise FileNotFoundError(f"data/profile/user{user_id}/profile.json")
+            return f"context{user_id}", {"Task 1": {"task_id": f"SD-Hotels-task-{user_id}"}}
+
+        ran = []
+        with mock.patch("src.generate_dialogue.build_models"), \
+                mock.patch("src.generate_dialogue.load_user", side_effect=load_user), \
+                mock.patch("src.generate_dialogue.run_task", side_effect=lambda user_id, *_, **__: ran.append(user_id)), \
+                self.assertLogs(level="ERROR") as logs:
+            main_parallel([0, 1, 2], SimpleNamespace(workers=2))
+        self.assertEqual(sorted(ran), [0, 2])
+        self.assertIn("User1 could not be loaded", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
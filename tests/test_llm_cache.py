@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import shutil
+import tempfile
+import unittest
+from util.llm_cache import ResponseCache, make_cache_key
+from util.prompt_caching import PromptParts
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+class CacheKeyTest(unittest.TestCase):
+    def key(self, **overrides):
+        request = {"model_id": MODEL_ID, "messages": [{"role": "user", "content": "Hi"}], "system_prompt": "Be brief.",
+                   "temperature": 0, "max_tokens": 512, "top_p": 1.0, "stop_sequences": ["END"]}
+        request.update(overrides)
+        return make_cache_key(**request)
+
+    def test_stable_across_dict_order(self):
+        forward = make_cache_key(MODEL_ID, [{"role": "user", "content": "Hi"}], "", 0, 512, top_p=1.0, top_k=5)
+        backward = make_cache_key(MODEL_ID, [{"content": "Hi", "role": "user"}], "", 0, 512, top_k=5, top_p=1.0)
+        self.assertEqual(forward, backward)
+        self.assertEqual(len(forward), 64)
+
+    def test_changes_with_model_and_params(self):
+        base = self.key()
+        self.assertEqual(base, self.key())
+        for overrides in ({"model_id": "anthropic.claude-3-5-haiku-20241022-v1:0"}, {"temperature": 0.5},
+                          {"max_tokens": 256}, {"top_p": 0.9}, {"stop_sequences": []}, {"system_prompt": ""},
+                          {"messages": [{"role": "user", "content": "Hi!"}]}):
+            self.assertNotEqual(base, self.key(**overrides), overrides)
+
+    def test_split_prompt_shares_key(self):
+        self.assertEqual(make_cache_key(MODEL_ID, PromptParts(["<context>", "Hi"])), make_cache_key(MODEL_ID, "<context>Hi"))
+
+
+class ResponseCacheStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_counts_evictions_of_the_run(self):
+        ResponseCache(self.directory).set("earlier", "x" * 100)
+        # Far below the size of the SQLite file alone, so every write culls
+        cache = ResponseCache(self.directory, size_limit_gb=1e-6, eviction_policy="least-recently-stored")
+        for i in range(30):
+            cache.set(f"key{i}", "x" * 1000)
+        stats = cache.stats()
+        self.assertEqual(stats["writes"], 30)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertEqual(stats["evictions"], 1 + 30 - stats["entries"])
+        self.assertIsNone(cache.get("earlier"))
+
+    def test_rewriting_a_key_is_not_an_eviction(self):
+        cache = ResponseCache(self.directory)
+        cache.set("key", "first")
+        cache.set("key", "second")
+        stats = cache.stats()
+        self.assertEqual((stats["writes"], stats["evictions"], stats["entries"]), (1, 0, 1))
+        self.assertEqual(cache.get("key"), "first")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+from util.profile_store import PROFILE_DIR, TASK_FILES, ProfileStore, JsonProfileStore, build_profile_store
+from util.task_catalog import TASK_DIR
+
+USER_IDS = (0, 1, 2)
+
+
+class StalePackTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profile_dir = path.join(self.directory, "profile")
+        self.task_dir = path.join(self.directory, "task")
+        for user_id in USER_IDS:
+            shutil.copytree(path.join(PROFILE_DIR, f"user{user_id}"), path.join(self.profile_dir, f"user{user_id}"))
+        shutil.copytree(TASK_DIR, self.task_dir)
+        self.store_path = path.join(self.directory, "profile.pack")
+        build_profile_store(self.profile_dir, self.store_path, self.task_dir)
+        self.store = ProfileStore(self.store_path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def touch(self, file):
+        stat = os.stat(file)
+        os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_fresh_pack_is_current(self):
+        self.assertFalse(self.store.is_stale())
+        source = JsonProfileStore(self.profile_dir, self.task_dir)
+        for user_id in USER_IDS:
+            self.assertEqual(self.store.profile(user_id), source.profile(user_id))
+            self.assertEqual(self.store.profile_digest(user_id), source.profile_digest(user_id))
+
+    def test_edited_task_file_makes_pack_stale(self):
+        self.touch(path.join(self.profile_dir, "user1", TASK_FILES[True]))
+        self.assertTrue(self.store.is_stale())
+
+    def test_edited_task_definition_makes_pack_stale(self):
+        self.touch(path.join(self.task_dir, sorted(os.listdir(self.task_dir))[0], "task.jsonl"))
+        self.assertTrue(self.store.is_stale())
+
+    def test_missing_source_is_not_stale(self):
+        shutil.rmtree(self.profile_dir)
+        self.assertFalse(self.store.is_stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
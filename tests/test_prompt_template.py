@@ -0,0 +1,76 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import unittest
+from util.prompt_template import BoundPrompt
+from util.prompt_caching import PromptParts
+
+TEMPLATE = """<profile>
+{profile}
+</profile>
+
+<history>
+{message_history}
+</history>
+Reply as the {role}."""
+FIELDS = {"profile": "Age: 30\nCity: Basel", "role": "user"}
+
+
+def format_message(msg):
+    return f"[{msg['role'].upper()}]: {msg['content']}"
+
+
+def full_format(message_history):
+    return TEMPLATE.format(message_history="\n".join(map(format_message, message_history)), **FIELDS)
+
+
+def dialogue(*contents):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": content} for i, content in enumerate(contents)]
+
+
+class IncrementalHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.prompt = BoundPrompt(TEMPLATE, format_message, **FIELDS)
+
+    def assertRenders(self, message_history):
+        self.assertEqual(self.prompt.format(message_history), full_format(message_history))
+
+    def test_growing_history(self):
+        history = dialogue("Any Thai places?", "Try Baan Thai.", "Is it open late?", "Until 11pm.")
+        for count in range(len(history) + 1):
+            self.assertRenders(history[:count])
+
+    def test_latest_message_edited(self):
+        history = dialogue("Any Thai places?", "Try Baan Thai.", "Thanks! TERMINATE")
+        self.assertRenders(history)
+        history[-1]["content"] = "Thanks!"
+        self.assertRenders(history)
+
+    def test_earlier_message_edited(self):
+        history = dialogue("Any Thai places?", "Try Baan Thai.", "Is it open late?")
+        self.assertRenders(history)
+        history[1]["content"] = "Try Baan Thai on Steinenvorstadt."
+        self.assertRenders(history)
+        history.append({"role": "assistant", "content": "Until 11pm."})
+        self.assertRenders(history)
+
+    def test_shorter_or_other_history(self):
+        self.assertRenders(dialogue("Any Thai places?", "Try Baan Thai.", "Is it open late?"))
+        self.assertRenders(dialogue("Any Thai places?"))
+        self.assertRenders(dialogue("Book a flight to Rome.", "For which dates?"))
+        self.assertRenders([])
+
+    def test_split_prefix(self):
+        history = dialogue("Any Thai places?")
+        parts = self.prompt.format(history, split_prefix=True)
+        self.assertIsInstance(parts, PromptParts)
+        self.assertEqual(parts.text(), full_format(history))
+        self.assertNotIn("Thai", parts[0])
+
+    def test_detached_history(self):
+        prompt = BoundPrompt(TEMPLATE, format_message, "See the messages.", **FIELDS)
+        self.assertEqual(prompt.format(None), TEMPLATE.format(message_history="See the messages.", **FIELDS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from util.rate_limiter import AdaptiveRateLimiter
+
+
+class LimiterStateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.limiter = AdaptiveRateLimiter("test-model", requests_per_minute=600, tokens_per_minute=60000,
+                                           state_dir=self.directory, idle_reset=60.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_state(self, state):
+        with open(self.limiter.state_path, "w") as f:
+            f.write(state if isinstance(state, str) else json.dumps(state))
+
+    def read_state(self):
+        with open(self.limiter.state_path) as f:
+            return json.load(f)
+
+    def throttled_state(self, updated):
+        return {"rate": 0.05, "updated": updated, "last_throttle": updated, "requests": 0.0, "tokens": 0.0}
+
+    def test_corrupt_state_is_rebuilt(self):
+        self.write_state('{"rate": 0.5, "upd')
+        self.assertEqual(self.limiter.acquire(10), 0.0)
+        self.assertEqual(self.read_state()["rate"], 1.0)
+
+    def test_idle_state_starts_at_full_rate(self):
+        self.write_state(self.throttled_state(time.time() - 3600))
+        self.assertEqual(self.limiter.acquire(10), 0.0)
+        self.assertEqual(self.read_state()["rate"], 1.0)
+
+    def test_recent_throttling_is_kept(self):
+        self.write_state(self.throttled_state(time.time()))
+        self.limiter.on_success()
+        self.assertAlmostEqual(self.read_state()["rate"], 0.06)
+
+
+if __name__ == '__main__':
+    unittest.main()
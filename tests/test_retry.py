@@ -0,0 +1,121 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import json
+import time
+import boto3
+import unittest
+import threading
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from util.fake_bedrock import make_server
+from util.rate_limiter import configure_rate_limits
+from util.retry import CircuitBreaker, RetryEngine, RetryError, conversation_deadline
+from util.streaming import consume_stream, claude_stream_text
+
+
+# Bare invoke_model response, without usage headers
+RESPONSE = {"ResponseMetadata": {}}
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "InvokeModel")
+
+
+class CircuitBreakerTrialTest(unittest.TestCase):
+    def setUp(self):
+        configure_rate_limits(None)
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        self.engine = RetryEngine(max_attempts=1, base_delay=0.01, circuit_breaker=self.breaker)
+
+    def open_circuit(self):
+        def unavailable():
+            raise client_error("ServiceUnavailableException")
+        with self.assertRaises(RetryError):
+            self.engine.call(unavailable, model_id="test-model")
+        self.assertGreater(self.breaker.open_until, time.monotonic())
+        time.sleep(0.06)
+
+    def call_within(self, fn, seconds=5.0):
+        """Run `fn` on a thread, failing the test if it hangs."""
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = fn()
+            except Exception as e:
+                outcome["error"] = e
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(seconds)
+        self.assertFalse(thread.is_alive(), "call is stuck waiting on the circuit breaker")
+        return outcome
+
+    def test_unexpected_error_releases_trial(self):
+        self.open_circuit()
+
+        def broken():
+            raise ValueError("not JSON")
+        outcome = self.call_within(lambda: self.engine.call(broken, model_id="test-model"))
+        self.assertIsInstance(outcome.get("error"), ValueError)
+        self.assertFalse(self.breaker.trial_in_flight)
+
+        outcome = self.call_within(lambda: self.engine.call(lambda: RESPONSE, model_id="test-model"))
+        self.assertEqual(outcome.get("result"), RESPONSE)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_deadline_does_not_take_trial(self):
+        self.open_circuit()
+
+        def expired():
+            with conversation_deadline(-1):
+                return self.engine.call(lambda: RESPONSE, model_id="test-model")
+        outcome = self.call_within(expired)
+        self.assertIsInstance(outcome.get("error"), RetryError)
+        self.assertFalse(self.breaker.trial_in_flight)
+
+        outcome = self.call_within(lambda: self.engine.call(lambda: RESPONSE, model_id="test-model"))
+        self.assertEqual(outcome.get("result"), RESPONSE)
+
+    def test_stale_release_keeps_new_trial(self):
+        self.open_circuit()
+        first = self.breaker.wait()
+        self.breaker.record_failure()
+        time.sleep(0.11)
+        second = self.breaker.wait()
+        self.breaker.release_trial(first)
+        self.assertTrue(self.breaker.trial_in_flight)
+        self.breaker.release_trial(second)
+        self.assertFalse(self.breaker.trial_in_flight)
+
+
+class MidStreamErrorTest(unittest.TestCase):
+    MODEL_ID = "us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+
+    def setUp(self):
+        configure_rate_limits(None)
+        profile = {"first_token_median": 0.001, "seconds_per_output_token": 0.0, "mean_output_tokens": 20,
+                   "stream_error_rate": 1.0}
+        self.server = make_server(port=0, profiles={"default": profile})
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = boto3.client("bedrock-runtime", region_name="us-east-1",
+                                   endpoint_url=f"http://127.0.0.1:{self.server.server_address[1]}",
+                                   aws_access_key_id="test", aws_secret_access_key="test",
+                                   config=Config(retries={"total_max_attempts": 1, "mode": "standard"}))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_stream_error_is_retried(self):
+        body = json.dumps({"anthropic_version": "bedrock-2023-05-31", "max_tokens": 50, "temperature": 0,
+                           "messages": [{"role": "user", "content": [{"type": "text", "text": "Hello"}]}]})
+        engine = RetryEngine(max_attempts=3, base_delay=0.001, circuit_breaker=CircuitBreaker())
+        with self.assertRaisesRegex(RetryError, "after 3 attempts, last error: ModelStreamErrorException"):
+            engine.call(lambda: consume_stream(
+                lambda: self.client.invoke_model_with_response_stream(body=body, modelId=self.MODEL_ID),
+                claude_stream_text), model_id=self.MODEL_ID)
+
+
+if __name__ == '__main__':
+    unittest.main()
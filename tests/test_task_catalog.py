@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import json
+import unittest
+from os import path
+from util.profile_store import PROFILE_DIR, TASK_FILES
+from util.task_catalog import TASK_DIR, UserTasks, expand_task, load_task_catalog, normalize_tasks
+
+USER_IDS = (0, 1, 2, 500, 1499)
+
+
+def load_tasks(user_id, multi_domain):
+    with open(path.join(PROFILE_DIR, f"user{user_id}", TASK_FILES[multi_domain])) as f:
+        return json.load(f)
+
+
+class NormalizedTasksTest(unittest.TestCase):
+    def setUp(self):
+        self.catalog = load_task_catalog(TASK_DIR)
+
+    def assertRoundTrip(self, tasks):
+        expanded = dict(UserTasks(normalize_tasks(tasks, self.catalog), self.catalog))
+        # Same keys and fields in the same order, so the file would be written back identically
+        self.assertEqual(json.dumps(expanded), json.dumps(tasks))
+
+    def test_task_files_round_trip(self):
+        for user_id in USER_IDS:
+            for multi_domain in (False, True):
+                with self.subTest(user_id=user_id, multi_domain=multi_domain):
+                    self.assertRoundTrip(load_tasks(user_id, multi_domain))
+
+    def test_rows_hold_only_user_fields(self):
+        tasks = load_tasks(0, False)
+        for row, task in zip(normalize_tasks(tasks, self.catalog), tasks.values()):
+            self.assertEqual(row[:2], [task["task_id"], task["situations"]])
+
+    def test_edited_and_unknown_tasks_round_trip(self):
+        tasks = load_tasks(0, False)
+        tasks["Task 1"]["Task Goal"] = "A goal only this user has."
+        tasks["Task 2"] = {**tasks["Task 2"], "task_id": "SD-Custom-task-1", "Extra": [1, 2]}
+        self.assertRoundTrip(tasks)
+        self.assertIn("SD-Custom-task-1", self.catalog)
+
+    def test_expanded_lists_are_copies(self):
+        row = normalize_tasks(load_tasks(0, False), self.catalog)[0]
+        domains = expand_task(row, self.catalog)["Relevant Domains"]
+        domains.append("Unknown Domain")
+        self.assertEqual(expand_task(row, self.catalog)["Relevant Domains"], domains[:-1])
+
+    def test_misnumbered_tasks_are_rejected(self):
+        tasks = load_tasks(0, False)
+        with self.assertRaises(ValueError):
+            normalize_tasks({"Task 2": tasks["Task 1"]}, self.catalog)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("BEDROCK_MAX_CONCURRENCY", 32))
+
+
+class AsyncInvoker:
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """
+        Run blocking Bedrock calls from asyncio code.
+
+        Each call is handed to a dedicated thread pool, so the number of
+        requests in flight is bounded by `max_concurrency`.
+
+        Args:
+            max_concurrency: Maximum number of concurrent Bedrock requests
+        """
+        assert max_concurrency > 0, "max_concurrency must be positive"
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="bedrock")
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # Carry context variables such as the conversation deadline over to the worker thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, partial(context.run, fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_invoker = None
+_invoker_lock = threading.Lock()
+
+
+def configure_async_invoker(max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Replace the process-wide invoker with one bounded by `max_concurrency`."""
+    global _invoker
+    with _invoker_lock:
+        if _invoker is not None:
+            _invoker.shutdown(wait=False)
+        _invoker = AsyncInvoker(max_concurrency)
+    return _invoker
+
+
+def get_async_invoker():
+    """Return the process-wide invoker shared by all LLM wrappers."""
+    global _invoker
+    with _invoker_lock:
+        if _invoker is None:
+            _invoker = AsyncInvoker()
+    return _invoker
@@ -0,0 +1,85 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+from util.cassette import cassette_mode, wrap_client
+
+BEDROCK_SERVICE = "bedrock-runtime"
+
+DEFAULT_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", 64))
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get("BEDROCK_CONNECT_TIMEOUT", 10))
+DEFAULT_READ_TIMEOUT = float(os.environ.get("BEDROCK_READ_TIMEOUT", 300))
+# Overrides the regional endpoint, e.g. to target util.fake_bedrock in load tests
+DEFAULT_ENDPOINT_URL = os.environ.get("BEDROCK_ENDPOINT_URL")
+
+_client_options = {
+    "max_pool_connections": DEFAULT_MAX_POOL_CONNECTIONS,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "read_timeout": DEFAULT_READ_TIMEOUT,
+    "tcp_keepalive": True,
+    "endpoint_url": DEFAULT_ENDPOINT_URL,
+}
+_clients = {}
+_lock = threading.Lock()
+
+
+def configure_bedrock_clients(**options):
+    """
+    Update the botocore options used for every Bedrock runtime client.
+
+    Supported options are `max_pool_connections`, `connect_timeout`,
+    `read_timeout`, `tcp_keepalive` and `endpoint_url`. Clients created with
+    the previous options are dropped from the registry and rebuilt on next use.
+    """
+    unknown = set(options) - set(_client_options)
+    assert not unknown, f"Unsupported Bedrock client options: {sorted(unknown)}"
+    with _lock:
+        _client_options.update(options)
+        _clients.clear()
+
+
+def _create_client(region, profile_name):
+    # Replayed runs are served from the cassette and never reach Bedrock
+    if cassette_mode() == "replay":
+        return wrap_client(None)
+    session = boto3.Session(profile_name=profile_name)
+    config = Config(
+        region_name=region,
+        max_pool_connections=_client_options["max_pool_connections"],
+        connect_timeout=_client_options["connect_timeout"],
+        read_timeout=_client_options["read_timeout"],
+        tcp_keepalive=_client_options["tcp_keepalive"],
+        # Retries are handled by util.retry, so botocore sends each request once
+        retries={"total_max_attempts": 1, "mode": "standard"},
+    )
+    return wrap_client(session.client(BEDROCK_SERVICE, config=config, endpoint_url=_client_options["endpoint_url"]))
+
+
+def get_bedrock_client(region, profile_name=None):
+    """
+    Return the process-wide Bedrock runtime client for (region, profile_name).
+
+    Clients are thread-safe and keep a pool of persistent connections, so
+    all LLM wrappers and worker threads of a process share one per key.
+    """
+    key = (region, profile_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _create_client(region, profile_name)
+                _clients[key] = client
+    return client
+
+
+def refresh_bedrock_client(region, profile_name=None):
+    """Rebuild the client for (region, profile_name) with a fresh session, e.g. after credentials expired."""
+    key = (region, profile_name)
+    with _lock:
+        client = _create_client(region, profile_name)
+        _clients[key] = client
+    return client
@@ -0,0 +1,219 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import io
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from os import path
+from collections import defaultdict
+
+CASSETTE_FILE = "cassette.sqlite"
+
+# Response headers worth keeping, e.g. token counts for models that do not report them in the body
+RECORDED_HEADERS = ["x-amzn-bedrock-input-token-count", "x-amzn-bedrock-output-token-count",
+                    "x-amzn-bedrock-cache-read-input-token-count", "x-amzn-bedrock-cache-write-input-token-count",
+                    "x-amzn-bedrock-invocation-latency", "content-type"]
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+def request_key(model_id, body):
+    return hashlib.sha256(f"{model_id}\n{body}".encode('utf-8')).hexdigest()
+
+
+class Cassette:
+    def __init__(self, directory):
+        """
+        Compact store of Bedrock request/response pairs with their timing.
+
+        Each interaction is a row of a SQLite file keyed by the digest of
+        (model id, request body); the payload is zlib-compressed JSON.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = path.join(directory, CASSETTE_FILE)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS interactions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, model_id TEXT NOT NULL, "
+            "kind TEXT NOT NULL, latency REAL NOT NULL, payload BLOB NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS interactions_key ON interactions (key)")
+        self._lock = threading.Lock()
+        # Replaying the same request several times serves its recordings in order
+        self._replay_positions = defaultdict(int)
+
+    def record(self, key, model_id, kind, latency, payload):
+        blob = zlib.compress(json.dumps(payload).encode('utf-8'))
+        with self._lock:
+            self.connection.execute(
+                "INSERT INTO interactions (key, model_id, kind, latency, payload) VALUES (?, ?, ?, ?, ?)",
+                (key, model_id, kind, latency, blob))
+
+    def lookup(self, key, kind):
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT latency, payload FROM interactions WHERE key = ? AND kind = ? ORDER BY id",
+                (key, kind)).fetchall()
+            if not rows:
+                return None
+            position = self._replay_positions[(key, kind)]
+            self._replay_positions[(key, kind)] = position + 1
+        latency, blob = rows[min(position, len(rows) - 1)]
+        return latency, json.loads(zlib.decompress(blob))
+
+
+class _RecordingEventStream:
+    """
+    Pass an EventStream through while recording its chunks and their arrival times.
+
+    The recording is kept once the stream is read to the end or closed by the
+    caller, e.g. on an early stop; a stream failing partway is a failed attempt
+    that gets retried, so its chunks are dropped and replay serves the retry.
+    """
+
+    def __init__(self, stream, on_done, start):
+        self.stream = stream
+        self.on_done = on_done
+        self.start = start
+        self.chunks = []
+        self.done = False
+
+    def __iter__(self):
+        try:
+            for event in self.stream:
+                chunk = event.get("chunk")
+                if chunk is not None:
+                    self.chunks.append([time.perf_counter() - self.start, chunk["bytes"].decode('utf-8')])
+                yield event
+        except GeneratorExit:
+            # Abandoned by the caller, which records it by closing the stream
+            raise
+        except BaseException:
+            self.done = True
+            raise
+        self._finish()
+
+    def close(self):
+        self.stream.close()
+        self._finish()
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.on_done(self.chunks, time.perf_counter() - self.start)
+
+
+class _ReplayEventStream:
+    def __init__(self, chunks, reproduce_latency):
+        self.chunks = chunks
+        self.reproduce_latency = reproduce_latency
+
+    def __iter__(self):
+        start = time.perf_counter()
+        for offset, data in self.chunks:
+            if self.reproduce_latency:
+                time.sleep(max(0.0, offset - (time.perf_counter() - start)))
+            yield {"chunk": {"bytes": data.encode('utf-8')}}
+
+    def close(self):
+        pass
+
+
+class CassetteClient:
+    def __init__(self, cassette, client=None, reproduce_latency=False):
+        """
+        Bedrock runtime client stand-in that records to, or replays from, a cassette.
+
+        Args:
+            cassette: Cassette to use
+            client: Real bedrock-runtime client to record from; None replays
+            reproduce_latency: Whether replayed calls wait for their recorded latency
+        """
+        self.cassette = cassette
+        self.client = client
+        self.reproduce_latency = reproduce_latency
+
+    def _replay(self, modelId, body, kind):
+        found = self.cassette.lookup(request_key(modelId, body), kind)
+        if found is None:
+            raise CassetteMissError(f"No recorded {kind} for a {modelId} request in {self.cassette.path}")
+        return found
+
+    def invoke_model(self, body, modelId, **kwargs):
+        if self.client is None:
+            latency, payload = self._replay(modelId, body, "invoke")
+            if self.reproduce_latency:
+                time.sleep(latency)
+            return {"body": io.BytesIO(payload["body"].encode('utf-8')),
+                    "contentType": "application/json",
+                    "ResponseMetadata": {"HTTPHeaders": payload["headers"]}}
+
+        start = time.perf_counter()
+        response = self.client.invoke_model(body=body, modelId=modelId, **kwargs)
+        data = response["body"].read()
+        latency = time.perf_counter() - start
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        headers = {name: headers[name] for name in RECORDED_HEADERS if name in headers}
+        self.cassette.record(request_key(modelId, body), modelId, "invoke", latency,
+                             {"body": data.decode('utf-8'), "headers": headers})
+        response["body"] = io.BytesIO(data)
+        return response
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        if self.client is None:
+            _, payload = self._replay(modelId, body, "stream")
+            return {"body": _ReplayEventStream(payload["chunks"], self.reproduce_latency),
+                    "ResponseMetadata": {"HTTPHeaders": {}}}
+
+        start = time.perf_counter()
+        response = self.client.invoke_model_with_response_stream(body=body, modelId=modelId, **kwargs)
+        key = request_key(modelId, body)
+        response["body"] = _RecordingEventStream(
+            response["body"],
+            lambda chunks, latency: self.cassette.record(key, modelId, "stream", latency, {"chunks": chunks}),
+            start)
+        return response
+
+
+_cassette_options = {"mode": None, "directory": None, "reproduce_latency": False}
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def configure_cassette(mode=None, directory=None, reproduce_latency=False):
+    """
+    Record every Bedrock call to, or replay every call from, the cassette in `directory`.
+
+    Args:
+        mode: "record", "replay" or None to talk to Bedrock directly
+        directory: Cassette directory
+        reproduce_latency: Whether replayed calls wait for their recorded latency
+    """
+    assert mode in (None, "record", "replay"), f"Unknown cassette mode: {mode}"
+    assert mode is None or directory, "A cassette directory is required to record or replay"
+    _cassette_options.update(mode=mode, directory=directory, reproduce_latency=reproduce_latency)
+
+
+def cassette_mode():
+    return _cassette_options["mode"]
+
+
+def wrap_client(client):
+    """Wrap a bedrock-runtime client according to the configured cassette mode."""
+    mode = _cassette_options["mode"]
+    if mode is None:
+        return client
+    directory = _cassette_options["directory"]
+    with _cassettes_lock:
+        cassette = _cassettes.get(directory)
+        if cassette is None:
+            cassette = Cassette(directory)
+            _cassettes[directory] = cassette
+    return CassetteClient(cassette, client if mode == "record" else None, _cassette_options["reproduce_latency"])
@@ -0,0 +1,412 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Binary feature matrix of every user profile, to select cohorts and find
+similar users without parsing the profiles again.
+
+Each column is one feature of a profile:
+    affinity:<Domain>/<Affinity>=<value>   one-hot, or multi-hot for affinities with multiple values
+    demographic:<field>=<value>            one-hot
+    interest:<Domain>                      the `interests` bit
+
+Affinity columns cover the `possible_values` of res/schema.json and every other
+value found in the profiles, e.g. of non-categorical affinities. The matrix is
+cached under $DATA_DIR/caches and rebuilt when the profile store changes.
+
+Cohorts, i.e. the users a run is restricted to, are saved as JSON files under
+res/cohorts; `stratified_sample` draws one whose demographics, interests and
+task domains follow those of the whole population. Reading cohort files does
+not need NumPy.
+"""
+
+import os
+import json
+import logging
+import argparse
+import threading
+from os import path
+from collections import defaultdict
+from util.profile_store import get_profile_store
+from util.task_index import store_signature, get_task_index
+from util.user_context import DATA_DIR
+
+try:
+    import numpy as np
+except ImportError:
+    # Only the profile matrix needs NumPy; entry points merely read cohort files
+    np = None
+
+RES_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'res')
+SCHEMA_PATH = path.join(RES_DIR, 'schema.json')
+COHORT_DIR = path.join(RES_DIR, 'cohorts')
+PROFILE_FEATURES_PATH = os.environ.get("PROFILE_FEATURES", path.join(DATA_DIR, 'caches', 'profile_features.npz'))
+FORMAT_VERSION = 1
+FEATURE_GROUPS = ("affinity", "demographic", "interest")
+STRATA = ("demographic", "interest", "task_domain")
+# Fixed samples of the sample flags of the entry points, in their order of precedence
+SAMPLE_COHORTS = ("sample_30", "sample_50", "sample_100", "sample_20")
+
+
+def affinity_column(domain, affinity, value):
+    return f"affinity:{domain}/{affinity}={value}"
+
+
+def demographic_column(field, value):
+    return f"demographic:{field}={value}"
+
+
+def interest_column(domain):
+    return f"interest:{domain}"
+
+
+def profile_features(user_profile: dict) -> list:
+    """Columns set for a profile."""
+    features = []
+    for domain, affinities in user_profile['affinities'].items():
+        for affinity, value in affinities.items():
+            for v in (value if isinstance(value, list) else [value]):
+                features.append(affinity_column(domain, affinity, v))
+    features += [demographic_column(k, v) for k, v in user_profile['demographics'].items() if k != 'user_id']
+    features += [interest_column(domain) for domain, interested in user_profile['interests'].items() if interested]
+    return features
+
+
+def build_profile_matrix(store, schema_path=SCHEMA_PATH):
+    """Encode every profile of `store`; returns (user ids, column names, uint8 matrix)."""
+    with open(schema_path) as f:
+        schema = json.load(f)
+    columns = {}
+    for domain in schema:
+        columns[interest_column(domain['domain'])] = None
+        for affinity in domain['affinities']:
+            if affinity['is_categorical']:
+                for value in affinity['possible_values']:
+                    columns[affinity_column(domain['domain'], affinity['name'], value)] = None
+    user_ids = store.user_ids()
+    rows = []
+    for user_id in user_ids:
+        features = profile_features(store.profile(user_id))
+        for feature in features:
+            columns.setdefault(feature, None)
+        rows.append(features)
+    columns = sorted(columns)
+    index = {column: i for i, column in enumerate(columns)}
+    matrix = np.zeros((len(user_ids), len(columns)), dtype=np.uint8, order="F")
+    for i, features in enumerate(rows):
+        matrix[i, [index[feature] for feature in features]] = 1
+    return np.array(user_ids, dtype=np.int64), columns, matrix
+
+
+def parse_cohort_query(query: str) -> dict:
+    """
+    Parse a `clause; clause; ...` cohort query into `ProfileMatrix.select` keyword arguments.
+
+    Clauses are `interests=Music,Travel` (interested in all of them), `<demographic field>=v1,v2`
+    and `<Domain>/<Affinity>=v1,v2` (any of the values), e.g.
+    "interests=Music,Travel; age=25-34; Music/Preferred Genres=Jazz,Blues".
+    """
+    kwargs = {"interests": [], "demographics": {}, "affinities": {}}
+    for clause in filter(None, (c.strip() for c in query.split(";"))):
+        key, sep, values = clause.partition("=")
+        if not sep:
+            raise ValueError(f"Cohort query clause {clause!r} is not of the form key=value[,value...]")
+        key, values = key.strip(), [v.strip() for v in values.split(",") if v.strip()]
+        if key == "interests":
+            kwargs["interests"] += values
+        elif "/" in key:
+            kwargs["affinities"][key] = values
+        else:
+            kwargs["demographics"][key] = values
+    return kwargs
+
+
+class ProfileMatrix:
+    def __init__(self, user_ids, columns, matrix):
+        """
+        Cohort queries and similarity search over a `build_profile_matrix` encoding.
+
+        Args:
+            user_ids: (n_users,) int array
+            columns: n_features column names
+            matrix: (n_users, n_features) uint8 array of 0/1
+        """
+        self.user_ids = user_ids
+        self.columns = list(columns)
+        # Queries read a few columns for every user, so store them contiguously
+        self.matrix = np.asfortranarray(matrix)
+        self.column_index = {column: i for i, column in enumerate(self.columns)}
+        self.row_index = {int(user_id): i for i, user_id in enumerate(user_ids)}
+        self._group_counts = {}
+        self._values = None
+
+    def _matching(self, prefix, values):
+        """Indices of the columns `prefix` + value, where a value also matches the leading words of a column value."""
+        if self._values is None:
+            self._values = defaultdict(list)
+            for i, column in enumerate(self.columns):
+                key, sep, value = column.partition("=")
+                if sep:
+                    self._values[key + sep].append((value, i))
+        matched = []
+        for value in values:
+            hits = [i for column_value, i in self._values.get(prefix, [])
+                    if column_value == value or column_value.startswith(value + " ")]
+            if not hits:
+                raise ValueError(f"No profile has {prefix}{value}")
+            matched += hits
+        return matched
+
+    def mask(self, interests=(), demographics=None, affinities=None, user_ids=None) -> "np.ndarray":
+        """
+        Boolean mask of the users matching every criterion.
+
+        Args:
+            interests: Domains the users must all be interested in
+            demographics: {field: values}, the users' value of each field being any of `values`, e.g. {"age": ["25-34"]}
+            affinities: {"Domain/Affinity": values}, the users having any of `values` for each affinity
+            user_ids: Users to select from; everyone by default
+        """
+        mask = np.ones(len(self.user_ids), dtype=bool)
+        for domain in interests:
+            column = self.column_index.get(interest_column(domain))
+            if column is None:
+                raise ValueError(f"Unknown domain {domain}")
+            mask &= self.matrix[:, column].astype(bool)
+        for prefix_of, criteria in ((lambda field: demographic_column(field, ""), demographics or {}),
+                                    (lambda key: f"affinity:{key}=", affinities or {})):
+            for key, values in criteria.items():
+                columns = self._matching(prefix_of(key), [values] if isinstance(values, str) else values)
+                mask &= self.matrix[:, columns].any(axis=1)
+        if user_ids is not None:
+            mask &= np.isin(self.user_ids, np.fromiter(user_ids, dtype=np.int64))
+        return mask
+
+    def select(self, interests=(), demographics=None, affinities=None, user_ids=None) -> list:
+        """User ids matching every criterion of `mask`, in ascending order."""
+        return self.user_ids[self.mask(interests, demographics, affinities, user_ids)].tolist()
+
+    def group_columns(self, groups=FEATURE_GROUPS) -> "np.ndarray":
+        """0/1 mask of the columns of the feature groups `groups`."""
+        return np.array([column.split(":", 1)[0] in groups for column in self.columns], dtype=np.uint8)
+
+    def similar(self, user_id, k=10, groups=FEATURE_GROUPS, user_ids=None) -> list:
+        """
+        The `k` users most similar to `user_id` by cosine similarity of their features, restricted to the
+        columns of `groups` and to `user_ids` if given, as (user_id, similarity) pairs, most similar first.
+        """
+        groups = tuple(groups)
+        if groups not in self._group_counts:
+            columns = self.group_columns(groups)
+            self._group_counts[groups] = columns, self.matrix.sum(axis=1, dtype=np.int32, where=columns.astype(bool))
+        columns, counts = self._group_counts[groups]
+        row = self.row_index[int(user_id)]
+        # Features are binary: the dot product is the number of shared features, each norm the root of a count
+        shared = np.flatnonzero(self.matrix[row] & columns)
+        dots = self.matrix[:, shared].sum(axis=1, dtype=np.int32)
+        scores = dots / np.sqrt(np.maximum(counts * counts[row], 1))
+        scores[row] = -np.inf
+        if user_ids is not None:
+            scores[~np.isin(self.user_ids, np.fromiter(user_ids, dtype=np.int64))] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        top = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=np.int64)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self.user_ids[i]), float(scores[i])) for i in top]
+
+    def save(self, features_path, signature):
+        os.makedirs(path.dirname(path.abspath(features_path)), exist_ok=True)
+        tmp_path = f"{features_path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, user_ids=self.user_ids, columns=np.array(self.columns),
+                            matrix_t=np.packbits(self.matrix.T, axis=1),
+                            meta=np.array(json.dumps({"version": FORMAT_VERSION, "source": signature})))
+        os.replace(tmp_path, features_path)
+
+    @classmethod
+    def load(cls, features_path, signature):
+        """Return the matrix cached at `features_path`, or None if missing or built from another profile store."""
+        if not path.exists(features_path):
+            return None
+        with np.load(features_path) as cached:
+            if json.loads(str(cached["meta"])) != {"version": FORMAT_VERSION, "source": signature}:
+                return None
+            user_ids = cached["user_ids"]
+            matrix = np.unpackbits(cached["matrix_t"], axis=1, count=len(user_ids)).T
+            return cls(user_ids, cached["columns"].tolist(), matrix)
+
+
+def cohort_path(cohort) -> str:
+    """Path of a cohort given as a file path or as the name of a file under res/cohorts."""
+    if path.exists(cohort) or path.dirname(cohort) or cohort.endswith(".json"):
+        return cohort
+    return path.join(COHORT_DIR, f"{cohort}.json")
+
+
+def load_cohort(cohort) -> list:
+    """User ids of a cohort file (see `cohort_path`)."""
+    with open(cohort_path(cohort)) as f:
+        return json.load(f)["user_ids"]
+
+
+def save_cohort(cohort, user_ids, **meta):
+    """Write a cohort file, with `meta` (description, how it was drawn, ...) ahead of the user ids."""
+    cohort_file = cohort_path(cohort)
+    os.makedirs(path.dirname(path.abspath(cohort_file)), exist_ok=True)
+    fields = {**meta, "size": len(user_ids)}
+    with open(cohort_file, "w") as f:
+        f.write("{\n")
+        for key, value in fields.items():
+            f.write(f" {json.dumps(key)}: {json.dumps(value)},\n")
+        f.write(f' "user_ids": {json.dumps([int(user_id) for user_id in user_ids])}\n}}\n')
+    return cohort_file
+
+
+def select_users(args) -> list:
+    """
+    User ids selected by the arguments of an entry point, the first of: `--cohort`,
+    a sample flag (`-s3`, `-s5`, `-s10`, `-s2`), `--sample_idxs`, the index range.
+    """
+    if getattr(args, "cohort", None):
+        return load_cohort(args.cohort)
+    for cohort in SAMPLE_COHORTS:
+        if getattr(args, cohort, False):
+            return load_cohort(cohort)
+    if getattr(args, "sample_idxs", None):
+        return args.sample_idxs
+    return list(range(args.start_index, args.end_index + 1))
+
+
+def strata_features(profile_matrix, strata=STRATA):
+    """
+    (n_users, n_features) float matrix of the strata to balance, with column names.
+
+    Demographic and interest columns are those of the profile matrix; each
+    task_domain column is the number of the user's tasks (single and multi-domain)
+    involving the domain, scaled to at most 1.
+    """
+    groups = [group for group in strata if group != "task_domain"]
+    columns = profile_matrix.group_columns(tuple(groups)).astype(bool)
+    features = profile_matrix.matrix[:, columns].astype(np.float32)
+    names = [column for column, keep in zip(profile_matrix.columns, columns) if keep]
+    if "task_domain" in strata:
+        index = get_task_index()
+        domains = sorted({domain for info in index.tasks.values() for domain in info["domains"]})
+        counts = np.zeros((len(profile_matrix.user_ids), len(domains)), dtype=np.float32)
+        for j, domain in enumerate(domains):
+            for user_id, _ in index.tasks_in_domain(domain):
+                if user_id in profile_matrix.row_index:
+                    counts[profile_matrix.row_index[user_id], j] += 1
+        counts /= np.maximum(counts.max(axis=0), 1)
+        features = np.hstack([features, counts])
+        names += [f"task_domain:{domain}" for domain in domains]
+    return features, names
+
+
+def marginal_deviation(features, names, rows, population_rows):
+    """Largest absolute difference, per stratum, between the feature means of `rows` and of `population_rows`."""
+    deviation = np.abs(features[rows].mean(axis=0) - features[population_rows].mean(axis=0))
+    groups = [name.split(":", 1)[0] for name in names]
+    return {group: round(float(deviation[np.array(groups) == group].max()), 4) for group in dict.fromkeys(groups)}
+
+
+def stratified_sample(size, seed=0, strata=STRATA, user_ids=None, profile_matrix=None):
+    """
+    Draw a reproducible sample of `size` users whose strata follow those of the population.
+
+    Users are added greedily, each time the one bringing the mean of every
+    strata feature of the sample closest (in squared error) to the population
+    mean; `seed` picks the first user and breaks ties.
+
+    Args:
+        size: Number of users to draw
+        seed: Random seed
+        strata: Feature groups to balance, among "demographic", "interest" and "task_domain"
+        user_ids: Population to draw from; every user by default
+        profile_matrix: `ProfileMatrix` to use instead of `get_profile_matrix()`
+
+    Returns:
+        Tuple of (sorted user ids, marginal deviation per stratum, that of a simple random sample of the same size)
+    """
+    profile_matrix = profile_matrix or get_profile_matrix()
+    features, names = strata_features(profile_matrix, strata)
+    population = (np.flatnonzero(np.isin(profile_matrix.user_ids, np.fromiter(user_ids, dtype=np.int64)))
+                  if user_ids is not None else np.arange(len(profile_matrix.user_ids)))
+    if not 0 < size <= len(population):
+        raise ValueError(f"Cannot draw {size} users out of {len(population)}")
+    rng = np.random.default_rng(seed)
+    # Visit the candidates in a seeded order, so argmin breaks ties at random
+    candidates = population[rng.permutation(len(population))]
+    target = features[population].mean(axis=0)
+    squared_norms = (features[candidates] ** 2).sum(axis=1)
+    available = np.ones(len(candidates), dtype=bool)
+    total = np.zeros_like(target)
+    chosen = []
+    for n in range(size):
+        if n == 0:
+            best = 0
+        else:
+            # ||(total + x) / m - target||^2 = ||a||^2 + (2 a.x + |x|^2 / m) / m, with m = n + 1 and a = total / m - target
+            m = n + 1
+            scores = 2 * (features[candidates] @ (total / m - target)) + squared_norms / m
+            scores[~available] = np.inf
+            best = int(np.argmin(scores))
+        available[best] = False
+        total += features[candidates[best]]
+        chosen.append(candidates[best])
+    random_rows = rng.choice(population, size, replace=False)
+    return (sorted(int(profile_matrix.user_ids[row]) for row in chosen),
+            marginal_deviation(features, names, chosen, population),
+            marginal_deviation(features, names, random_rows, population))
+
+
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def get_profile_matrix() -> ProfileMatrix:
+    """Return the process-wide profile matrix, from the cache at $PROFILE_FEATURES if still valid."""
+    global _matrix
+    if np is None:
+        raise ImportError("The profile matrix needs NumPy, install it with `pip install -r requirements.txt`")
+    with _matrix_lock:
+        if _matrix is None:
+            store = get_profile_store()
+            signature = store_signature(store)
+            _matrix = ProfileMatrix.load(PROFILE_FEATURES_PATH, signature)
+            if _matrix is None:
+                logging.info(f"Encoding the user profiles into {PROFILE_FEATURES_PATH}")
+                _matrix = ProfileMatrix(*build_profile_matrix(store))
+                _matrix.save(PROFILE_FEATURES_PATH, signature)
+    return _matrix
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt="%Y-%m-%d %H:%M")
+    parser = argparse.ArgumentParser(description="Select cohorts of users by profile features.")
+    parser.add_argument("-q", "--query", type=str, default="", help="Cohort query, e.g. \"interests=Music,Travel; age=25-34\".")
+    parser.add_argument("--sample", type=int, default=None, help="Draw a stratified sample of this many users of the cohort.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of --sample.")
+    parser.add_argument("--strata", type=str, nargs='+', default=list(STRATA), choices=STRATA, help="Strata balanced by --sample.")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Cohort file (or name under res/cohorts) to save the cohort to.")
+    parser.add_argument("--similar_to", type=int, default=None, help="List the users of the cohort most similar to this user.")
+    parser.add_argument("-k", type=int, default=10, help="Number of similar users to list.")
+    parser.add_argument("--groups", type=str, nargs='+', default=list(FEATURE_GROUPS), choices=FEATURE_GROUPS, help="Feature groups compared by --similar_to.")
+    args = parser.parse_args()
+
+    profile_matrix = get_profile_matrix()
+    cohort = profile_matrix.select(**parse_cohort_query(args.query))
+    meta = {"query": args.query}
+    if args.sample is not None:
+        cohort, deviation, random_deviation = stratified_sample(args.sample, args.seed, tuple(args.strata), cohort,
+                                                                profile_matrix)
+        logging.info(f"Largest deviation of the stratum means from the population: {deviation} "
+                     f"(simple random sample: {random_deviation})")
+        meta.update(seed=args.seed, strata=args.strata, max_deviation=deviation)
+    if args.similar_to is None:
+        logging.info(f"{len(cohort)} users match")
+        if args.output:
+            logging.info(f"Cohort saved to {save_cohort(args.output, cohort, **meta)}")
+        else:
+            print(" ".join(map(str, cohort)))
+    else:
+        for user_id, similarity in profile_matrix.similar(args.similar_to, args.k, tuple(args.groups), cohort):
+            print(f"{user_id}\t{similarity:.3f}")
@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Structured output of the combined judge (`EVAL_DIALOGUE_COMBINED`), which
+rates every dimension of a dialogue in one call.
+
+`parse_combined_evaluation` checks a response against the expected JSON
+object, and `split_combined_evaluation` renders it back into the response
+format of each single-dimension prompt, so `util.gather_evaluation` analyzes
+both kinds of evaluations the same way.
+"""
+
+import re
+import json
+
+COMBINED_DIMENSION = "combined"
+
+# Judged dimension as named by `evaluate_dialogue --dimensions` -> (eval_dimension, file suffix, score label, max score)
+COMBINED_FIELDS = {
+    "naturalness_user": ("naturalness", "_user", "Naturalness Score", 5),
+    "naturalness_asst": ("naturalness", "_asst", "Naturalness Score", 5),
+    "coherence_user": ("coherence", "_user", "Coherence Score", 5),
+    "coherence_asst": ("coherence", "_asst", "Coherence Score", 5),
+    "task_completion": ("task_completion", "", None, None),
+    "personalization": ("personalization", "", "Personalization Score", 4),
+}
+
+
+def parse_combined_evaluation(content: str) -> dict:
+    """
+    Parse a combined judge response into {name: {"score", "justification"} or {"verdict", "explanation"}}.
+
+    Raises ValueError if the response is not exactly the expected JSON object.
+    """
+    match = re.search(r"<response>(.*?)</response>", content, re.DOTALL)
+    try:
+        evaluation = json.loads(match.group(1) if match else content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Combined evaluation is not valid JSON: {e}") from None
+    if not isinstance(evaluation, dict) or set(evaluation) != set(COMBINED_FIELDS):
+        raise ValueError(f"Combined evaluation must have exactly the keys {', '.join(COMBINED_FIELDS)}")
+    for name, (_, _, label, max_score) in COMBINED_FIELDS.items():
+        field = evaluation[name]
+        if label is None:
+            if not (isinstance(field, dict) and isinstance(field.get("verdict"), bool)
+                    and isinstance(field.get("explanation"), str)):
+                raise ValueError(f"{name} must be {{\"verdict\": bool, \"explanation\": str}}")
+        else:
+            score = field.get("score") if isinstance(field, dict) else None
+            if not (type(score) is int and 1 <= score <= max_score and isinstance(field.get("justification"), str)):
+                raise ValueError(f"{name} must be {{\"score\": 1-{max_score}, \"justification\": str}}")
+    return evaluation
+
+
+def split_combined_evaluation(content: str) -> dict:
+    """
+    Render a combined judge response as the single-dimension responses it stands for.
+
+    Returns:
+        {(eval_dimension, file suffix): text in the response format of that dimension's prompt}
+    """
+    evaluation = parse_combined_evaluation(content)
+    responses = {}
+    for name, (eval_dimension, evalname, label, _) in COMBINED_FIELDS.items():
+        field = evaluation[name]
+        if label is None:
+            text = f"VERDICT: {field['verdict']}\nEXPLANATION: {field['explanation']}"
+        else:
+            text = f"{label}: {field['score']}\nJustification: {field['justification']}"
+        responses[(eval_dimension, evalname)] = text
+    return responses
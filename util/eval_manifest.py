@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Record of the judge request behind every saved evaluation, so reruns only
+judge the dialogues that are new or changed.
+
+Each evaluation file is recorded against the digest of its judge request
+(`make_cache_key` of the rendered prompt, i.e. dialogue, context and template,
+plus the judge model id and parameters), in a `.manifest.json` sidecar of its
+directory. An evaluation is current if its file exists and was saved from a
+request with the same digest.
+"""
+
+import os
+import json
+import threading
+from os import path
+
+MANIFEST_NAME = ".manifest.json"
+
+
+class EvaluationManifest:
+    def __init__(self):
+        """Sidecar manifests of the evaluation directories, loaded on first use and kept in memory."""
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def _manifest(self, directory):
+        manifest = self._manifests.get(directory)
+        if manifest is None:
+            manifest_path = path.join(directory, MANIFEST_NAME)
+            manifest = {}
+            if path.exists(manifest_path):
+                try:
+                    with open(manifest_path) as f:
+                        manifest = json.load(f)
+                except json.JSONDecodeError:
+                    # Only costs rejudging the directory
+                    manifest = {}
+            self._manifests[directory] = manifest
+        return manifest
+
+    def is_current(self, file_path, digest) -> bool:
+        """Whether `file_path` exists and was saved from the judge request of `digest`."""
+        with self._lock:
+            recorded = self._manifest(path.dirname(file_path)).get(path.basename(file_path))
+        return recorded == digest and path.exists(file_path)
+
+    def record(self, file_path, digest):
+        """Record that `file_path` was just saved from the judge request of `digest`."""
+        directory = path.dirname(file_path)
+        with self._lock:
+            manifest = self._manifest(directory)
+            manifest[path.basename(file_path)] = digest
+            tmp_path = path.join(directory, f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, path.join(directory, MANIFEST_NAME))
@@ -586,4 +586,128 @@ Justification:
 <response>
 Provide your response immediately without any preamble, enclosed in <response></response> tags.
 </response>
-"""
\ No newline at end of file
+"""
+EVAL_DIALOGUE_COMBINED = """<task_description>
+Evaluate a conversation between a USER and an ASSISTANT on every dimension below at once: the naturalness and coherence of the user's requests and of the assistant's responses, whether the conversation meets the user's GOALS, and how well the assistant personalizes the conversation to the user.
+</task_description>
+
+<definitions>
+- User Demographic Profile: The user's demographic information.
+- User Preferences: The user's relevant preferences.
+- Explicit Preferences: Preferences clearly stated by the user
+- Implicit Preferences: Preferences inferred from patterns, habits, contextual clues, past interactions or user behavior.
+- User Control: The level of influence the user has in making decisions or directing the course of an interaction.
+- Past Interaction Summary: A summary of relevant past user interactions.
+- Task Description: The description of the task the user needs help with.
+- Current Situation Context: The user's current situation.
+- Goals: Clear, measurable objectives the user aims to achieve in the interaction.
+- Conversation: A sequence of USER inputs and ASSISTANT responses.
+</definitions>
+
+<instructions>
+Rate each dimension independently of the others, using the following rubrics.
+
+1. Naturalness: how closely the utterances resemble natural human communication. Rate the overall user utterances (naturalness_user) and the overall assistant responses (naturalness_asst) separately, on a scale from 1 to 5, using whole numbers only:
+<rating_scale>
+1: Highly unnatural, fails to resemble human communication
+2: Exhibits significant unnaturalness in multiple aspects
+3: Somewhat natural but has noticeable unnatural elements
+4: Mostly natural but has minor unnatural elements
+5: Fully natural, resembles human communication
+</rating_scale>
+
+2. Coherence: how logically and contextually connected the utterances are to the preceding user requests and conversation flow. Rate the overall user utterances (coherence_user) and the overall assistant responses (coherence_asst) separately, on a scale from 1 to 5, using whole numbers only:
+<rating_scale>
+1: Highly incoherent, lacks logical connection or relevance to the conversation
+2: Significantly incoherent, with multiple issues affecting logic or relevance
+3: Somewhat coherent but with noticeable issues in logic or relevance
+4: Mostly coherent but with minor flaws in logic, relevance, or clarity
+5: Fully coherent, logically connected, relevant, and clear within the conversation context
+</rating_scale>
+
+3. Task completion: deliver a boolean verdict of whether or not all GOALS are satisfied, with a brief explanation of why or why not. If one of the GOALS requires a piece of the conversation that is absent, the verdict is false.
+
+4. Personalization: the degree to which the assistant learns from, remembers, and proactively applies user preferences and patterns. Evaluate the conversation against these key criteria:
+- Proactive Learning: Does the assistant demonstrate learning from past interactions?
+- Preference Application: Does the assistant proactively apply user preferences?
+- Contextual Awareness: Does the assistant adapt to user's current situation?
+- User Agency: Does the assistant maintain user control while showing personalization?
+
+Score from 1 to 4 using the following guidelines:
+
+Score of 1: POOR (Complete Failure to Personalize)
+- The assistant fails to apply known preferences that should be automatically recalled from past interactions.
+- The assistant asks for basic information that should already be known, when those preferences have already been established.
+- The assistant contradicts previously established preferences or gives responses that are inconsistent with the user's history.
+- There is no learning from past interactions, and the assistant does not personalize the experience in any meaningful way.
+
+Score of 2: BASIC (Minimal Personalization)
+- The assistant acknowledges user preferences only when explicitly stated in the current conversation.
+- The assistant requires explicit restatement of preferences that have already been established in past interactions.
+- Implicit preferences are missed or not applied unless explicitly mentioned by the user.
+- The assistant may suggest minimal changes or adjustments based on the current conversation, but it does not proactively personalize the experience.
+
+Score of 3: STRONG (Proactive Personalization)
+- The assistant proactively applies known preferences from past interactions without needing explicit user input.
+- It applies learned preferences from previous interactions but might still ask for minor adjustments (e.g., if the user wants to change something).
+- Successfully identifies implicit preferences
+- Maintains user agency while showing knowledge
+- Makes intelligent suggestions based on context
+
+Score of 4: EXCEPTIONAL (Perfect Personalization)
+- The assistant anticipates user needs based on both explicit and implicit preferences.
+- It applies sophisticated understanding of the user's habits, identifying patterns, and proactively adjusting for future needs.
+- The assistant doesn't simply rely on explicit preferences, it recognizes context and makes intelligent suggestions based on its deep knowledge of the user's habits.
+
+Additional guidelines for personalization:
+- Evaluate based on all available context information
+- Consider both explicit and implicit preferences
+- Assess balance between personalization and user control
+- Look for evidence of learning and pattern recognition
+- Consider appropriateness of personalization level for context
+
+5. Provide your evaluation as a single JSON object with exactly these keys, whole numbers for the scores and a JSON boolean for the verdict:
+
+<response_format>
+{{
+  "naturalness_user": {{"score": [1-5], "justification": "[Detailed explanation of score based on criteria]"}},
+  "naturalness_asst": {{"score": [1-5], "justification": "[Detailed explanation of score based on criteria]"}},
+  "coherence_user": {{"score": [1-5], "justification": "[Detailed explanation of score based on criteria]"}},
+  "coherence_asst": {{"score": [1-5], "justification": "[Detailed explanation of score based on criteria]"}},
+  "task_completion": {{"verdict": [true or false], "explanation": "[Why the goals are or are not met]"}},
+  "personalization": {{"score": [1-4], "justification": "[Detailed explanation of score based on criteria]"}}
+}}
+</response_format>
+</instructions>
+
+Review the provided context information and conversation:
+<user_demographic_profile>
+{demographic_profile}
+</user_demographic_profile>
+
+<user_preferences>
+{user_affinity}
+</user_preferences>
+
+<task_description>
+{task_description}
+</task_description>
+
+<past_interaction_summary>
+{interaction_summary}
+</past_interaction_summary>
+
+<current_situation_context>
+{situation_context}
+</current_situation_context>
+
+<goals>
+{goal}
+</goals>
+
+<conversation>
+{conversation}
+</conversation>
+
+Provide your response immediately without any preamble, as the JSON object alone enclosed in <response></response> tags.
+"""
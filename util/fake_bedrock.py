@@ -0,0 +1,371 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Local stand-in for the Bedrock runtime API, for load-testing the dialogue
+generation and evaluation pipelines without spending real quota.
+
+Run it with `python3 -m util.fake_bedrock --port 8080` and point the entry
+points at it with `--endpoint_url http://localhost:8080`.
+"""
+
+import json
+import time
+import zlib
+import base64
+import random
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+from collections import deque
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from util.rate_limiter import RATE_LIMITS_PATH
+
+DEFAULT_PROFILE = {
+    # Per-minute quotas; None means unlimited. Overridden by the quotas file.
+    "requests_per_minute": None,
+    "tokens_per_minute": None,
+    # Time to first token is log-normal with this median (seconds) and shape
+    "first_token_median": 0.6,
+    "first_token_sigma": 0.4,
+    # Token-proportional part of the response time
+    "seconds_per_input_token": 0.00005,
+    "seconds_per_output_token": 0.02,
+    # Output length is exponential with this mean, capped by the request's max tokens
+    "mean_output_tokens": 150,
+    # Failure injection, as probabilities per request
+    "throttle_rate": 0.0,
+    "timeout_rate": 0.0,
+    # Streamed responses failing after some chunks with an exception event
+    "stream_error_rate": 0.0,
+    # Probability that a response ends with TERMINATE, so simulated dialogues end
+    "terminate_rate": 0.25,
+}
+
+# Prompt cache entries live this long after their last use, and shorter prefixes are never cached
+PROMPT_CACHE_TTL = 300
+PROMPT_CACHE_MIN_TOKENS = 1024
+# Block boundaries before a checkpoint that are also looked up, as Bedrock does
+PROMPT_CACHE_LOOKBACK = 20
+
+WORDS = ("the a of to and in for on with that this is can you I would like please help find book "
+         "check set time place option thanks sure great recommend next order price schedule").split()
+
+
+def _encode_event(chunk: dict) -> bytes:
+    """Encode one `chunk` event of an invoke-with-response-stream response in the AWS event stream format."""
+    payload = json.dumps({"bytes": base64.b64encode(json.dumps(chunk).encode('utf-8')).decode('ascii')}).encode('utf-8')
+    return _encode_message(((":event-type", "chunk"), (":content-type", "application/json"), (":message-type", "event")),
+                           payload)
+
+
+def _encode_exception(code: str, message: str) -> bytes:
+    """Encode a mid-stream error, which botocore raises as an EventStreamError with the lower camel case `code`."""
+    payload = json.dumps({"message": message}).encode('utf-8')
+    return _encode_message(((":exception-type", code), (":content-type", "application/json"),
+                            (":message-type", "exception")), payload)
+
+
+def _encode_message(header_values, payload: bytes) -> bytes:
+    headers = b""
+    for name, value in header_values:
+        name, value = name.encode('utf-8'), value.encode('utf-8')
+        headers += bytes([len(name)]) + name + b"\x07" + struct.pack(">H", len(value)) + value
+    prelude = struct.pack(">II", 16 + len(headers) + len(payload), len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack(">I", zlib.crc32(message))
+
+
+def _family(model_id):
+    if "anthropic" in model_id:
+        return "claude"
+    if "llama" in model_id:
+        return "llama"
+    if "mistral" in model_id or "mixtral" in model_id:
+        return "mistral"
+    return None
+
+
+class FakeBedrock:
+    def __init__(self, profiles=None, quotas=None):
+        """
+        Simulated models: quotas, latency and failure injection per model id.
+
+        Args:
+            profiles: Dict of model id (or "default") to overrides of DEFAULT_PROFILE
+            quotas: Dict of model id (or "default") to requests/tokens per minute, as in res/rate_limits.json
+        """
+        self.profiles = {}
+        for source in (quotas or {}, profiles or {}):
+            for model_id, values in source.items():
+                self.profiles.setdefault(model_id, {}).update(values)
+        self._windows = {}
+        self._prompt_cache = {}
+        self._lock = threading.Lock()
+
+    def profile(self, model_id):
+        profile = dict(DEFAULT_PROFILE)
+        profile.update(self.profiles.get("default", {}))
+        profile.update(self.profiles.get(model_id, {}))
+        return profile
+
+    def admit(self, model_id, tokens, profile):
+        """Count a request against the per-minute quotas of `model_id`; False if it must be throttled."""
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault(model_id, deque())
+            while window and now - window[0][0] >= 60:
+                window.popleft()
+            requests_per_minute = profile["requests_per_minute"]
+            tokens_per_minute = profile["tokens_per_minute"]
+            if requests_per_minute is not None and len(window) + 1 > requests_per_minute:
+                return False
+            if tokens_per_minute is not None and sum(t for _, t in window) + tokens > tokens_per_minute:
+                return False
+            window.append((now, tokens))
+        return True
+
+    def prompt_cache(self, model_id, prefixes, checkpoints):
+        """
+        Simulate Bedrock prompt caching.
+
+        Args:
+            prefixes: Prompt text up to the end of each content block
+            checkpoints: Indices of the blocks carrying `cache_control`
+
+        Returns:
+            Tuple of (read_chars, write_chars): the longest cached prefix, and what the last checkpoint adds to it
+        """
+        now = time.monotonic()
+        checkpoints = [i for i in checkpoints if len(prefixes[i]) // 4 >= PROMPT_CACHE_MIN_TOKENS]
+        candidates = sorted({j for i in checkpoints for j in range(max(0, i - PROMPT_CACHE_LOOKBACK), i + 1)})
+        key = lambda i: (model_id, hashlib.sha256(prefixes[i].encode('utf-8')).digest())
+        read_chars = 0
+        with self._lock:
+            for i in candidates:
+                if self._prompt_cache.get(key(i), 0) > now:
+                    read_chars = len(prefixes[i])
+            for i in checkpoints:
+                self._prompt_cache[key(i)] = now + PROMPT_CACHE_TTL
+        write_chars = len(prefixes[checkpoints[-1]]) - read_chars if checkpoints else 0
+        return read_chars, max(0, write_chars)
+
+    def plan(self, model_id, body):
+        """Draw the outcome of a request: an error code, or the tokens to generate and their timing."""
+        family = _family(model_id)
+        request = json.loads(body)
+        read_chars = write_chars = 0
+        if family == "claude":
+            system = request.get("system", "")
+            blocks = [{"type": "text", "text": system}] if isinstance(system, str) else list(system)
+            blocks += [part for message in request["messages"] for part in message["content"]]
+            prompt, prefixes, checkpoints = "", [], []
+            for i, block in enumerate(blocks):
+                prompt += block.get("text", "")
+                prefixes.append(prompt)
+                if "cache_control" in block:
+                    checkpoints.append(i)
+            read_chars, write_chars = self.prompt_cache(model_id, prefixes, checkpoints)
+            max_tokens = request["max_tokens"]
+        else:
+            prompt = request["prompt"]
+            max_tokens = request.get("max_gen_len", request.get("max_tokens", 512))
+        input_tokens = max(1, (len(prompt) - read_chars - write_chars) // 4)
+        cache_read_tokens, cache_write_tokens = read_chars // 4, write_chars // 4
+
+        profile = self.profile(model_id)
+        rng = random.Random(hashlib.sha256(body).digest())
+        # Bedrock reserves the full output budget against the tokens quota when a request starts
+        if not self.admit(model_id, input_tokens + cache_write_tokens + max_tokens, profile):
+            return {"error": "ThrottlingException"}
+        if random.random() < profile["throttle_rate"]:
+            return {"error": "ThrottlingException"}
+
+        output_tokens = max(1, min(max_tokens, int(rng.expovariate(1 / profile["mean_output_tokens"]))))
+        words = [rng.choice(WORDS) for _ in range(output_tokens)]
+        if rng.random() < profile["terminate_rate"]:
+            words[-1] = "TERMINATE"
+        first_token = (random.lognormvariate(0, profile["first_token_sigma"]) * profile["first_token_median"]
+                       + (input_tokens + cache_write_tokens) * profile["seconds_per_input_token"])
+        plan = {
+            "family": family,
+            "input_tokens": input_tokens,
+            "cache_read_tokens": cache_read_tokens,
+            "cache_write_tokens": cache_write_tokens,
+            "pieces": [word if i == 0 else " " + word for i, word in enumerate(words)],
+            "first_token": first_token,
+            "per_token": profile["seconds_per_output_token"],
+        }
+        if random.random() < profile["timeout_rate"]:
+            plan["error"] = "ModelTimeoutException"
+        elif random.random() < profile["stream_error_rate"]:
+            # Only streamed responses fail this way; the chunk the error replaces
+            plan["stream_error_at"] = rng.randrange(len(words))
+        return plan
+
+
+def _final_chunk(plan, latency, first_token):
+    family, output_tokens = plan["family"], len(plan["pieces"])
+    metrics = {"amazon-bedrock-invocationMetrics": {
+        "inputTokenCount": plan["input_tokens"], "outputTokenCount": output_tokens,
+        "cacheReadInputTokenCount": plan["cache_read_tokens"], "cacheWriteInputTokenCount": plan["cache_write_tokens"],
+        "invocationLatency": int(latency * 1000), "firstByteLatency": int(first_token * 1000)}}
+    if family == "claude":
+        return dict({"type": "message_stop"}, **metrics)
+    if family == "llama":
+        return dict({"generation": "", "prompt_token_count": plan["input_tokens"],
+                     "generation_token_count": output_tokens, "stop_reason": "stop"}, **metrics)
+    return dict({"outputs": [{"text": "", "stop_reason": "stop"}]}, **metrics)
+
+
+def _piece_chunk(family, piece):
+    if family == "claude":
+        return {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}}
+    if family == "llama":
+        return {"generation": piece, "prompt_token_count": None, "generation_token_count": None, "stop_reason": None}
+    return {"outputs": [{"text": piece, "stop_reason": None}]}
+
+
+def _response_body(plan):
+    text = "".join(plan["pieces"])
+    output_tokens = len(plan["pieces"])
+    if plan["family"] == "claude":
+        return {"id": "msg_fake", "type": "message", "role": "assistant",
+                "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                "usage": {"input_tokens": plan["input_tokens"], "output_tokens": output_tokens,
+                          "cache_read_input_tokens": plan["cache_read_tokens"],
+                          "cache_creation_input_tokens": plan["cache_write_tokens"]}}
+    if plan["family"] == "llama":
+        return {"generation": text, "prompt_token_count": plan["input_tokens"],
+                "generation_token_count": output_tokens, "stop_reason": "stop"}
+    return {"outputs": [{"text": text, "stop_reason": "stop"}]}
+
+
+ERROR_STATUS = {"ThrottlingException": 429, "ModelTimeoutException": 408, "ValidationException": 400}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send_error(self, code, message):
+        data = json.dumps({"message": message}).encode('utf-8')
+        self.send_response(ERROR_STATUS[code])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("x-amzn-ErrorType", f"{code}:http://internal.amazon.com/coral/com.amazon.bedrock/")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        parts = self.path.split("/")
+        if len(parts) != 4 or parts[1] != "model" or parts[3] not in ("invoke", "invoke-with-response-stream"):
+            return self._send_error("ValidationException", f"Unknown path {self.path}")
+        model_id = unquote(parts[2])
+        if _family(model_id) is None:
+            return self._send_error("ValidationException", f"Unsupported model {model_id}")
+
+        start = time.perf_counter()
+        plan = self.server.fake.plan(model_id, body)
+        if plan.get("error") == "ThrottlingException":
+            return self._send_error("ThrottlingException", "Too many requests, please wait before trying again.")
+        if plan.get("error") == "ModelTimeoutException":
+            time.sleep(plan["first_token"] + plan["per_token"] * len(plan["pieces"]))
+            return self._send_error("ModelTimeoutException", "Model has timed out in processing the request.")
+
+        if parts[3] == "invoke":
+            time.sleep(plan["first_token"] + plan["per_token"] * len(plan["pieces"]))
+            data = json.dumps(_response_body(plan)).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("x-amzn-bedrock-input-token-count", str(plan["input_tokens"]))
+            self.send_header("x-amzn-bedrock-output-token-count", str(len(plan["pieces"])))
+            self.send_header("x-amzn-bedrock-cache-read-input-token-count", str(plan["cache_read_tokens"]))
+            self.send_header("x-amzn-bedrock-cache-write-input-token-count", str(plan["cache_write_tokens"]))
+            self.send_header("x-amzn-bedrock-invocation-latency", str(int((time.perf_counter() - start) * 1000)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(plan["first_token"])
+        first_token = time.perf_counter() - start
+        try:
+            for i, piece in enumerate(plan["pieces"]):
+                if i:
+                    time.sleep(plan["per_token"])
+                if i == plan.get("stream_error_at"):
+                    self._write_chunk(_encode_exception(
+                        "modelStreamErrorException", "The model encountered an error while streaming the response."))
+                    self._write_chunk(b"")
+                    return
+                self._write_chunk(_encode_event(_piece_chunk(plan["family"], piece)))
+            self._write_chunk(_encode_event(_final_chunk(plan, time.perf_counter() - start, first_token)))
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early, e.g. after TERMINATE
+            self.close_connection = True
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+def make_server(host="127.0.0.1", port=8080, profiles=None, quotas=None):
+    """Create (without starting) a threaded HTTP server simulating the Bedrock runtime API."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.fake = FakeBedrock(profiles=profiles, quotas=quotas)
+    return server
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Local Bedrock runtime stand-in for load tests.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument("--quotas", type=str, default=RATE_LIMITS_PATH, help="JSON file with per-model requests/tokens per minute quotas to enforce.")
+    parser.add_argument("--no_quotas", action="store_true", help="Whether to accept any request rate.")
+    parser.add_argument("--profiles", type=str, default=None, help="JSON file with per-model overrides of the latency and failure settings.")
+    parser.add_argument("--first_token_median", type=float, default=DEFAULT_PROFILE["first_token_median"], help="Median seconds to the first token.")
+    parser.add_argument("--seconds_per_output_token", type=float, default=DEFAULT_PROFILE["seconds_per_output_token"], help="Seconds per generated token.")
+    parser.add_argument("--mean_output_tokens", type=int, default=DEFAULT_PROFILE["mean_output_tokens"], help="Mean number of generated tokens.")
+    parser.add_argument("--throttle_rate", type=float, default=DEFAULT_PROFILE["throttle_rate"], help="Fraction of requests failing with ThrottlingException regardless of quotas.")
+    parser.add_argument("--timeout_rate", type=float, default=DEFAULT_PROFILE["timeout_rate"], help="Fraction of requests failing with ModelTimeoutException.")
+    parser.add_argument("--stream_error_rate", type=float, default=DEFAULT_PROFILE["stream_error_rate"], help="Fraction of streamed responses failing mid-stream with modelStreamErrorException.")
+    parser.add_argument("--terminate_rate", type=float, default=DEFAULT_PROFILE["terminate_rate"], help="Fraction of responses ending with TERMINATE.")
+    args = parser.parse_args()
+
+    quotas = None
+    if not args.no_quotas:
+        with open(args.quotas) as f:
+            quotas = json.load(f)
+    profiles = {}
+    if args.profiles:
+        with open(args.profiles) as f:
+            profiles = json.load(f)
+    defaults = {name: getattr(args, name) for name in ("first_token_median", "seconds_per_output_token", "mean_output_tokens",
+                                                       "throttle_rate", "timeout_rate", "stream_error_rate", "terminate_rate")}
+    # Command-line settings apply to every model unless the profiles file overrides them
+    profiles["default"] = dict(defaults, **profiles.get("default", {}))
+
+    server = make_server(args.host, args.port, profiles=profiles, quotas=quotas)
+    logging.info(f"Fake Bedrock runtime listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
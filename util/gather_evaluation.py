@@ -7,7 +7,19 @@ import glob
 import logging
 import argparse
 from collections import defaultdict
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+from util.cohort import select_users
+from util.combined_rubric import COMBINED_DIMENSION, COMBINED_FIELDS, split_combined_evaluation
+
+def parse_score(content: str, matching_string_score: str) -> Optional[int]:
+    """Extract the `{matching_string_score}: N` rating of a judge response."""
+    score_match = re.search(rf"{matching_string_score}: (\d+)", content)
+    return int(score_match.group(1)) if score_match else None
+
+def parse_verdict(content: str) -> Optional[bool]:
+    """Extract the `VERDICT: True/False` of a task completion judge response."""
+    verdict_match = re.search(r"VERDICT: (True|False)", content, re.IGNORECASE)
+    return verdict_match.group(1).lower() == "true" if verdict_match else None
 
 def analyze_quality_ratings(user_list: List, base_path: str = 'data/evaluation', 
                    model_id_asst: str = 'claude-3-sonnet-v1', 
@@ -43,9 +55,7 @@ def analyze_quality_ratings(user_list: List, base_path: str = 'data/evaluation',
             Tuple of (score, justification)
         """
         # Extract coherence score
-        score_pattern = rf"{matching_string_score}: (\d+)"
-        score_match = re.search(score_pattern, content)
-        score = int(score_match.group(1)) if score_match else None
+        score = parse_score(content, matching_string_score)
         
         # Extract justification
         justification_pattern = rf"{matching_string_justification}: (.*?)(?=\n\n|$)"
@@ -170,11 +180,7 @@ def analyze_task_completion_ratings(user_list: List, base_path: str = 'data/eval
             Tuple of (verdict, justification)
         """
         # Check for VERDICT
-        verdict_pattern = r"VERDICT: (True|False)"
-        verdict_match = re.search(verdict_pattern, content, re.IGNORECASE)
-        verdict = verdict_match.group(1).lower() == "true" if verdict_match else None
-       
-        return verdict
+        return parse_verdict(content)
     
     # Loop through specified user range
     for i in user_list:
@@ -234,6 +240,92 @@ def analyze_task_completion_ratings(user_list: List, base_path: str = 'data/eval
     }
 
 
+def split_combined_results(user_list: List, base_path: str = 'output/evaluation',
+                           split_path: str = 'output/evaluation_combined',
+                           model_id_asst: str = 'claude-3-sonnet-v1',
+                           model_id_eval: str = 'claude-3-5-sonnet-v2') -> Tuple[int, List[str]]:
+    """
+    Split every combined evaluation into the per-dimension responses it stands for.
+
+    The responses are written under `split_path` in the layout of `base_path`, e.g.
+    `{split_path}/user0/{model_id_asst}/naturalness/{model_id_eval}/{task_id}_user.txt`,
+    so the analyze functions read them like single-dimension evaluations.
+
+    Returns:
+        Tuple of (number of combined evaluations split, paths of those not following the response format)
+    """
+    split = 0
+    unparsed = []
+    for i in user_list:
+        combined_dir = os.path.join(base_path, f'user{i}', model_id_asst, COMBINED_DIMENSION, model_id_eval)
+        for file_path in sorted(glob.glob(os.path.join(combined_dir, '*.txt'))):
+            with open(file_path) as f:
+                content = f.read()
+            try:
+                responses = split_combined_evaluation(content)
+            except ValueError:
+                unparsed.append(file_path)
+                continue
+            task_id = os.path.basename(file_path)[:-len('.txt')]
+            for (dimension, file_ext), text in responses.items():
+                save_path = os.path.join(split_path, f'user{i}', model_id_asst, dimension, model_id_eval)
+                os.makedirs(save_path, exist_ok=True)
+                with open(os.path.join(save_path, f'{task_id}{file_ext}.txt'), 'w') as f:
+                    f.write(text)
+            split += 1
+    return split, unparsed
+
+def judge_agreement(user_list: List, base_path: str = 'output/evaluation',
+                    split_path: str = 'output/evaluation_combined',
+                    model_id_asst: str = 'claude-3-sonnet-v1',
+                    model_id_eval: str = 'claude-3-5-sonnet-v2',
+                    multi_domain: bool = False) -> Dict:
+    """
+    Compare the split combined evaluations against the single-dimension ones of the same dialogues.
+
+    Meant for a calibration subset of users evaluated both ways, e.g. with
+    `evaluate_dialogue --dimensions all combined`.
+
+    Returns:
+        {dimension name: statistics over the dialogues evaluated both ways}, with for scores the
+        exact and within-one agreement rates and mean ratings, and for task completion the
+        agreement rate and completion rates
+    """
+    results = {}
+    for name, (dimension, file_ext, matching_string_score, _) in COMBINED_FIELDS.items():
+        pairs = []
+        for i in user_list:
+            single_dir = os.path.join(base_path, f'user{i}', model_id_asst, dimension, model_id_eval)
+            combined_dir = os.path.join(split_path, f'user{i}', model_id_asst, dimension, model_id_eval)
+            pattern = f'MD*{file_ext}.txt' if multi_domain else f'SD*{file_ext}.txt'
+            for combined_file in glob.glob(os.path.join(combined_dir, pattern)):
+                single_file = os.path.join(single_dir, os.path.basename(combined_file))
+                if not os.path.exists(single_file):
+                    continue
+                with open(single_file) as f:
+                    single_content = f.read()
+                with open(combined_file) as f:
+                    combined_content = f.read()
+                if matching_string_score is None:
+                    single, combined = parse_verdict(single_content), parse_verdict(combined_content)
+                else:
+                    single, combined = parse_score(single_content, matching_string_score), parse_score(combined_content, matching_string_score)
+                # Answers without a verdict or score say nothing about agreement
+                if single is not None and combined is not None:
+                    pairs.append((single, combined))
+        count = len(pairs)
+        stats = {'count': count, 'agreement': sum(a == b for a, b in pairs) / count if count else 0}
+        if matching_string_score is None:
+            stats['single_tc_rate'] = sum(a for a, _ in pairs) / count if count else 0
+            stats['combined_tc_rate'] = sum(b for _, b in pairs) / count if count else 0
+        else:
+            stats['within_one'] = sum(abs(a - b) <= 1 for a, b in pairs) / count if count else 0
+            stats['single_average'] = sum(a for a, _ in pairs) / count if count else 0
+            stats['combined_average'] = sum(b for _, b in pairs) / count if count else 0
+        results[name] = stats
+    return results
+
+
 def main():
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt="%Y-%m-%d %H:%M")
     parser = argparse.ArgumentParser(description="Generate personas for user profiles.")
@@ -249,40 +341,52 @@ def main():
     parser.add_argument("-s3", "--sample_30", action="store_true", help="Whether to use small sample of 30 users.")
     parser.add_argument("-s5", "--sample_50", action="store_true", help="Whether to use small sample of 50 users.")
     parser.add_argument("-s10", "--sample_100", action="store_true", help="Whether to use small sample of 100 users.")
+    parser.add_argument("--cohort", type=str, default=None, help="Cohort file, or name of a file under res/cohorts, listing the users to process.")
+    parser.add_argument("--model_id_eval", type=str, default=None, help="The model id of the judge; defaults to the judge used for the dimension.")
+    parser.add_argument("--combined", action="store_true", help="Whether to analyze the combined judge evaluations, split into per-dimension results.")
+    parser.add_argument("--agreement", action="store_true", help="Whether to compare the combined judge evaluations with the single-dimension ones, on the selected users.")
     parser.add_argument("-i", "--icl", action="store_true", help="Whether to use in-context learning for path.")
     parser.add_argument("-p", "--icl_path", type=str, default="icl", help="Path for in-context learning experiment.")
 
     # Parse arguments
     args = parser.parse_args()
 
-    sample_20_idxs = [66, 132, 139, 207, 230, 340, 386, 389, 415, 428, 597, 746, 774, 854, 900, 1111, 1197, 1231, 1322, 1458]
-    sample_30_idxs = [7, 66, 132, 139, 207, 230, 251, 313, 340, 376, 386, 389, 415, 428, 597, 746, 774, 788, 822, 854, 900, 1111, 1142, 1150, 1197, 1231, 1322, 1458, 1492, 1495]
-    sample_50_idxs = [7, 53, 66, 107, 132, 139, 167, 195, 207, 230, 251, 313, 340, 376, 386, 389, 415, 418, 428, 439, 517, 532, 597, 630, 641, 660, 674, 701, 746, 774, 788, 802, 822, 854, 900, 1111, 1142, 1145, 1150, 1197, 1231, 1322, 1335, 1362, 1377, 1439, 1458, 1492, 1493, 1495]
-    sample_100_idxs = [7, 21, 53, 66, 86, 107, 132, 139, 157, 166, 167, 168, 195, 207, 230, 248, 251, 312, 313, 340, 352, 363, 365, 376, 386, 389, 394, 415, 418, 428, 431, 439, 470, 482, 517, 532, 597, 619, 630, 641, 657, 659, 660, 664, 674, 686, 689, 701, 744, 745, 746, 774, 788, 802, 813, 822, 838, 840, 842, 847, 854, 857, 870, 878, 880, 900, 913, 928, 942, 954, 997, 1069, 1111, 1114, 1118, 1120, 1142, 1145, 1150, 1151, 1167, 1184, 1197, 1231, 1246, 1322, 1330, 1335, 1345, 1362, 1377, 1384, 1434, 1439, 1458, 1461, 1492, 1493, 1495, 1496]
-
-  
-    if args.sample_30:
-        sample_idxs = sample_30_idxs
-    if args.sample_50:
-        sample_idxs = sample_50_idxs
-    elif args.sample_100:
-        sample_idxs = sample_100_idxs
-    elif args.sample_20:
-        sample_idxs = sample_20_idxs
-    elif args.start_index or args.end_index:
-        sample_idxs = [i for i in range(args.start_index, args.end_index+1)]
-    else:
-        print("wrong sample index provided")
-        exit()
+    sample_idxs = select_users(args)
     
     base_path = "output/evaluation"
 
+    if args.combined or args.agreement:
+        split_path = "output/evaluation_combined"
+        # The combined judge rates every dimension, task completion included
+        args.model_id_eval = model_id_eval = args.model_id_eval or "claude-3-5-sonnet-v2"
+        split, unparsed = split_combined_results(sample_idxs, base_path=base_path, split_path=split_path,
+                                                 model_id_asst=args.model_id_asst, model_id_eval=model_id_eval)
+        logging.info(f"Split {split} combined evaluations into {split_path}")
+        for file_path in unparsed:
+            print(f"Combined evaluation does not follow the response format: {file_path}")
+        if args.agreement:
+            agreement = judge_agreement(sample_idxs, base_path=base_path, split_path=split_path,
+                                        model_id_asst=args.model_id_asst, model_id_eval=model_id_eval,
+                                        multi_domain=args.multi_domain)
+            print("\nAgreement of the combined judge with the single-dimension judges:")
+            for name, stats in agreement.items():
+                if 'within_one' in stats:
+                    print(f"{name}: {stats['count']} dialogues, exact {stats['agreement'] * 100:.1f}%, "
+                          f"within one {stats['within_one'] * 100:.1f}%, average {stats['single_average']:.2f} "
+                          f"single vs {stats['combined_average']:.2f} combined")
+                else:
+                    print(f"{name}: {stats['count']} dialogues, agreement {stats['agreement'] * 100:.1f}%, "
+                          f"completion rate {stats['single_tc_rate'] * 100:.1f}% single vs "
+                          f"{stats['combined_tc_rate'] * 100:.1f}% combined")
+            return
+        base_path = split_path
+
     if args.eval_dimension == "task_completion":
         results = analyze_task_completion_ratings(
             sample_idxs, 
             base_path=base_path, 
             model_id_asst=args.model_id_asst, 
-            model_id_eval="claude-3-sonnet-v1",
+            model_id_eval=args.model_id_eval or "claude-3-sonnet-v1",
             multi_domain=args.multi_domain)
         
         # Print summary
@@ -310,7 +414,7 @@ def main():
             sample_idxs, 
             base_path=base_path, 
             model_id_asst=args.model_id_asst, 
-            model_id_eval="claude-3-5-sonnet-v2",
+            model_id_eval=args.model_id_eval or "claude-3-5-sonnet-v2",
             matching_string_score=matching_string_score, # Naturalness Score, Coherence Score, Personalization Score
             dimension=args.eval_dimension, # naturalness, coherence, personalization
             file_ext=args.file_ext,
@@ -0,0 +1,134 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import diskcache
+from util.prompt_caching import PromptParts
+
+EVICTION_POLICIES = ['least-recently-used', 'least-frequently-used', 'least-recently-stored']
+DEFAULT_SIZE_LIMIT_GB = float(os.environ.get("LLM_CACHE_SIZE_LIMIT_GB", 4))
+DEFAULT_EVICTION_POLICY = os.environ.get("LLM_CACHE_EVICTION_POLICY", 'least-recently-used')
+
+
+def is_deterministic(temperature) -> bool:
+    """Only greedy (temperature 0) completions are reproducible, so only those may be served from cache."""
+    return temperature == 0
+
+
+def make_cache_key(model_id: str, messages, system_prompt: str = "", temperature=None, max_tokens=None, **params) -> str:
+    """
+    Build the response cache key of a request.
+
+    The key is the SHA-256 digest of the canonical request, covering
+    everything that influences the completion: the model, the system
+    prompt, the sampling parameters and the messages. Prompts split for
+    prompt caching share the key of the unsplit prompt.
+    """
+    if isinstance(messages, PromptParts):
+        messages = messages.text()
+    elif isinstance(messages, list):
+        messages = [{**msg, "content": msg["content"].text()} if isinstance(msg.get("content"), PromptParts) else msg
+                    for msg in messages]
+    canonical = json.dumps({
+        "model_id": model_id,
+        "system": system_prompt,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "params": params,
+        "messages": messages,
+    }, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory, size_limit_gb=DEFAULT_SIZE_LIMIT_GB, eviction_policy=DEFAULT_EVICTION_POLICY):
+        """
+        Size-bounded on-disk response cache with hit/miss/write/eviction counters.
+
+        Evictions are derived from the entry count when the cache was opened,
+        the entries added since and the entry count now, so they are only
+        exact if no other process writes to the same directory meanwhile.
+
+        Args:
+            directory: Cache directory, one per model
+            size_limit_gb: Size cap of the directory; entries are evicted beyond it
+            eviction_policy: One of EVICTION_POLICIES
+        """
+        assert eviction_policy in EVICTION_POLICIES, f"Unknown eviction policy: {eviction_policy}"
+        self.directory = directory
+        self.cache = diskcache.Cache(directory, size_limit=int(size_limit_gb * 1024 ** 3),
+                                     eviction_policy=eviction_policy)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.initial_entries = len(self.cache)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.cache.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        # diskcache culls old entries while storing once the directory exceeds its size limit.
+        # Responses are deterministic, so an entry another worker stored meanwhile is kept as is.
+        added = self.cache.add(key, value)
+        with self._lock:
+            self.writes += added
+
+    def stats(self):
+        with self._lock:
+            entries = len(self.cache)
+            return {
+                "directory": self.directory,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": max(0, self.initial_entries + self.writes - entries),
+                "entries": entries,
+                "size_mb": self.cache.volume() / 1024 ** 2,
+            }
+
+
+_cache_options = {"size_limit_gb": DEFAULT_SIZE_LIMIT_GB, "eviction_policy": DEFAULT_EVICTION_POLICY}
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def configure_response_cache(**options):
+    """Set `size_limit_gb` and/or `eviction_policy` for caches opened afterwards."""
+    unknown = set(options) - set(_cache_options)
+    assert not unknown, f"Unsupported response cache options: {sorted(unknown)}"
+    with _caches_lock:
+        _cache_options.update(options)
+
+
+def get_response_cache(directory):
+    """Return the process-wide response cache stored in `directory`."""
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = ResponseCache(directory, **_cache_options)
+            _caches[directory] = cache
+    return cache
+
+
+def log_cache_stats():
+    """Log the counters of every response cache used in this run."""
+    for cache in list(_caches.values()):
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        if not lookups and not stats['writes']:
+            continue
+        hit_rate = stats['hits'] / lookups if lookups else 0
+        logging.info(f"Response cache {stats['directory']}: {stats['hits']} hits, {stats['misses']} misses "
+                     f"({hit_rate:.1%} hit rate), {stats['writes']} writes, {stats['evictions']} evictions, "
+                     f"{stats['entries']} entries, {stats['size_mb']:.1f} MB")
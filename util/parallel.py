@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+
+def imap_unordered(fn: Callable, jobs: Iterable, workers: int,
+                   max_pending: Optional[int] = None) -> Iterator[Tuple[Any, Any, Optional[BaseException]]]:
+    """
+    Apply `fn` to every job on a thread pool and yield results as they finish.
+
+    Jobs are pulled lazily from `jobs`, so at most `max_pending` (default
+    2 * workers) of them are materialized at any time.
+
+    Args:
+        fn: Callable taking a single job
+        jobs: Iterable of jobs
+        workers: Number of worker threads
+        max_pending: Maximum number of submitted but unfinished jobs
+
+    Yields:
+        Tuple of (job, result, exception); exactly one of result/exception is set
+    """
+    assert workers > 0, "workers must be positive"
+    max_pending = max_pending or 2 * workers
+    jobs = iter(jobs)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    job = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[pool.submit(fn, job)] = job
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                exception = future.exception()
+                yield job, (None if exception else future.result()), exception
@@ -0,0 +1,270 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Packed store of the user profiles and tasks under data/profile.
+
+Build it once with `python3 -m util.profile_store`; generation and evaluation
+then read profiles and tasks from the memory-mapped pack instead of parsing
+three JSON files per user, and fall back to those files if there is no pack.
+
+Pack layout (little endian):
+    header      magic, format version, user count, user table offset,
+                task catalog offset and length, source offset and length
+    records     compact UTF-8 JSON of every profile, every per-user entry,
+                the task catalog and the source signature
+    user table  (user id, entry offset, entry length) rows sorted by user id
+
+Tasks are stored normalized (see `util.task_catalog`): the catalog holds each
+task definition once, and a user entry holds the offset, length and source
+digest of the user's profile plus the (task_id, situations) rows of each of
+their task files, which `tasks()` expands back into the task file content.
+
+The source signature records the directories the pack was built from and the
+sizes and mtimes of their files; `get_profile_store` reads those files instead
+of a pack they have changed since.
+"""
+
+import os
+import re
+import glob
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+from os import path
+from util.task_catalog import TASK_DIR, UserTasks, expand_task, load_task_catalog, normalize_tasks
+
+PROFILE_DIR = "data/profile"
+PROFILE_STORE_PATH = os.environ.get("PROFILE_STORE", "data/profile.pack")
+
+MAGIC = b"PLSTORE\x00"
+FORMAT_VERSION = 3
+_HEADER = struct.Struct("<8sIIQQIQI")
+_USER_ROW = struct.Struct("<qQI")
+TASK_FILES = {False: "tasks.json", True: "tasks_md.json"}
+
+
+class ProfileStore:
+    def __init__(self, store_path=PROFILE_STORE_PATH):
+        """
+        Read-only view of a pack built by `build_profile_store`.
+
+        The file is memory-mapped, so worker processes share its pages, and
+        every profile, or all task rows of a user, is one slice and one
+        `json.loads` away.
+        """
+        self.path = store_path
+        with open(store_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from("<8sI", self._map, 0)
+        assert magic == MAGIC, f"{store_path} is not a profile store"
+        assert version == FORMAT_VERSION, f"{store_path} has format {version}, rebuild it with `python3 -m util.profile_store`"
+        _, _, count, table_offset, catalog_offset, catalog_length, source_offset, source_length = \
+            _HEADER.unpack_from(self._map, 0)
+        self._users = {user_id: (offset, length) for user_id, offset, length in
+                       _USER_ROW.iter_unpack(self._map[table_offset:table_offset + count * _USER_ROW.size])}
+        self.catalog = self._record(catalog_offset, catalog_length)
+        self.source = self._record(source_offset, source_length)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _record(self, offset, length):
+        return json.loads(self._map[offset:offset + length].decode('utf-8'))
+
+    def _entry(self, user_id):
+        user_id = int(user_id)
+        entry = self._entries.get(user_id)
+        if entry is None:
+            if user_id not in self._users:
+                raise KeyError(f"User {user_id} is not in {self.path}")
+            entry = self._record(*self._users[user_id])
+            entry["by_task_id"] = {row[0]: row for kind in ("tasks", "tasks_md") for row in entry[kind]}
+            with self._lock:
+                self._entries[user_id] = entry
+        return entry
+
+    def user_ids(self):
+        return sorted(self._users)
+
+    def profile(self, user_id) -> dict:
+        offset, length, _ = self._entry(user_id)["profile"]
+        return self._record(offset, length)
+
+    def profile_digest(self, user_id) -> str:
+        """SHA-256 of the user's profile.json as packed."""
+        return self._entry(user_id)["profile"][2]
+
+    def task_rows(self, user_id, multi_domain=False) -> list:
+        """The user's (task_id, situations[, overrides]) rows against `catalog`."""
+        return self._entry(user_id)["tasks_md" if multi_domain else "tasks"]
+
+    def tasks(self, user_id, multi_domain=False) -> UserTasks:
+        """The user's tasks.json (or tasks_md.json) content, keyed as in the file and expanded lazily."""
+        return UserTasks(self.task_rows(user_id, multi_domain), self.catalog)
+
+    def task(self, user_id, task_id) -> dict:
+        return expand_task(self._entry(user_id)["by_task_id"][task_id], self.catalog)
+
+    def is_stale(self) -> bool:
+        """Whether the files the pack was built from changed since; False if they are not around."""
+        if not (path.isdir(self.source["profile_dir"]) and path.isdir(self.source["task_dir"])):
+            return False
+        source = JsonProfileStore(self.source["profile_dir"], self.source["task_dir"])
+        return source.source_signature() != self.source["signature"]
+
+    def close(self):
+        self._map.close()
+
+
+class JsonProfileStore:
+    def __init__(self, profile_dir=PROFILE_DIR, task_dir=TASK_DIR):
+        """The `ProfileStore` interface over the per-user JSON files, for trees without a pack."""
+        self.profile_dir = profile_dir
+        self.task_dir = task_dir
+        self._catalog = None
+        self._digests = {}
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = load_task_catalog(self.task_dir)
+        return self._catalog
+
+    def _file(self, user_id, name):
+        return path.join(self.profile_dir, f"user{user_id}", name)
+
+    def user_ids(self):
+        return sorted(int(name[4:]) for name in os.listdir(self.profile_dir) if re.fullmatch(r"user\d+", name))
+
+    def profile(self, user_id) -> dict:
+        with open(self._file(user_id, "profile.json")) as f:
+            return json.load(f)
+
+    def profile_digest(self, user_id) -> str:
+        """SHA-256 of the user's profile.json, recomputed when its size or mtime changes."""
+        profile_file = self._file(user_id, "profile.json")
+        stat = os.stat(profile_file)
+        cached = self._digests.get(profile_file)
+        if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+            with open(profile_file, 'rb') as f:
+                cached = ((stat.st_mtime_ns, stat.st_size), hashlib.sha256(f.read()).hexdigest())
+            self._digests[profile_file] = cached
+        return cached[1]
+
+    def tasks(self, user_id, multi_domain=False) -> dict:
+        with open(self._file(user_id, TASK_FILES[multi_domain])) as f:
+            return json.load(f)
+
+    def task_rows(self, user_id, multi_domain=False) -> list:
+        return normalize_tasks(self.tasks(user_id, multi_domain), self.catalog)
+
+    def source_signature(self) -> list:
+        """Number of profile, task and task definition files, and a digest of their paths, sizes and mtimes."""
+        # Editing a file in place does not touch its directory's mtime, so stat every file
+        files = [self._file(user_id, name) for user_id in self.user_ids()
+                 for name in ("profile.json", *TASK_FILES.values())]
+        files += sorted(glob.glob(path.join(self.task_dir, "*", "task.jsonl")))
+        digest = hashlib.sha256()
+        count = 0
+        for file in files:
+            if path.exists(file):
+                stat = os.stat(file)
+                digest.update(f"{file}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+                count += 1
+        return [count, digest.hexdigest()]
+
+    def task(self, user_id, task_id) -> dict:
+        for multi_domain in (False, True):
+            for task in self.tasks(user_id, multi_domain).values():
+                if task['task_id'] == task_id:
+                    return task
+        raise KeyError(f"Task {task_id} of user {user_id} not found in {self.profile_dir}")
+
+    def close(self):
+        pass
+
+
+def build_profile_store(profile_dir=PROFILE_DIR, store_path=PROFILE_STORE_PATH, task_dir=TASK_DIR):
+    """
+    Pack every user{id}/ directory of `profile_dir` into `store_path`, with tasks normalized
+    against the definitions under `task_dir`; returns the number of users.
+    """
+    source = JsonProfileStore(profile_dir, task_dir)
+    user_ids = source.user_ids()
+    # Taken before reading, so files edited while packing make the pack stale rather than silently current
+    signed = JsonProfileStore(path.abspath(profile_dir), path.abspath(task_dir))
+    signature = {"profile_dir": signed.profile_dir, "task_dir": signed.task_dir, "signature": signed.source_signature()}
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b"\0" * _HEADER.size)
+
+        def encode(data):
+            return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+        def write(encoded):
+            offset = f.tell()
+            f.write(encoded)
+            return offset, len(encoded)
+
+        rows = []
+        for user_id in user_ids:
+            with open(source._file(user_id, "profile.json"), 'rb') as profile_file:
+                raw = profile_file.read()
+            entry = {"profile": [*write(encode(json.loads(raw))), hashlib.sha256(raw).hexdigest()]}
+            for kind, multi_domain in (("tasks", False), ("tasks_md", True)):
+                entry[kind] = source.task_rows(user_id, multi_domain)
+            rows.append((user_id, *write(encode(entry))))
+
+        # Written last, as tasks missing from the task files are added to it while normalizing
+        catalog = write(encode(source.catalog))
+        source_record = write(encode(signature))
+        table_offset = f.tell()
+        for row in rows:
+            f.write(_USER_ROW.pack(*row))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(rows), table_offset, *catalog, *source_record))
+    os.replace(tmp_path, store_path)
+    return len(rows)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_profile_store():
+    """
+    Return the process-wide profile store: the pack at $PROFILE_STORE if built
+    and current, else the JSON files.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            if path.exists(PROFILE_STORE_PATH):
+                _store = ProfileStore(PROFILE_STORE_PATH)
+                if _store.is_stale():
+                    logging.warning(f"Profiles or tasks changed since {PROFILE_STORE_PATH} was built, reading "
+                                    f"{_store.source['profile_dir']} instead (rebuild it with `python3 -m util.profile_store`)")
+                    source = _store.source
+                    _store.close()
+                    _store = JsonProfileStore(source["profile_dir"], source["task_dir"])
+            else:
+                logging.info(f"No profile store at {PROFILE_STORE_PATH}, reading {PROFILE_DIR} "
+                             f"(build one with `python3 -m util.profile_store`)")
+                _store = JsonProfileStore(PROFILE_DIR)
+    return _store
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt="%Y-%m-%d %H:%M")
+    parser = argparse.ArgumentParser(description="Pack the user profiles and tasks into a memory-mappable store.")
+    parser.add_argument("--profile_dir", type=str, default=PROFILE_DIR, help="Directory holding the user{id}/ profile folders.")
+    parser.add_argument("--task_dir", type=str, default=TASK_DIR, help="Directory holding the <Domain>/task.jsonl task definitions.")
+    parser.add_argument("--output", type=str, default=PROFILE_STORE_PATH, help="Path of the store to write.")
+    args = parser.parse_args()
+
+    count = build_profile_store(args.profile_dir, args.output, args.task_dir)
+    logging.info(f"Packed {count} users into {args.output} ({path.getsize(args.output) / 2**20:.0f} MB)")
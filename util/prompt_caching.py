@@ -0,0 +1,110 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import re
+
+# Bedrock models accepting `cache_control` checkpoints, without the cross-region inference prefix
+PROMPT_CACHING_MODELS = {
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-5-sonnet-20241022-v2:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
+}
+# Shortest prefix, in tokens, a checkpoint caches; shorter prefixes are processed as usual and never cached
+PROMPT_CACHE_MIN_TOKENS = {
+    "anthropic.claude-3-5-haiku-20241022-v1:0": 2048,
+    "anthropic.claude-3-5-sonnet-20241022-v2:0": 1024,
+    "anthropic.claude-3-7-sonnet-20250219-v1:0": 1024,
+}
+# Rough prompt length per token, as in util.rate_limiter.estimate_tokens
+CHARS_PER_TOKEN = 4
+CACHE_CONTROL = {"type": "ephemeral"}
+# Bedrock accepts at most this many checkpoints per request
+MAX_CHECKPOINTS = 4
+
+
+class PromptParts(list):
+    """A single prompt split into text parts; every part but the last is a static prefix worth caching."""
+
+    def text(self):
+        return "".join(self)
+
+
+def _base_model_id(model_id):
+    if model_id.split(".", 1)[0] in ("us", "eu", "apac"):
+        return model_id.split(".", 1)[1]
+    return model_id
+
+
+def supports_prompt_caching(model_id) -> bool:
+    return _base_model_id(model_id) in PROMPT_CACHING_MODELS
+
+
+def prompt_cache_min_tokens(model_id) -> int:
+    return PROMPT_CACHE_MIN_TOKENS.get(_base_model_id(model_id), 1024)
+
+
+def split_template(template, placeholder=None):
+    """
+    Split a str.format template before the line holding `placeholder` (the first placeholder by default).
+
+    Returns:
+        Tuple of (static_prefix, rest), where the prefix holds no placeholders and
+        `static_prefix + rest.format(**kwargs) == template.format(**kwargs)`
+    """
+    pattern = r"\{%s\}" % (re.escape(placeholder) if placeholder else r"[a-z_]+")
+    match = re.search(pattern, template)
+    if match is None:
+        return template.format(), ""
+    cut = template.rfind("\n", 0, match.start()) + 1
+    return template[:cut].format(), template[cut:]
+
+
+def split_prompt(prompt, dynamic):
+    """Split a rendered prompt before the last occurrence of its `dynamic` text, e.g. the dialogue history."""
+    cut = prompt.rfind(dynamic) if dynamic else -1
+    if cut <= 0:
+        return PromptParts([prompt])
+    return PromptParts([prompt[:cut], prompt[cut:]])
+
+
+def claude_content(content, prompt_caching):
+    """Convert message content (str or PromptParts) into Claude text blocks, checkpointing the static parts."""
+    if not isinstance(content, PromptParts):
+        parts = [content]
+    else:
+        parts = content if prompt_caching else [content.text()]
+    blocks = [{"type": "text", "text": part} for part in parts if part]
+    if prompt_caching:
+        for block in blocks[:-1]:
+            block["cache_control"] = CACHE_CONTROL
+    return blocks
+
+
+def claude_request(system_prompt, messages, prompt_caching, min_tokens=0):
+    """
+    Build the `system` and `messages` fields of a Claude request.
+
+    With prompt caching, checkpoints go on the system prompt, on the static
+    parts of PromptParts content and, for dialogues, on the last message, so
+    the next turn reads the whole history so far from the cache. Checkpoints
+    ending a prefix shorter than `min_tokens` (see `prompt_cache_min_tokens`)
+    are left out, as the model would not cache it anyway.
+    """
+    formatted_messages = [{"role": msg["role"], "content": claude_content(msg["content"], prompt_caching)}
+                          for msg in messages]
+    if not prompt_caching:
+        return system_prompt, formatted_messages
+    system = [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}] if system_prompt else system_prompt
+    if len(formatted_messages) > 1 and formatted_messages[-1]["content"]:
+        formatted_messages[-1]["content"][-1]["cache_control"] = CACHE_CONTROL
+    prefix_chars = 0
+    for block in (system if system_prompt else []) + [block for msg in formatted_messages for block in msg["content"]]:
+        prefix_chars += len(block["text"])
+        if "cache_control" in block and prefix_chars // CHARS_PER_TOKEN < min_tokens:
+            del block["cache_control"]
+    # Drop the earliest message checkpoints if there are too many; the last one covers everything before it
+    checkpoints = [block for msg in formatted_messages for block in msg["content"] if "cache_control" in block]
+    excess = len(checkpoints) + bool(system_prompt and "cache_control" in system[0]) - MAX_CHECKPOINTS
+    for block in checkpoints[:max(0, excess)]:
+        del block["cache_control"]
+    return system, formatted_messages
@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+from util.prompt_caching import PromptParts
+
+HISTORY_FIELD = "message_history"
+# Cannot occur in rendered profiles or tasks, so it marks where the history goes
+_HISTORY_MARK = "\x00" + HISTORY_FIELD + "\x00"
+
+
+class BoundPrompt:
+    def __init__(self, template, format_message, detached_history="", **fields):
+        """
+        A prompt template with every field but the dialogue history filled in once per dialogue.
+
+        The rendered history is kept as a buffer that each call extends with
+        the messages added since the previous one, so a turn only formats its
+        new messages and concatenates the pre-rendered sections around them.
+
+        Args:
+            template: str.format template, with or without a {message_history} field
+            format_message: Function rendering one history message as a line
+            detached_history: Stands in for the history when it is sent as separate messages
+            fields: Values of the other fields of `template`
+        """
+        rendered = template.format(**{HISTORY_FIELD: _HISTORY_MARK}, **fields)
+        self.prefix, mark, self.suffix = rendered.partition(_HISTORY_MARK)
+        self.has_history = bool(mark)
+        self.format_message = format_message
+        self.detached_history = detached_history
+        self._sources = []
+        self._lines = []
+        self._history = ""
+
+    def history(self, message_history):
+        """Render `message_history`, formatting only the messages not rendered by the previous call."""
+        # Keep the lines of the leading messages left unchanged: usually all of them, or all but the
+        # latest, which the simulator edits in place to strip TERMINATE
+        count = 0
+        while count < min(len(self._sources), len(message_history)) and \
+                self._sources[count] == (message_history[count]["role"], message_history[count]["content"]):
+            count += 1
+        if count < len(self._sources):
+            del self._sources[count:], self._lines[count:]
+            self._history = "\n".join(self._lines)
+        for msg in message_history[count:]:
+            line = self.format_message(msg)
+            self._history = self._history + "\n" + line if self._lines else line
+            self._sources.append((msg["role"], msg["content"]))
+            self._lines.append(line)
+        return self._history
+
+    def format(self, message_history=None, split_prefix=False):
+        """
+        Render the prompt for `message_history`, or with `detached_history` in its place if None.
+
+        With `split_prefix`, return PromptParts split before the history, so the
+        static context ahead of it can be read from the prompt cache.
+        """
+        if not self.has_history:
+            return self.prefix
+        history = self.detached_history if message_history is None else self.history(message_history)
+        if split_prefix and history and self.prefix:
+            return PromptParts([self.prefix, history + self.suffix])
+        return self.prefix + history + self.suffix
@@ -0,0 +1,201 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+import threading
+from os import path
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows, limiter is then only shared across threads
+    fcntl = None
+
+RATE_LIMITS_PATH = os.environ.get(
+    "BEDROCK_RATE_LIMITS", path.join(path.dirname(path.dirname(path.abspath(__file__))), 'res', 'rate_limits.json'))
+STATE_DIR = os.environ.get("BEDROCK_RATE_LIMIT_DIR", path.join(tempfile.gettempdir(), 'personalens-rate-limits'))
+
+
+def estimate_tokens(body: str, max_tokens: int) -> int:
+    """Rough token cost of a request: ~4 characters per input token plus the full output budget."""
+    return len(body) // 4 + max_tokens
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, model_id, requests_per_minute=None, tokens_per_minute=None, state_dir=STATE_DIR,
+                 burst_seconds=2.0, min_rate=0.05, increase=0.01, decrease=0.5, cooldown=2.0,
+                 idle_reset=300.0):
+        """
+        Token bucket limiter over requests/min and tokens/min with AIMD adaptation.
+
+        The effective rate is a fraction of the configured quota. Every
+        ThrottlingException multiplies it by `decrease` (at most once per
+        `cooldown` seconds, so a burst of throttles from many workers counts
+        once) and every success adds `increase` back, up to the full quota.
+        The bucket state lives in a lock-protected file under `state_dir`,
+        so all threads and processes on the host draw from the same budget.
+        State left idle for `idle_reset` seconds, e.g. by an earlier run, or
+        that cannot be parsed, e.g. after a crash mid-write, starts over at
+        the full quota.
+
+        Args:
+            model_id: Bedrock model id the quota applies to
+            requests_per_minute: Request quota, or None for no request limit
+            tokens_per_minute: Token quota, or None for no token limit
+            state_dir: Directory holding the shared bucket state
+            burst_seconds: Bucket capacity, in seconds worth of quota
+            min_rate: Lower bound on the fraction of the quota in use
+            increase: Fraction of the quota added back after each success
+            decrease: Factor applied to the rate on throttling
+            cooldown: Minimum seconds between two rate decreases
+            idle_reset: Seconds without any call after which the state starts over
+        """
+        self.model_id = model_id
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.idle_reset = idle_reset
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = path.join(state_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', model_id) + '.json')
+        self._lock = threading.Lock()
+
+    def _per_second(self, per_minute, state):
+        return per_minute / 60 * state['rate']
+
+    def _capacity(self, per_minute, state):
+        return max(1.0, self._per_second(per_minute, state) * self.burst_seconds)
+
+    def _initial_state(self, now):
+        return {'rate': 1.0, 'updated': now, 'last_throttle': 0.0,
+                'requests': self._capacity(self.requests_per_minute or 60, {'rate': 1.0}),
+                'tokens': self._capacity(self.tokens_per_minute or 60, {'rate': 1.0})}
+
+    def _load_state(self, raw, now):
+        try:
+            state = json.loads(raw)
+            if now - state['updated'] <= self.idle_reset:
+                return state
+        except (ValueError, TypeError, KeyError):
+            logging.warning(f"Resetting unreadable rate limiter state {self.state_path}")
+        return self._initial_state(now)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['updated'] = now
+        for key, per_minute in (('requests', self.requests_per_minute), ('tokens', self.tokens_per_minute)):
+            if per_minute:
+                state[key] = min(self._capacity(per_minute, state),
+                                 state[key] + elapsed * self._per_second(per_minute, state))
+
+    @contextmanager
+    def _state(self):
+        """Lock the shared bucket state, refill it and write it back on exit."""
+        with self._lock, open(self.state_path, 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                now = time.time()
+                state = self._load_state(raw, now) if raw else self._initial_state(now)
+                self._refill(state, now)
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, tokens=0):
+        """
+        Block until one request of `tokens` tokens fits in the quota.
+
+        Returns:
+            Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._state() as state:
+                delay = 0.0
+                if self.requests_per_minute and state['requests'] < 1:
+                    delay = (1 - state['requests']) / self._per_second(self.requests_per_minute, state)
+                if self.tokens_per_minute:
+                    # Requests larger than the bucket are let through once it is full and drive it negative
+                    needed = min(tokens, self._capacity(self.tokens_per_minute, state))
+                    if state['tokens'] < needed:
+                        delay = max(delay, (needed - state['tokens']) / self._per_second(self.tokens_per_minute, state))
+                if delay == 0.0:
+                    state['requests'] -= 1
+                    state['tokens'] -= tokens
+                    return waited
+            delay = min(max(delay, 0.01), 5.0)
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        with self._state() as state:
+            state['rate'] = min(1.0, state['rate'] + self.increase)
+
+    def on_throttle(self):
+        with self._state() as state:
+            now = time.time()
+            if now - state['last_throttle'] >= self.cooldown:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                state['last_throttle'] = now
+                logging.warning(f"[ThrottlingException] Reducing {self.model_id} rate to {state['rate']:.0%} of quota.")
+            # Empty the buckets so every worker pauses, not just the one that got throttled
+            state['requests'] = min(state['requests'], 0.0)
+            state['tokens'] = min(state['tokens'], 0.0)
+
+
+_rate_limits = None
+_limiters = {}
+_registry_lock = threading.Lock()
+
+
+def configure_rate_limits(rate_limits=RATE_LIMITS_PATH, state_dir=STATE_DIR):
+    """
+    Set the per-model quotas used by `get_rate_limiter`.
+
+    Args:
+        rate_limits: Path to a JSON file, or a dict, mapping model ids (and
+            "default") to {"requests_per_minute", "tokens_per_minute"}; None
+            disables rate limiting
+        state_dir: Directory holding the shared bucket state
+    """
+    global _rate_limits, STATE_DIR
+    if isinstance(rate_limits, str):
+        with open(rate_limits) as f:
+            rate_limits = json.load(f)
+    with _registry_lock:
+        _rate_limits = rate_limits
+        STATE_DIR = state_dir
+        _limiters.clear()
+
+
+def get_rate_limiter(model_id):
+    """Return the shared limiter of `model_id`, or None if rate limiting is disabled."""
+    if _rate_limits is None:
+        return None
+    limiter = _limiters.get(model_id)
+    if limiter is None:
+        with _registry_lock:
+            limiter = _limiters.get(model_id)
+            if limiter is None:
+                quota = _rate_limits.get(model_id, _rate_limits.get("default"))
+                if quota is None:
+                    return None
+                limiter = AdaptiveRateLimiter(model_id, state_dir=STATE_DIR, **quota)
+                _limiters[model_id] = limiter
+    return limiter
@@ -0,0 +1,259 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
+from util.rate_limiter import get_rate_limiter
+from util.telemetry import get_telemetry, response_usage
+
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", 8))
+DEFAULT_CALL_DEADLINE = float(os.environ.get("BEDROCK_CALL_DEADLINE", 900))
+
+# Errors worth retrying after a backoff; anything else is raised immediately
+TRANSIENT_ERRORS = {'ModelErrorException', 'ServiceUnavailableException', 'ModelTimeoutException',
+                    'InternalServerException', 'ModelNotReadyException', 'ModelStreamErrorException'}
+# Errors that indicate Bedrock itself is unhealthy and count towards opening the circuit
+OUTAGE_ERRORS = {'ServiceUnavailableException', 'InternalServerException', 'ConnectionError'}
+
+_conversation_deadline = contextvars.ContextVar("conversation_deadline", default=None)
+
+
+class RetryError(Exception):
+    pass
+
+
+@contextmanager
+def conversation_deadline(seconds):
+    """Bound the total time spent in Bedrock calls made inside this block; None means no bound."""
+    token = _conversation_deadline.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _conversation_deadline.reset(token)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=10, reset_timeout=30.0, max_reset_timeout=600.0):
+        """
+        Process-wide circuit breaker over consecutive outage errors.
+
+        After `failure_threshold` outage errors in a row the circuit opens
+        and every caller sleeps until `reset_timeout` has passed. A single
+        trial call is then let through; if it fails again the timeout
+        doubles (up to `max_reset_timeout`).
+        """
+        self.failure_threshold = failure_threshold
+        self.initial_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    def wait(self, deadline=None):
+        """
+        Block while the circuit is open; returns once this caller may send a request.
+
+        Returns:
+            None, or an id of the trial call granted to this caller if the circuit is open,
+            which must be handed to `release_trial` once the call is over
+
+        Raises RetryError if `deadline` (a time.monotonic() value) passes first.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.failures < self.failure_threshold:
+                    return None
+                if deadline is not None and now > deadline:
+                    raise RetryError("Deadline exceeded waiting for the Bedrock circuit to close.")
+                if now >= self.open_until and not self.trial_in_flight:
+                    self.trial_in_flight = True
+                    self._trials += 1
+                    return self._trials
+                delay = max(self.open_until - now, 1.0)
+                if deadline is not None:
+                    delay = min(delay, max(deadline - now, 0.01))
+            time.sleep(min(delay, 5.0))
+
+    def release_trial(self, trial):
+        """Hand back trial `trial` if no outcome was recorded for it, e.g. the call raised an unrelated error."""
+        with self._lock:
+            if trial is not None and self.trial_in_flight and self._trials == trial:
+                self.trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self.failures >= self.failure_threshold:
+                logging.info("Bedrock circuit closed, resuming.")
+            self.failures = 0
+            self.trial_in_flight = False
+            self.reset_timeout = self.initial_reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight:
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.reset_timeout
+                logging.warning(f"Bedrock circuit open after {self.failures} consecutive failures, "
+                                f"pausing calls for {self.reset_timeout:.0f}s.")
+
+
+class RetryEngine:
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, call_deadline=DEFAULT_CALL_DEADLINE,
+                 base_delay=0.5, max_delay=30.0, circuit_breaker=None):
+        """
+        Bounded, iterative retries for Bedrock calls.
+
+        Transient errors are retried with full-jitter exponential backoff up
+        to `max_attempts` times. Throttling is handed to the shared rate
+        limiter (or backed off when there is none) and only bounded by the
+        deadlines. Expired credentials trigger a session refresh.
+
+        Args:
+            max_attempts: Maximum number of attempts for non-throttling errors
+            call_deadline: Maximum seconds spent on a single call, retries included
+            base_delay: Backoff ceiling of the first retry
+            max_delay: Upper bound of the backoff ceiling
+            circuit_breaker: Shared CircuitBreaker, a new one by default
+        """
+        self.max_attempts = max_attempts
+        self.call_deadline = call_deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _deadline(self, start):
+        deadline = start + self.call_deadline if self.call_deadline else None
+        conversation = _conversation_deadline.get()
+        if conversation is not None:
+            deadline = conversation if deadline is None else min(deadline, conversation)
+        return deadline
+
+    def _sleep(self, delay, deadline, model_id, reason):
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise RetryError(f"Deadline exceeded calling {model_id} ({reason}).")
+        time.sleep(delay)
+
+    def call(self, fn, model_id, tokens=0, refresh=None):
+        """
+        Call `fn` until it succeeds or the retry budget is spent.
+
+        Args:
+            fn: Zero-argument callable sending the request
+            model_id: Bedrock model id, used for rate limiting and logging
+            tokens: Estimated token cost of the request
+            refresh: Callable recreating the session after ExpiredTokenException
+
+        Returns:
+            The return value of `fn`
+        """
+        stats = {"attempts": 0, "throttles": 0, "throttle_wait": 0.0, "backoff_wait": 0.0}
+        start = time.monotonic()
+        try:
+            response = self._call(fn, model_id, tokens, refresh, start, stats)
+        except Exception as e:
+            get_telemetry().record(model_id, time.monotonic() - start, error=str(e), **stats)
+            raise
+        get_telemetry().record(model_id, time.monotonic() - start, **response_usage(response), **stats)
+        return response
+
+    def _call(self, fn, model_id, tokens, refresh, start, stats):
+        rate_limiter = get_rate_limiter(model_id)
+        deadline = self._deadline(start)
+        attempt = 0
+        while True:
+            trial = self.circuit_breaker.wait(deadline)
+            try:
+                if rate_limiter is not None:
+                    stats["throttle_wait"] += rate_limiter.acquire(tokens)
+                if deadline is not None and time.monotonic() > deadline:
+                    raise RetryError(f"Deadline exceeded calling {model_id}.")
+                stats["attempts"] += 1
+                try:
+                    response = fn()
+                except ClientError as e:
+                    code = e.response['Error']['Code']
+                    # Errors raised mid-stream (EventStreamError) carry lower camel case codes, e.g. throttlingException
+                    code = code[:1].upper() + code[1:]
+                except (ConnectionError, ReadTimeoutError) as e:
+                    code = 'ConnectionError'
+                    logging.warning(f"{type(e).__name__} calling {model_id}: {e}")
+                else:
+                    self.circuit_breaker.record_success()
+                    if rate_limiter is not None:
+                        rate_limiter.on_success()
+                    return response
+
+                if code in OUTAGE_ERRORS:
+                    self.circuit_breaker.record_failure()
+                else:
+                    # Any answer from Bedrock other than an outage releases a pending trial call
+                    self.circuit_breaker.record_success()
+            finally:
+                # Hand a trial call back if the attempt ended without an outcome, e.g. on an unexpected error
+                self.circuit_breaker.release_trial(trial)
+
+            if code == 'ThrottlingException':
+                stats["throttles"] += 1
+                if rate_limiter is not None:
+                    # Shrink the shared budget so every worker slows down, not just this one
+                    rate_limiter.on_throttle()
+                else:
+                    delay = self._backoff(min(stats["throttles"], 10))
+                    logging.warning(f"[ThrottlingException] Waiting for ({delay:.1f})s.")
+                    self._sleep(delay, deadline, model_id, code)
+                    stats["throttle_wait"] += delay
+                continue
+
+            if code not in TRANSIENT_ERRORS and code not in ('ExpiredTokenException', 'ConnectionError'):
+                raise Exception(f"Unhandled boto ClientError: {code}")
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise RetryError(f"Giving up calling {model_id} after {attempt} attempts, last error: {code}")
+            if code == 'ExpiredTokenException':
+                logging.warning(f"[ExpiredTokenException] Refreshing session security token.")
+                if refresh is None:
+                    raise RetryError(f"Credentials expired calling {model_id} and no refresh is available.")
+                refresh()
+            else:
+                delay = self._backoff(attempt)
+                logging.warning(f'{code} calling {model_id}, retrying in {delay:.1f}s '
+                                f'(attempt {attempt}/{self.max_attempts})')
+                self._sleep(delay, deadline, model_id, code)
+                stats["backoff_wait"] += delay
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def configure_retry(**options):
+    """Replace the process-wide retry engine; see RetryEngine for the options."""
+    global _engine
+    with _engine_lock:
+        _engine = RetryEngine(**options)
+    return _engine
+
+
+def get_retry_engine():
+    """Return the process-wide retry engine shared by all LLM wrappers."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = RetryEngine()
+    return _engine
@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import json
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+
+def claude_stream_text(chunk: dict) -> str:
+    if chunk.get("type") == "content_block_delta":
+        return chunk["delta"].get("text", "")
+    return ""
+
+
+def llama_stream_text(chunk: dict) -> str:
+    return chunk.get("generation") or ""
+
+
+def mistral_stream_text(chunk: dict) -> str:
+    outputs = chunk.get("outputs")
+    return outputs[0].get("text", "") if outputs else ""
+
+
+def consume_stream(send: Callable, extract_text: Callable[[dict], str],
+                   stop_on: Optional[str] = None) -> Tuple[str, Dict]:
+    """
+    Read an invoke_model_with_response_stream response to the end, or until `stop_on` appears.
+
+    Args:
+        send: Zero-argument callable starting the streaming request
+        extract_text: Callable returning the text carried by one decoded chunk
+        stop_on: Stop reading (and close the stream) once this string was emitted
+
+    Returns:
+        Tuple of (completion, stats) where stats holds the time to first
+        token, total latency, input and output token counts and tokens per second
+    """
+    start = time.perf_counter()
+    response = send()
+    stream = response["body"]
+    completion = ""
+    first_token = None
+    chunks = 0
+    metrics = {}
+    stopped = False
+    try:
+        for event in stream:
+            chunk = event.get("chunk")
+            if chunk is None:
+                continue
+            data = json.loads(chunk["bytes"])
+            metrics = data.get("amazon-bedrock-invocationMetrics", metrics)
+            piece = extract_text(data)
+            if not piece:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            chunks += 1
+            completion += piece
+            if stop_on and stop_on in completion[-(len(piece) + len(stop_on)):]:
+                stopped = True
+                break
+    finally:
+        if stopped:
+            stream.close()
+    latency = time.perf_counter() - start
+    # Bedrock only reports token counts in the last chunk; fall back to the chunk count when we stopped early
+    output_tokens = metrics.get("outputTokenCount", chunks)
+    generation_time = latency - (first_token or 0.0)
+    stats = {
+        "time_to_first_token": first_token,
+        "latency": latency,
+        "input_tokens": metrics.get("inputTokenCount"),
+        "cache_read_input_tokens": metrics.get("cacheReadInputTokenCount"),
+        "cache_write_input_tokens": metrics.get("cacheWriteInputTokenCount"),
+        "output_tokens": output_tokens,
+        "tokens_per_sec": output_tokens / generation_time if generation_time > 0 else None,
+        "stopped_early": stopped,
+        "response_cache_hit": False,
+    }
+    return completion, stats
+
+
+def stream_cache_params(stop_on: Optional[str]) -> Dict:
+    """Response cache key parameters of a streamed request; one stopped at `stop_on` can end before the full completion."""
+    return {"stop_on": stop_on} if stop_on else {}
+
+
+def cached_stream_stats() -> Dict:
+    """Stats of a streamed request served from the response cache, which has no latency or tokens to report."""
+    return {"time_to_first_token": None, "latency": None, "input_tokens": None, "cache_read_input_tokens": None,
+            "cache_write_input_tokens": None, "output_tokens": None, "tokens_per_sec": None, "stopped_early": None,
+            "response_cache_hit": True}
@@ -0,0 +1,126 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Normalized form of the per-user task files.
+
+Every tasks.json / tasks_md.json entry copies the definition of its task from
+data/task/<Domain>/task.jsonl; only the task id and the situations are user
+specific. A user's tasks are therefore kept as (task_id, situations) rows,
+plus the fields of the few entries that differ from the definition, against
+one catalog of definitions, and expanded back into the usual dicts on access.
+"""
+
+import os
+import json
+from os import path
+from collections.abc import Mapping
+
+TASK_DIR = "data/task"
+MULTI_DOMAIN = "Multi-Domain"
+# Per-user fields of a task; everything else comes from its definition
+ROW_FIELDS = ("task_id", "situations")
+
+
+def task_id_of(domain, task_number) -> str:
+    return f"MD-task-{task_number}" if domain == MULTI_DOMAIN else f"SD-{domain}-task-{task_number}"
+
+
+def task_definition(domain, record) -> dict:
+    """
+    The fields a task.jsonl record contributes to a user's task, in the order of the user task files.
+
+    The per-user fields are None placeholders marking their position.
+    """
+    fields = {k: record[k] for k in ("Task Description", "User Intent", "Task Goal")}
+    if domain == MULTI_DOMAIN:
+        return {**fields, "Relevant Domains": record["Relevant Domains"],
+                "Relevant Affinity Types": record["Relevant Affinity Types"], "task_id": None, "situations": None}
+    return {**fields, "Relevant Affinity Types": record["Relevant Affinity Types"], "task_id": None, "situations": None,
+            "Relevant Domains": [domain]}
+
+
+def load_task_catalog(task_dir=TASK_DIR) -> dict:
+    """Return {task_id: definition} for every task.jsonl under `task_dir`."""
+    catalog = {}
+    for domain in sorted(os.listdir(task_dir)):
+        task_file = path.join(task_dir, domain, "task.jsonl")
+        if not path.exists(task_file):
+            continue
+        with open(task_file) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    catalog[task_id_of(domain, record["Task Number"])] = task_definition(domain, record)
+    return catalog
+
+
+def expand_task(row, catalog) -> dict:
+    """Rebuild the task dict of a (task_id, situations[, overrides]) row."""
+    task_id, situations = row[0], row[1]
+    overrides = row[2] if len(row) > 2 else {}
+    task = {}
+    for key, value in catalog[task_id].items():
+        if key == "task_id":
+            task[key] = task_id
+        elif key == "situations":
+            task[key] = situations
+        else:
+            value = overrides.get(key, value)
+            # Definitions are shared by every user, so hand out copies of their lists
+            task[key] = list(value) if isinstance(value, list) else value
+    for key, value in overrides.items():
+        if key not in task:
+            task[key] = value
+    return task
+
+
+def normalize_tasks(tasks: dict, catalog: dict) -> list:
+    """
+    Convert the content of a tasks.json / tasks_md.json file into rows against `catalog`.
+
+    Tasks missing from the catalog are added to it, defined by their first occurrence.
+    Raises ValueError if the rows would not expand back into `tasks`.
+    """
+    keys = [f"Task {i + 1}" for i in range(len(tasks))]
+    if list(tasks) != keys:
+        raise ValueError(f"Task keys are not numbered Task 1..Task {len(tasks)}")
+    rows = []
+    for task in tasks.values():
+        definition = catalog.setdefault(task["task_id"], {k: (None if k in ROW_FIELDS else v) for k, v in task.items()})
+        overrides = {k: v for k, v in task.items() if k not in ROW_FIELDS and definition.get(k) != v}
+        row = [task["task_id"], task["situations"]] + ([overrides] if overrides else [])
+        if expand_task(row, catalog) != task:
+            raise ValueError(f"Task {task['task_id']} cannot be expressed against its definition")
+        rows.append(row)
+    return rows
+
+
+class UserTasks(Mapping):
+    def __init__(self, rows, catalog):
+        """
+        Read-only `{"Task 1": task, ...}` view of a user's task rows, as loaded from a task file.
+
+        Each task dict is expanded from the catalog on first access and kept.
+        """
+        self.rows = rows
+        self.catalog = catalog
+        self._tasks = {}
+
+    def __getitem__(self, key):
+        task = self._tasks.get(key)
+        if task is None:
+            number = key[5:] if isinstance(key, str) and key.startswith("Task ") else ""
+            if not (number.isdigit() and key == f"Task {int(number)}" and 1 <= int(number) <= len(self.rows)):
+                raise KeyError(key)
+            task = self._tasks[key] = expand_task(self.rows[int(number) - 1], self.catalog)
+        return task
+
+    def __iter__(self):
+        return (f"Task {i + 1}" for i in range(len(self.rows)))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return f"UserTasks({len(self.rows)} tasks)"
@@ -0,0 +1,191 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Inverted index over the tasks of every user, to run generation or evaluation
+on a subset of tasks (e.g. `--domains Hotels` or `--task_ids SD-Flights-task-3`)
+without loading the users that have none of them.
+
+Build it once with `python3 -m util.task_index`; without a prebuilt index, or
+if the profile store changed since it was built, it is built in memory from
+the profile store (about a second with a pack).
+"""
+
+import os
+import json
+import logging
+import argparse
+import threading
+from os import path
+from collections import defaultdict
+from util.profile_store import ProfileStore, get_profile_store
+from util.task_catalog import expand_task
+
+TASK_INDEX_PATH = os.environ.get("TASK_INDEX", "data/task_index.json")
+FORMAT_VERSION = 1
+
+
+def store_signature(store) -> list:
+    """
+    Identify the state of a profile store: path, size and mtime of the pack, or for the JSON
+    files, their directory and `JsonProfileStore.source_signature`.
+    """
+    if isinstance(store, ProfileStore):
+        stat = os.stat(store.path)
+        return [path.abspath(store.path), stat.st_size, stat.st_mtime_ns]
+    return [path.abspath(store.profile_dir), *store.source_signature()]
+
+
+def build_task_index(store) -> dict:
+    """
+    Index the tasks of every user of `store`.
+
+    Returns:
+        JSON-serializable dict with, besides the version and store signature:
+            tasks: task_id -> {"multi_domain", "domains", "affinity_types"}
+            task_users: task_id -> sorted user ids
+            domain_tasks: domain -> [user_id, task_id] pairs
+            affinity_type_tasks: affinity type -> task ids
+            domain_combination_tasks: "A|B" domains of multi-domain tasks -> task ids
+    """
+    tasks = {}
+    task_users = defaultdict(list)
+    domain_tasks = defaultdict(list)
+    affinity_type_tasks = defaultdict(set)
+    domain_combination_tasks = defaultdict(set)
+    for user_id in store.user_ids():
+        for multi_domain in (False, True):
+            for row in store.task_rows(user_id, multi_domain):
+                task = expand_task(row, store.catalog)
+                task_id = task['task_id']
+                domains = task['Relevant Domains']
+                info = tasks.setdefault(task_id, {"multi_domain": multi_domain, "domains": domains, "affinity_types": []})
+                for affinity_type in task['Relevant Affinity Types']:
+                    if affinity_type not in info["affinity_types"]:
+                        info["affinity_types"].append(affinity_type)
+                    affinity_type_tasks[affinity_type].add(task_id)
+                task_users[task_id].append(user_id)
+                for domain in domains:
+                    domain_tasks[domain].append([user_id, task_id])
+                if multi_domain:
+                    domain_combination_tasks["|".join(domains)].add(task_id)
+    return {
+        "version": FORMAT_VERSION,
+        "source": store_signature(store),
+        "tasks": tasks,
+        "task_users": dict(task_users),
+        "domain_tasks": dict(domain_tasks),
+        "affinity_type_tasks": {k: sorted(v) for k, v in affinity_type_tasks.items()},
+        "domain_combination_tasks": {k: sorted(v) for k, v in domain_combination_tasks.items()},
+    }
+
+
+class TaskIndex:
+    def __init__(self, index):
+        """Queries over a `build_task_index` dict."""
+        self.index = index
+        self.tasks = index["tasks"]
+
+    def users_with_task(self, task_id) -> list:
+        return self.index["task_users"].get(task_id, [])
+
+    def tasks_in_domain(self, domain) -> list:
+        """(user_id, task_id) pairs of every task involving `domain`."""
+        return [tuple(pair) for pair in self.index["domain_tasks"].get(domain, [])]
+
+    def tasks_with_affinity_type(self, affinity_type) -> list:
+        return self.index["affinity_type_tasks"].get(affinity_type, [])
+
+    def tasks_with_domains(self, domains) -> list:
+        """Multi-domain tasks over exactly `domains`, in any order."""
+        wanted = sorted(domains)
+        return sorted(task_id for key, task_ids in self.index["domain_combination_tasks"].items()
+                      if sorted(key.split("|")) == wanted for task_id in task_ids)
+
+    def select(self, user_ids, multi_domain=False, domains=None, task_ids=None) -> dict:
+        """
+        Return {user_id: set of task ids} of the tasks of `user_ids` matching the query, users without any left out.
+
+        Args:
+            user_ids: Users to select from, in the order of the result
+            multi_domain: Whether to select among multi-domain instead of single-domain tasks
+            domains: Keep the tasks involving any of these domains
+            task_ids: Keep the tasks with these ids
+        """
+        for task_id in task_ids or []:
+            if task_id not in self.tasks:
+                raise ValueError(f"Unknown task id {task_id}")
+        wanted = {task_id for task_id, info in self.tasks.items() if info["multi_domain"] == multi_domain}
+        if task_ids:
+            wanted &= set(task_ids)
+        if domains:
+            pairs = {(user_id, task_id) for domain in domains for user_id, task_id in self.tasks_in_domain(domain)
+                     if task_id in wanted}
+        else:
+            pairs = {(user_id, task_id) for task_id in wanted for user_id in self.users_with_task(task_id)}
+        selection = defaultdict(set)
+        for user_id, task_id in pairs:
+            selection[user_id].add(task_id)
+        return {user_id: selection[user_id] for user_id in user_ids if user_id in selection}
+
+
+def save_task_index(index, index_path=TASK_INDEX_PATH):
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_task_index() -> TaskIndex:
+    """Return the process-wide task index: the one at $TASK_INDEX if it matches the profile store, else a fresh one."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            store = get_profile_store()
+            index = None
+            if path.exists(TASK_INDEX_PATH):
+                with open(TASK_INDEX_PATH) as f:
+                    index = json.load(f)
+                if index.get("version") != FORMAT_VERSION or index.get("source") != store_signature(store):
+                    logging.info(f"{TASK_INDEX_PATH} is stale, rebuilding the task index in memory "
+                                 f"(rebuild it with `python3 -m util.task_index`)")
+                    index = None
+            _index = TaskIndex(index or build_task_index(store))
+    return _index
+
+
+def select_user_tasks(user_ids, multi_domain, domains=None, task_ids=None):
+    """
+    Apply the `--domains` and `--task_ids` filters of an entry point.
+
+    Returns:
+        Tuple of (user_ids, selection), where `selection` maps each remaining user
+        to the task ids to run, or is None without filters
+    """
+    if not domains and not task_ids:
+        return user_ids, None
+    selection = get_task_index().select(user_ids, multi_domain=multi_domain, domains=domains, task_ids=task_ids)
+    logging.info(f"Selected {sum(map(len, selection.values()))} tasks of {len(selection)} users")
+    return list(selection), selection
+
+
+def filter_tasks(tasks, task_ids=None) -> dict:
+    """Keep the entries of a user's tasks whose id is in `task_ids`, if given."""
+    if task_ids is None:
+        return tasks
+    return {key: task for key, task in tasks.items() if task['task_id'] in task_ids}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt="%Y-%m-%d %H:%M")
+    parser = argparse.ArgumentParser(description="Build the inverted index over the tasks of every user.")
+    parser.add_argument("--output", type=str, default=TASK_INDEX_PATH, help="Path of the index to write.")
+    args = parser.parse_args()
+
+    index = build_task_index(get_profile_store())
+    save_task_index(index, args.output)
+    logging.info(f"Indexed {len(index['tasks'])} tasks of {len(get_profile_store().user_ids())} users into {args.output}")
@@ -0,0 +1,215 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from os import path
+from collections import defaultdict
+from contextlib import contextmanager
+
+MODEL_PRICES_PATH = os.environ.get(
+    "BEDROCK_MODEL_PRICES", path.join(path.dirname(path.dirname(path.abspath(__file__))), 'res', 'model_prices.json'))
+
+_tags = contextvars.ContextVar("telemetry_tags", default={})
+
+
+@contextmanager
+def telemetry_tags(**tags):
+    """Tag every Bedrock call made inside this block, e.g. with the user, task, turn or role."""
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def task_domain(relevant_domains):
+    """Domain a task is accounted under in the summary."""
+    return relevant_domains[0] if len(relevant_domains) == 1 else "Multi-Domain"
+
+
+def response_usage(response):
+    """
+    Return the token counts and service latency of a Bedrock response as `Telemetry.record` keyword arguments.
+
+    `response` is either an invoke_model response, whose token counts and
+    invocation latency come from the Bedrock response headers for every
+    model family, or the (completion, stats) pair of `consume_stream`.
+    Prompt cache reads and writes are counted apart from `input_tokens`.
+    """
+    if isinstance(response, tuple):
+        stats = response[1]
+        return {"input_tokens": stats.get("input_tokens"), "output_tokens": stats.get("output_tokens"),
+                "cache_read_input_tokens": stats.get("cache_read_input_tokens"),
+                "cache_write_input_tokens": stats.get("cache_write_input_tokens"),
+                "service_latency": stats.get("latency")}
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+
+    def header(name):
+        value = headers.get(name)
+        return int(value) if value is not None else None
+
+    latency = header("x-amzn-bedrock-invocation-latency")
+    return {"input_tokens": header("x-amzn-bedrock-input-token-count"),
+            "output_tokens": header("x-amzn-bedrock-output-token-count"),
+            "cache_read_input_tokens": header("x-amzn-bedrock-cache-read-input-token-count"),
+            "cache_write_input_tokens": header("x-amzn-bedrock-cache-write-input-token-count"),
+            "service_latency": latency / 1000 if latency is not None else None}
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Telemetry:
+    def __init__(self, metrics_file=None, prices=None):
+        """
+        Per-call accounting of Bedrock tokens, cost, latency, retries and throttling.
+
+        Every call is appended as one JSON line to `metrics_file` (if any) and
+        aggregated per model and per domain for the end-of-run summary.
+
+        Args:
+            metrics_file: Append-only JSONL file receiving one record per call
+            prices: Dict of model id to {"input_per_million", "output_per_million"} USD prices, with optional
+                "cache_read_per_million" and "cache_write_per_million" prompt cache prices
+        """
+        self.metrics_file = metrics_file
+        self.prices = prices or {}
+        self._file = None
+        if metrics_file:
+            os.makedirs(path.dirname(path.abspath(metrics_file)), exist_ok=True)
+            self._file = open(metrics_file, "a", buffering=1)
+        self._totals = {"model": defaultdict(self._empty_totals), "domain": defaultdict(self._empty_totals)}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty_totals():
+        return {"calls": 0, "errors": 0, "input_tokens": 0, "output_tokens": 0, "cache_read_input_tokens": 0,
+                "cache_write_input_tokens": 0, "cost": 0.0,
+                "retries": 0, "throttles": 0, "throttle_wait": 0.0, "latencies": []}
+
+    def cost(self, model_id, input_tokens, output_tokens, cache_read_input_tokens=None, cache_write_input_tokens=None):
+        price = self.prices.get(model_id)
+        if price is None or input_tokens is None or output_tokens is None:
+            return None
+        # Models without prompt cache prices are charged the input price for cached tokens
+        cache_read_price = price.get("cache_read_per_million", price["input_per_million"])
+        cache_write_price = price.get("cache_write_per_million", price["input_per_million"])
+        return (input_tokens * price["input_per_million"] + output_tokens * price["output_per_million"]
+                + (cache_read_input_tokens or 0) * cache_read_price
+                + (cache_write_input_tokens or 0) * cache_write_price) / 1e6
+
+    def record(self, model_id, latency, attempts=1, throttles=0, throttle_wait=0.0, backoff_wait=0.0,
+               input_tokens=None, output_tokens=None, cache_read_input_tokens=None, cache_write_input_tokens=None,
+               service_latency=None, error=None):
+        tags = _tags.get()
+        record = {
+            "time": time.time(),
+            "model_id": model_id,
+            **tags,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cache_read_input_tokens": cache_read_input_tokens,
+            "cache_write_input_tokens": cache_write_input_tokens,
+            "cost": self.cost(model_id, input_tokens, output_tokens, cache_read_input_tokens, cache_write_input_tokens),
+            "latency": latency,
+            "service_latency": service_latency,
+            "retries": max(0, attempts - 1),
+            "throttles": throttles,
+            "throttle_wait": throttle_wait,
+            "backoff_wait": backoff_wait,
+            "error": error,
+        }
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + "\n")
+            for kind, key in (("model", model_id), ("domain", tags.get("domain"))):
+                if key is None:
+                    continue
+                totals = self._totals[kind][key]
+                totals["calls"] += 1
+                totals["errors"] += error is not None
+                totals["input_tokens"] += input_tokens or 0
+                totals["output_tokens"] += output_tokens or 0
+                totals["cache_read_input_tokens"] += cache_read_input_tokens or 0
+                totals["cache_write_input_tokens"] += cache_write_input_tokens or 0
+                totals["cost"] += record["cost"] or 0.0
+                totals["retries"] += record["retries"]
+                totals["throttles"] += throttles
+                totals["throttle_wait"] += throttle_wait
+                totals["latencies"].append(latency)
+
+    def summary(self):
+        """Return {"model": {...}, "domain": {...}} totals, with latency percentiles instead of raw latencies."""
+        summary = {}
+        with self._lock:
+            for kind, groups in self._totals.items():
+                summary[kind] = {}
+                for key, totals in groups.items():
+                    latencies = totals["latencies"]
+                    summary[kind][key] = {k: v for k, v in totals.items() if k != "latencies"}
+                    summary[kind][key].update(wall_time=sum(latencies), latency_p50=_percentile(latencies, 0.5),
+                                              latency_p95=_percentile(latencies, 0.95))
+        return summary
+
+    def log_summary(self):
+        for kind, groups in self.summary().items():
+            for key, s in sorted(groups.items()):
+                logging.info(f"Telemetry {kind} {key}: {s['calls']} calls ({s['errors']} failed), "
+                             f"{s['input_tokens']} input / {s['output_tokens']} output tokens "
+                             f"({s['cache_read_input_tokens']} cache read / {s['cache_write_input_tokens']} cache write), "
+                             f"${s['cost']:.2f}, "
+                             f"{s['wall_time']:.0f}s wall (p50 {s['latency_p50']:.1f}s, p95 {s['latency_p95']:.1f}s), "
+                             f"{s['retries']} retries, {s['throttles']} throttles, {s['throttle_wait']:.0f}s throttled")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _load_prices(prices):
+    if isinstance(prices, str):
+        with open(prices) as f:
+            return json.load(f)
+    return prices
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def configure_telemetry(metrics_file=None, prices=MODEL_PRICES_PATH):
+    """
+    Replace the process-wide telemetry.
+
+    Args:
+        metrics_file: Append-only JSONL file receiving one record per call; None only keeps the summary
+        prices: Path to a JSON file, or a dict, of per-model USD prices per million tokens
+    """
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is not None:
+            _telemetry.close()
+        _telemetry = Telemetry(metrics_file, _load_prices(prices))
+    return _telemetry
+
+
+def get_telemetry():
+    """Return the process-wide telemetry recording every Bedrock call."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(prices=_load_prices(MODEL_PRICES_PATH))
+    return _telemetry
+
+
+def log_telemetry_summary():
+    """Log the per-model and per-domain totals of this run."""
+    get_telemetry().log_summary()
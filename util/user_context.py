@@ -0,0 +1,161 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import json
+import threading
+from os import path
+from util.profile_store import get_profile_store
+
+if "DATA_DIR" in os.environ:
+    DATA_DIR = os.environ["DATA_DIR"]
+else:
+    DATA_DIR = path.join(os.getenv("HOME"), 'workspace', 'data')
+
+USER_CONTEXT_DIR = os.environ.get("USER_CONTEXT_DIR", path.join(DATA_DIR, 'caches', 'user_context'))
+# Bump whenever the rendering below changes, so stale artifacts are rebuilt
+FORMAT_VERSION = 1
+
+
+def format_demographics(demographic_profile: dict) -> str:
+    return "\n".join([f"- {k}: {v}" for k, v in demographic_profile.items()])
+
+
+def format_affinity(user_affinity: dict) -> str:
+    return "\n".join([f"- {k}: {', '.join(map(str, v))}" if isinstance(v, list) else f"- {k}: {v}" for k, v in user_affinity.items()])
+
+
+def format_situation(situation_context: dict) -> str:
+    return "\n".join([f"- {k}: {v}" for k, v in situation_context.items()])
+
+
+def format_affinities(user_affinities: dict) -> str:
+    """Multi-domain preferences: each domain's rendered affinity under a `Domain:` header."""
+    return "".join("\n" + domain + ":\n" + (affinity if isinstance(affinity, str) else format_affinity(affinity)) + "\n"
+                   for domain, affinity in user_affinities.items())
+
+
+def format_interaction_summaries(interaction_summaries: dict) -> str:
+    """Multi-domain interaction history: each domain's summary wrapped in a `<Domain>` tag."""
+    return "".join("\n<" + domain + ">\n" + summary + "\n</" + domain + ">\n"
+                   for domain, summary in interaction_summaries.items())
+
+
+def as_rendered(section, format_section):
+    """Render a prompt section unless it is already rendered, e.g. taken from a `UserContext`."""
+    return section if isinstance(section, str) else format_section(section)
+
+
+def render_user_context(user_profile: dict, domain_sets=()) -> dict:
+    """
+    Render every user-level prompt section of a profile.
+
+    Args:
+        user_profile: Parsed profile.json
+        domain_sets: Domain combinations of the user's multi-domain tasks to pre-render
+
+    Returns:
+        JSON-serializable dict, see `UserContext`
+    """
+    demographics = dict(user_profile['demographics'])
+    rendered = {
+        # The judge has always been shown the user id; the dialogue agents are not
+        "profile_demographics": format_demographics(demographics),
+        "demographics": format_demographics({k: v for k, v in demographics.items() if k != 'user_id'}),
+        "affinity": {domain: format_affinity(affinity) for domain, affinity in user_profile['affinities'].items()},
+        "interaction": dict(user_profile['interactions']),
+        "affinities": {},
+        "interaction_summaries": {},
+    }
+    context = UserContext(rendered)
+    for domains in domain_sets:
+        context.affinities(domains)
+        context.interaction_summaries(domains)
+    return rendered
+
+
+class UserContext:
+    def __init__(self, rendered):
+        """
+        Pre-rendered prompt sections of one user, shared by generation and evaluation.
+
+        Single-domain sections are rendered per domain; multi-domain ones per
+        domain combination, on first use if not pre-rendered.
+        """
+        self.rendered = rendered
+        self.demographics = rendered["demographics"]
+        self.profile_demographics = rendered["profile_demographics"]
+
+    def affinity(self, domain) -> str:
+        return self.rendered["affinity"][domain]
+
+    def interaction_summary(self, domain) -> str:
+        return self.rendered["interaction"][domain]
+
+    def affinities(self, domains) -> str:
+        key = "|".join(domains)
+        if key not in self.rendered["affinities"]:
+            self.rendered["affinities"][key] = format_affinities({domain: self.affinity(domain) for domain in domains})
+        return self.rendered["affinities"][key]
+
+    def interaction_summaries(self, domains) -> str:
+        key = "|".join(domains)
+        if key not in self.rendered["interaction_summaries"]:
+            self.rendered["interaction_summaries"][key] = format_interaction_summaries(
+                {domain: self.interaction_summary(domain) for domain in domains})
+        return self.rendered["interaction_summaries"][key]
+
+
+def _build(store, user_id, digest):
+    domain_sets = [task['Relevant Domains'] for task in store.tasks(user_id, multi_domain=True).values()]
+    return {
+        "version": FORMAT_VERSION,
+        "profile_sha256": digest,
+        "context": render_user_context(store.profile(user_id), domain_sets),
+    }
+
+
+def _write(artifact_file, artifact):
+    os.makedirs(path.dirname(artifact_file), exist_ok=True)
+    # Concurrent processes may build the same user; each writes its own file and the last rename wins
+    tmp_file = f"{artifact_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(artifact, f)
+    os.replace(tmp_file, artifact_file)
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def load_user_context(user_id, cache_dir=USER_CONTEXT_DIR) -> UserContext:
+    """
+    Return the pre-rendered context of a user, memoized in memory and in `cache_dir`.
+
+    The on-disk artifact is rebuilt when the digest of the user's profile.json,
+    as reported by the profile store, no longer matches the one it was built from.
+    """
+    store = get_profile_store()
+    digest = store.profile_digest(user_id)
+    key = (cache_dir, user_id)
+    with _contexts_lock:
+        cached = _contexts.get(key)
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+
+    artifact_file = path.join(cache_dir, f"user{user_id}.json")
+    artifact = None
+    if path.exists(artifact_file):
+        try:
+            with open(artifact_file) as f:
+                artifact = json.load(f)
+        except ValueError:
+            artifact = None
+    if artifact is None or artifact.get("version") != FORMAT_VERSION or artifact.get("profile_sha256") != digest:
+        artifact = _build(store, user_id, digest)
+        _write(artifact_file, artifact)
+
+    context = UserContext(artifact["context"])
+    with _contexts_lock:
+        _contexts[key] = (digest, context)
+    return context
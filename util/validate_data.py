@@ -0,0 +1,338 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+"""
+Integrity check of data/profile against res/schema.json and the task definitions.
+
+Each user's profile.json, tasks.json and tasks_md.json are checked by
+per-domain checkers compiled once from the schema, on a process pool. Issues
+are errors when they would make generation or evaluation fail (e.g. a task of
+a domain missing from the profile, the KeyError hours into a run) and
+warnings otherwise (e.g. affinity values outside the schema). Results are
+cached by the SHA-256 of the user's files, so only changed users are checked
+again. Run it with `python3 -m util.validate_data`, or before a run with the
+`--validate` flag of the entry points.
+
+When a profile store is built (see `util.profile_store`), the pre-flight check
+validates the profiles and tasks packed in it instead, since that is what the
+run reads, and warns about user files changed since the pack was built.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import argparse
+from os import path
+from concurrent.futures import ProcessPoolExecutor
+from util.task_catalog import TASK_DIR, load_task_catalog
+from util.profile_store import PROFILE_DIR, PROFILE_STORE_PATH, TASK_FILES, ProfileStore, get_profile_store
+from util.user_context import DATA_DIR
+
+SCHEMA_PATH = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'res', 'schema.json')
+VALIDATION_CACHE_PATH = os.environ.get("VALIDATION_CACHE", path.join(DATA_DIR, 'caches', 'validation.json'))
+# Bump whenever the checks below change, so cached results are discarded
+VALIDATOR_VERSION = 1
+USER_FILES = ("profile.json", TASK_FILES[False], TASK_FILES[True])
+PROFILE_SECTIONS = ("affinities", "demographics", "interests", "interactions")
+# Task fields read by generation and evaluation, with their types
+TASK_FIELDS = {"task_id": str, "situations": dict, "Relevant Domains": list, "User Intent": str, "Task Goal": str}
+
+
+class DataValidationError(Exception):
+    pass
+
+
+def issue(level, file, where, message):
+    return {"level": level, "file": file, "path": where, "message": message}
+
+
+class DomainChecker:
+    def __init__(self, domain_schema):
+        """Check the affinities of one domain against its schema entry."""
+        self.domain = domain_schema['domain']
+        self.affinities = {
+            affinity['name']: (frozenset(affinity['possible_values']) if affinity['is_categorical'] else None,
+                               affinity['has_multiple_values'])
+            for affinity in domain_schema['affinities']}
+
+    def check(self, affinities):
+        issues = []
+        where = f"affinities.{self.domain}"
+        for name, (allowed, multiple) in self.affinities.items():
+            if name not in affinities:
+                issues.append(issue("warning", "profile.json", where, f"Missing affinity {name!r}"))
+                continue
+            value = affinities[name]
+            values = value if isinstance(value, list) else [value]
+            if isinstance(value, list) != multiple:
+                issues.append(issue("warning", "profile.json", f"{where}.{name}",
+                                    f"Expected {'a list' if multiple else 'a single value'}, got {value!r}"))
+            for v in values:
+                if not isinstance(v, str):
+                    issues.append(issue("warning", "profile.json", f"{where}.{name}", f"Non-string value {v!r}"))
+                elif allowed is not None and v not in allowed:
+                    issues.append(issue("warning", "profile.json", f"{where}.{name}", f"Value {v!r} is not in the schema"))
+        for name in affinities:
+            if name not in self.affinities:
+                issues.append(issue("warning", "profile.json", where, f"Affinity {name!r} is not in the schema"))
+        return issues
+
+
+class DatasetValidator:
+    def __init__(self, schema_path=SCHEMA_PATH, task_dir=TASK_DIR):
+        """Checks of a user directory, compiled once from the schema and the task definitions."""
+        with open(schema_path) as f:
+            schema = json.load(f)
+        self.checkers = {domain['domain']: DomainChecker(domain) for domain in schema}
+        self.catalog = load_task_catalog(task_dir)
+
+    def check_profile(self, profile):
+        if not isinstance(profile, dict):
+            return [issue("error", "profile.json", "", "Profile is not an object")]
+        issues = [issue("error", "profile.json", section, "Missing or not an object")
+                  for section in PROFILE_SECTIONS if not isinstance(profile.get(section), dict)]
+        if issues:
+            return issues
+        for domain, checker in self.checkers.items():
+            affinities = profile['affinities'].get(domain)
+            if isinstance(affinities, dict):
+                issues += checker.check(affinities)
+            if domain not in profile['interests']:
+                issues.append(issue("warning", "profile.json", "interests", f"Missing domain {domain!r}"))
+            elif profile['interests'][domain] not in (0, 1):
+                issues.append(issue("warning", "profile.json", f"interests.{domain}",
+                                    f"Expected 0 or 1, got {profile['interests'][domain]!r}"))
+        for section in ("affinities", "interests", "interactions"):
+            for domain in profile[section]:
+                if domain not in self.checkers:
+                    issues.append(issue("warning", "profile.json", section, f"Domain {domain!r} is not in the schema"))
+        for domain, summary in profile['interactions'].items():
+            if not isinstance(summary, str):
+                issues.append(issue("warning", "profile.json", f"interactions.{domain}", "Summary is not a string"))
+        if 'user_id' not in profile['demographics']:
+            issues.append(issue("warning", "profile.json", "demographics", "Missing user_id"))
+        return issues
+
+    def check_tasks(self, tasks, file, profile, multi_domain):
+        if not isinstance(tasks, dict):
+            return [issue("error", file, "", "Tasks are not an object")]
+        issues = []
+        seen = set()
+        for key, task in tasks.items():
+            if not isinstance(task, dict):
+                issues.append(issue("error", file, key, "Task is not an object"))
+                continue
+            missing = [field for field, kind in TASK_FIELDS.items() if not isinstance(task.get(field), kind)]
+            if missing:
+                issues.append(issue("error", file, key, f"Missing or mistyped fields {missing}"))
+                continue
+            task_id, domains = task['task_id'], task['Relevant Domains']
+            if task_id in seen:
+                issues.append(issue("error", file, key, f"Duplicate task id {task_id}"))
+            seen.add(task_id)
+            if task_id not in self.catalog:
+                issues.append(issue("warning", file, key, f"Task id {task_id} is not defined under {TASK_DIR}"))
+            if not domains or (not multi_domain and len(domains) != 1):
+                issues.append(issue("error", file, key, f"Expected {'domains' if multi_domain else 'one domain'}, got {domains}"))
+            for domain in domains:
+                # The prompts of the task read these sections of the profile
+                for section in ("affinities", "interactions"):
+                    if isinstance(profile, dict) and domain not in (profile.get(section) or {}):
+                        issues.append(issue("error", file, key, f"Domain {domain!r} of {task_id} is missing from profile {section}"))
+        return issues
+
+    def check_user(self, user_dir):
+        """Return the issues of the files of `user_dir`."""
+        documents = {}
+        issues = []
+        for name in USER_FILES:
+            try:
+                with open(path.join(user_dir, name)) as f:
+                    documents[name] = json.load(f)
+            except (OSError, ValueError) as exception:
+                issues.append(issue("error", name, "", f"Cannot be read: {exception}"))
+        return issues + self.check_documents(documents)
+
+    def check_packed_user(self, store, user_id, user_dir):
+        """Return the issues of the user's profile and tasks as packed in `store`, built from `user_dir`."""
+        try:
+            documents = {"profile.json": store.profile(user_id),
+                         TASK_FILES[False]: dict(store.tasks(user_id, False)),
+                         TASK_FILES[True]: dict(store.tasks(user_id, True))}
+        except KeyError as exception:
+            return [issue("error", path.basename(store.path), "", f"Cannot be read: {exception}")]
+        issues = self.check_documents(documents)
+        built = os.stat(store.path).st_mtime_ns
+        for name in USER_FILES:
+            file = path.join(user_dir, name)
+            if path.exists(file) and os.stat(file).st_mtime_ns > built:
+                issues.append(issue("warning", name, "", f"Changed since {store.path} was built, "
+                                                          f"rebuild it with `python3 -m util.profile_store`"))
+        return issues
+
+    def check_documents(self, documents):
+        """Return the issues of a user's parsed files, {file name: content}."""
+        issues = []
+        profile = documents.get("profile.json")
+        if profile is not None:
+            issues += self.check_profile(profile)
+        for name, multi_domain in ((TASK_FILES[False], False), (TASK_FILES[True], True)):
+            if name in documents:
+                issues += self.check_tasks(documents[name], name, profile, multi_domain)
+        return issues
+
+
+def user_digest(user_dir) -> str:
+    digest = hashlib.sha256()
+    for name in USER_FILES:
+        file = path.join(user_dir, name)
+        if path.exists(file):
+            with open(file, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def user_stat(user_dir) -> list:
+    stats = []
+    for name in USER_FILES:
+        file = path.join(user_dir, name)
+        stat = os.stat(file) if path.exists(file) else None
+        stats.append([stat.st_mtime_ns, stat.st_size] if stat else None)
+    return stats
+
+
+_validator = None
+_store = None
+
+
+def _init_worker(schema_path, task_dir, store_path=None):
+    global _validator, _store
+    _validator = DatasetValidator(schema_path, task_dir)
+    _store = ProfileStore(store_path) if store_path else None
+
+
+def _check(job):
+    """Worker: check a user's packed records, or hash their files and check them unless they match the cached digest."""
+    user_id, user_dir, cached_digest = job
+    if _store is not None:
+        return None, _validator.check_packed_user(_store, user_id, user_dir)
+    digest = user_digest(user_dir)
+    if digest == cached_digest:
+        return digest, None
+    return digest, _validator.check_user(user_dir)
+
+
+def _fingerprint(schema_path, task_dir):
+    digest = hashlib.sha256(str(VALIDATOR_VERSION).encode())
+    with open(schema_path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(json.dumps(load_task_catalog(task_dir), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def validate_dataset(user_ids, profile_dir=PROFILE_DIR, workers=None, cache_path=VALIDATION_CACHE_PATH,
+                     schema_path=SCHEMA_PATH, task_dir=TASK_DIR, store_path=None) -> dict:
+    """
+    Check the files of `user_ids` under `profile_dir`, or their records in the
+    profile store at `store_path` if given.
+
+    Users whose files (and store) are unchanged (same size and mtime, else
+    same SHA-256 of the files) since their last check reuse its result from
+    `cache_path`.
+
+    Returns:
+        {user_id: list of issues}, each a dict with the level ("error" or "warning"), file, path and message
+    """
+    fingerprint = _fingerprint(schema_path, task_dir)
+    cache = {}
+    if cache_path and path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+    entries = cache.get("users", {}) if cache.get("fingerprint") == fingerprint else {}
+
+    store_stat = None
+    if store_path:
+        stat = os.stat(store_path)
+        store_stat = [path.abspath(store_path), stat.st_mtime_ns, stat.st_size]
+
+    results, jobs = {}, []
+    for user_id in user_ids:
+        user_dir = path.join(profile_dir, f"user{user_id}")
+        entry = entries.get(str(user_id))
+        stat = user_stat(user_dir) + ([store_stat] if store_stat else [])
+        if entry is not None and entry["stat"] == stat:
+            results[user_id] = entry["issues"]
+        else:
+            jobs.append((user_id, user_dir, stat, entry["sha256"] if entry and not store_path else None))
+
+    if jobs:
+        workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+        job_args = [(user_id, user_dir, digest) for user_id, user_dir, _, digest in jobs]
+        if workers == 1:
+            _init_worker(schema_path, task_dir, store_path)
+            checked = list(map(_check, job_args))
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(schema_path, task_dir, store_path)) as pool:
+                checked = list(pool.map(_check, job_args, chunksize=max(1, len(jobs) // (4 * workers))))
+        for (user_id, _, stat, _), (digest, issues) in zip(jobs, checked):
+            if issues is None:
+                issues = entries[str(user_id)]["issues"]
+            results[user_id] = issues
+            entries[str(user_id)] = {"stat": stat, "sha256": digest, "issues": issues}
+        if cache_path:
+            os.makedirs(path.dirname(path.abspath(cache_path)), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"fingerprint": fingerprint, "users": entries}, f)
+            os.replace(tmp_path, cache_path)
+    source = store_path or profile_dir
+    logging.info(f"Validated {len(results)} users of {source} ({len(jobs)} checked, {len(results) - len(jobs)} unchanged)")
+    return results
+
+
+def log_issues(results, max_lines=50):
+    """Log the issues found and return the number of errors and warnings."""
+    # Errors first
+    found = sorted(((i["level"], user_id, i) for user_id, issues in results.items() for i in issues),
+                   key=lambda found: found[0])
+    for level, user_id, i in found[:max_lines]:
+        where = f" {i['path']}" if i['path'] else ""
+        (logging.error if level == "error" else logging.warning)(f"user{user_id}/{i['file']}{where}: {i['message']}")
+    if len(found) > max_lines:
+        logging.warning(f"... and {len(found) - max_lines} more issues")
+    levels = [level for level, _, _ in found]
+    return levels.count("error"), levels.count("warning")
+
+
+def validate_users(user_ids, workers=None):
+    """Pre-flight check of the users of a run, as read from the profile store; raises DataValidationError if any would fail."""
+    store = get_profile_store()
+    store_path = store.path if isinstance(store, ProfileStore) else None
+    errors, warnings = log_issues(validate_dataset(user_ids, workers=workers, store_path=store_path))
+    if errors:
+        raise DataValidationError(f"{errors} data errors found (and {warnings} warnings), fix them before the run")
+    logging.info(f"No data errors found ({warnings} warnings)")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt="%Y-%m-%d %H:%M")
+    parser = argparse.ArgumentParser(description="Check the user profiles and tasks against res/schema.json.")
+    parser.add_argument("-s", "--start_index", type=int, default=0, help="The starting index of the user profiles.")
+    parser.add_argument("-e", "--end_index", type=int, default=1499, help="The ending index of the user profiles.")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of checking processes. Default is the number of CPUs.")
+    parser.add_argument("--max_lines", type=int, default=50, help="Maximum number of issues to log.")
+    parser.add_argument("--store", action="store_true", help="Check the profile store at $PROFILE_STORE instead of the JSON files.")
+    args = parser.parse_args()
+    if args.store and not path.exists(PROFILE_STORE_PATH):
+        parser.error(f"No profile store at {PROFILE_STORE_PATH}, build one with `python3 -m util.profile_store`")
+
+    results = validate_dataset(range(args.start_index, args.end_index + 1), workers=args.workers,
+                               store_path=PROFILE_STORE_PATH if args.store else None)
+    errors, warnings = log_issues(results, args.max_lines)
+    logging.info(f"{errors} errors, {warnings} warnings")
+    exit(1 if errors else 0)